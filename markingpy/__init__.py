@@ -16,49 +16,68 @@
 #
 """The MarkingPy package"""
 
+__version__ = "1.0.0"
 
 import logging
 
 from .import exercises
 from .import cases
+from .import cache
 from .import compiler
 from .import config
+from .import distributed
 from .import execution
 from .import finders
 from .import grader
 from .import syntax
 from .import markscheme
+from .import metrics
+from .import pipeline
+from .import progress
 from .import submission
 from .import utils
 from .import users
 from .import storage
+from .import watch
 
 from .config import *
 from .grader import *
 from .exercises import *
 from .markscheme import *
+from .metrics import *
+from .pipeline import *
+from .progress import *
 from .cases import *
 from .submission import *
 from .finders import *
+from .cache import *
+from .distributed import *
 from .compiler import *
 from .execution import *
 from .syntax import *
 from .users import *
 from .storage import *
+from .watch import *
 
 logging.basicConfig(level=LOGGING_LEVELS[GLOBAL_CONF["logging"]["level"]])
 __all__ = (
     users.__all__ +
     cases.__all__ +
     config.__all__ +
+    cache.__all__ +
     compiler.__all__ +
+    distributed.__all__ +
     exercises.__all__ +
     finders.__all__ +
     grader.__all__ +
     markscheme.__all__ +
+    metrics.__all__ +
+    pipeline.__all__ +
+    progress.__all__ +
     submission.__all__ +
     execution.__all__ +
     syntax.__all__ +
     storage.__all__ +
+    watch.__all__ +
     ['utils']
 )
@@ -0,0 +1,481 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Caches for grading results.
+
+Results are keyed by the contents of a submission rather than its
+reference, together with a fingerprint of the marking scheme, so a cached
+result is only used when neither the submission nor anything that could
+change its grade has changed. The result of each exercise is also stored
+under the fingerprint of the exercise, so that when part of the marking
+scheme changes only the exercises that changed need to be run again.
+
+Compiled submissions are cached separately, on disk, by a hash of their
+source, the Python bytecode version and the compiler options, so they can
+be reused with any marking scheme.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import marshal
+import os
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import namedtuple
+from importlib.util import MAGIC_NUMBER
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+from .import __version__
+from .cases import TestFeedback
+from .exercises import ExerciseFeedback
+from .grader import Record
+
+if TYPE_CHECKING:
+    from .exercises import Exercise
+    from .submission import Submission
+logger = logging.getLogger(__name__)
+__all__ = ['ResultCache', 'CachedResult', 'CodeCache', 'CompiledSubmission']
+CachedResult = namedtuple('CachedResult', ('score', 'percentage', 'feedback'))
+CompiledSubmission = namedtuple('CompiledSubmission', ('source', 'code', 'feedback'))
+DEFAULT_MAX_SIZE = 256 * 2 ** 20
+# Fraction of the maximum size to which a full cache is reduced, so that
+# the results stored after an eviction do not each evict another one.
+EVICT_FRACTION = 0.9
+
+
+def _feedback_text(item) -> str:
+    """
+    Convert an item of feedback, which might be a report object, to text.
+    """
+    get_text_report = getattr(item, 'get_text_report', None)
+    if get_text_report is not None:
+        return get_text_report()
+
+    return str(item)
+
+
+def _exercise_data(result: ExerciseFeedback) -> list:
+    """
+    Convert the feedback for an exercise to a form that can be stored.
+    """
+    per_test = [
+        [r.mark, _feedback_text(r.feedback), r.passed, r.runtime]
+        for r in result.per_test
+    ]
+    return [result.marks, result.total_marks, result.feedback, per_test]
+
+
+def _exercise_feedback(exercise: 'Exercise', data: list) -> ExerciseFeedback:
+    """
+    Rebuild the feedback for an exercise from stored data.
+    """
+    marks, total_marks, feedback, per_test = data
+    # Entries written by older versions only have the mark and text.
+    per_test = [
+        TestFeedback(test, mark, text, *rest)
+        for test, (mark, text, *rest) in zip(exercise.tests, per_test)
+    ]
+    return ExerciseFeedback(marks, total_marks, feedback, per_test)
+
+
+class ResultCache:
+    """
+    Persistent cache of grading results.
+
+    Each result is stored under a hash of the submission source and the
+    marking scheme fingerprint. When the total size of the stored results
+    exceeds *max_size*, the least recently used results are evicted until
+    the cache is 90% full.
+
+    Results that are stored and the times at which results are used are
+    buffered, and written in a single transaction once *batch_size* of
+    them are waiting, *flush_interval* seconds after the first of them,
+    when the cache is full, or when the cache is closed.
+
+    :param path: Path to the cache database.
+    :param max_size: Maximum total size of the cached results in bytes.
+    :param batch_size: Maximum number of writes buffered. Default 100.
+    :param flush_interval: Maximum time in seconds a write is buffered.
+        Default 1.0.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        max_size: int = DEFAULT_MAX_SIZE,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+    ):
+        self.path = path = Path(path).expanduser()
+        self.max_size = max_size
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Results are looked up and stored from different pipeline stages.
+        self.lock = threading.RLock()
+        self.db = db = sqlite3.connect(str(path), check_same_thread=False)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        # Results waiting to be stored, as (result, size, last_used) by key,
+        # and the time at which stored results were last used, by key.
+        self.pending = {}
+        self.used = {}
+        self.timer = None
+        self.closed = False
+        ref = weakref.ref(self)
+
+        def close_at_exit():
+            cache = ref()
+            if cache is not None:
+                cache.close()
+
+        self.close_at_exit = close_at_exit
+        atexit.register(close_at_exit)
+        self.create_table()
+        (size,) = db.execute("SELECT TOTAL(size) FROM results").fetchone()
+        self.size = int(size)
+
+    def create_table(self):
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key text primary key,"
+            " result text,"
+            " size int,"
+            " last_used real"
+            ");"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def make_key(source: str, scheme_fingerprint: str) -> str:
+        digest = hashlib.sha256(scheme_fingerprint.encode())
+        digest.update(b'\0')
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def _get(self, key: str) -> Any:
+        now = time.time()
+        with self.lock:
+            if key in self.pending:
+                data, size, _ = self.pending[key]
+                self.pending[key] = (data, size, now)
+                return json.loads(data)
+
+            row = self.db.execute(
+                "SELECT result FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.used[key] = now
+            self.schedule_flush()
+        return json.loads(row[0])
+
+    def _put(self, key: str, value: Any):
+        data = json.dumps(value)
+        with self.lock:
+            if key in self.pending:
+                self.size -= self.pending.pop(key)[1]
+            else:
+                old = self.db.execute(
+                    "SELECT size FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if old is not None:
+                    self.size -= old[0]
+            self.used.pop(key, None)
+            self.pending[key] = (data, len(data), time.time())
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.flush()
+            else:
+                self.schedule_flush()
+
+    def schedule_flush(self):
+        """
+        Flush the buffered writes if the batch is full, or start a timer
+        that flushes them after the flush interval.
+        """
+        if len(self.pending) + len(self.used) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = timer = threading.Timer(self.flush_interval, self.flush_later)
+            timer.daemon = True
+            timer.start()
+
+    def flush_later(self):
+        """
+        Flush the buffered writes when the flush timer expires, unless the
+        cache has been closed in the meantime.
+        """
+        with self.lock:
+            if not self.closed:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered results and last used times, and evict results
+        if the cache is full, in a single transaction.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not (self.pending or self.used or self.size > self.max_size):
+                return
+
+            with self.db:
+                self.db.executemany(
+                    "UPDATE results SET last_used = ? WHERE key = ?",
+                    [(last_used, key) for key, last_used in self.used.items()],
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO results (key, result, size, last_used)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(key, *entry) for key, entry in self.pending.items()],
+                )
+                self.evict()
+            self.pending = {}
+            self.used = {}
+
+    def close(self):
+        """
+        Flush the buffered writes and close the cache database.
+        """
+        with self.lock:
+            if self.closed:
+                return
+
+            try:
+                self.flush()
+            finally:
+                self.db.close()
+                self.closed = True
+        atexit.unregister(self.close_at_exit)
+
+    def get(self, source: str, scheme_fingerprint: str) -> Optional[CachedResult]:
+        """
+        Get the cached result for a submission source.
+
+        :return: :class:`CachedResult` or None if there is no cached result.
+        """
+        data = self._get(self.make_key(source, scheme_fingerprint))
+        if data is None:
+            return None
+
+        return CachedResult(*data)
+
+    def put(self, source: str, scheme_fingerprint: str, result: CachedResult):
+        """
+        Store the result for a submission source, evicting old results if
+        the cache is full.
+        """
+        self._put(self.make_key(source, scheme_fingerprint), result)
+
+    def get_exercise(
+        self, source: str, exercise_fingerprint: str, exercise: 'Exercise'
+    ) -> Optional[ExerciseFeedback]:
+        """
+        Get the cached result of an exercise for a submission source.
+
+        :param source: Submission source.
+        :param exercise_fingerprint: Fingerprint of the exercise.
+        :param exercise: The exercise, used to rebuild the feedback.
+        :return: :class:`ExerciseFeedback` or None if there is no cached
+            result.
+        """
+        data = self._get(self.make_key(source, f'exercise:{exercise_fingerprint}'))
+        if data is None:
+            return None
+
+        return _exercise_feedback(exercise, data)
+
+    def put_exercise(
+        self, source: str, exercise_fingerprint: str, result: ExerciseFeedback
+    ):
+        """
+        Store the result of an exercise for a submission source.
+        """
+        key = self.make_key(source, f'exercise:{exercise_fingerprint}')
+        self._put(key, _exercise_data(result))
+
+    def evict(self):
+        """
+        Remove the least recently used results if the cache is larger than
+        the maximum size, until it is 90% full.
+        """
+        if self.size <= self.max_size:
+            return
+
+        target = self.max_size * EVICT_FRACTION
+        while self.size > target:
+            rows = self.db.execute(
+                "SELECT key, size FROM results ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+
+            for key, size in rows:
+                if self.size <= target:
+                    break
+
+                self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.size -= size
+                logger.debug(f'Evicted cached result {key}')
+
+    def clear(self):
+        with self.lock:
+            self.pending = {}
+            self.used = {}
+            self.db.execute("DELETE FROM results")
+            self.db.commit()
+            self.size = 0
+
+    def get_submission(self, sub: 'Submission', scheme_fingerprint: str) -> bool:
+        """
+        Restore the feedback and record for a submission from the cache.
+
+        :return: True if a cached result was found.
+        """
+        result = self.get(sub.raw_source, scheme_fingerprint)
+        if result is None:
+            return False
+
+        sub.feedback.update(result.feedback)
+        sub.score = result.score
+        sub.percentage = result.percentage
+        sub.record = Record(
+            sub.reference, result.percentage, result.feedback.get('tests', '')
+        )
+        return True
+
+    def put_submission(self, sub: 'Submission', scheme_fingerprint: str):
+        """
+        Store the result for a graded submission.
+        """
+        feedback = {k: _feedback_text(v) for k, v in sub.feedback.items()}
+        result = CachedResult(sub.score, sub.percentage, feedback)
+        self.put(sub.raw_source, scheme_fingerprint, result)
+
+    def get_exercises(
+        self, sub: 'Submission', exercises: list, exercise_fingerprints: list
+    ) -> int:
+        """
+        Restore the cached results of individual exercises for a submission
+        into :attr:`Submission.exercise_results`.
+
+        :return: Number of exercise results found.
+        """
+        found = 0
+        items = enumerate(zip(exercises, exercise_fingerprints))
+        for index, (exercise, exercise_fingerprint) in items:
+            result = self.get_exercise(sub.raw_source, exercise_fingerprint, exercise)
+            if result is not None:
+                sub.exercise_results[index] = result
+                found += 1
+        return found
+
+    def put_exercises(self, sub: 'Submission', exercise_fingerprints: list):
+        """
+        Store the results of the individual exercises for a graded
+        submission. Results of exercises that failed to run are not
+        stored.
+        """
+        for index, result in sub.exercise_results.items():
+            if result.failed:
+                continue
+
+            self.put_exercise(sub.raw_source, exercise_fingerprints[index], result)
+
+
+class CodeCache:
+    """
+    On-disk cache of compiled submissions.
+
+    Like ``__pycache__``, each entry is a file containing the marshalled
+    code object, together with the source recovered from any syntax errors
+    and the compilation feedback. Entries are keyed by a hash of the
+    submission source, the bytecode magic number, the optimization level
+    of the interpreter, the compiler options and the version of markingpy,
+    so entries written by a different version of Python, or recovered from
+    syntax errors by a different version of the compiler, are never used.
+
+    :param path: Directory in which the compiled submissions are stored.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path).expanduser()
+
+    @staticmethod
+    def make_key(source: str, flags: tuple = ()) -> str:
+        digest = hashlib.sha256(MAGIC_NUMBER)
+        digest.update(
+            repr((__version__, sys.flags.optimize) + tuple(flags)).encode()
+        )
+        digest.update(b'\0')
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def get_path(self, key: str) -> Path:
+        return self.path / key[:2] / f'{key}.marshal'
+
+    def get(self, source: str, flags: tuple = ()) -> Optional[CompiledSubmission]:
+        """
+        Get the compiled submission for a source.
+
+        :param source: Submission source.
+        :param flags: Options the source was compiled with.
+        :return: :class:`CompiledSubmission` or None if there is no cached
+            entry or the entry cannot be read.
+        """
+        path = self.get_path(self.make_key(source, flags))
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        # noinspection PyBroadException
+        try:
+            return CompiledSubmission(*marshal.loads(data))
+
+        except Exception:
+            logger.warning(f'Ignoring unreadable compiled submission {path}')
+            return None
+
+    def put(self, source: str, compiled: CompiledSubmission, flags: tuple = ()):
+        """
+        Store the compiled submission for a source.
+
+        The entry is written to a temporary file that replaces any existing
+        entry, so readers never see a partly written entry.
+        """
+        path = self.get_path(self.make_key(source, flags))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}')
+        tmp.write_bytes(marshal.dumps(tuple(compiled)))
+        os.replace(tmp, path)
+
+    def clear(self):
+        for path in self.path.glob('*/*.marshal'):
+            path.unlink()
@@ -16,6 +16,7 @@
 #
 #
 import logging
+import time
 import types
 import typing
 import inspect
@@ -26,14 +27,20 @@ from io import StringIO
 from typing import ( Callable, Union, Optional, Type, Any, Tuple, Dict, List, Iterable)
 from warnings import WarningMessage
 
-from .utils import time_run, str_format_args
+from .utils import time_run, str_format_args, fingerprint
 from .execution import ExecutionContext
 from .import magic
+from .import metrics
 
 ARGS = Tuple[Any, ...]
 KWARGS = Dict[str, Any]
 logger = logging.getLogger(__name__)
-TestFeedback = namedtuple("TestFeedback", ("test", "mark", "feedback"))
+# passed is whether the test succeeded, and runtime the time in seconds
+# taken to run it, where known.
+TestFeedback = namedtuple(
+    "TestFeedback", ("test", "mark", "feedback", "passed", "runtime")
+)
+TestFeedback.__new__.__defaults__ = (None, None)
 __all__ = [
     'BaseTest',
     'Test',
@@ -79,6 +86,21 @@ class BaseTest(magic.MagicBase):
     def get_name(self) -> str:
         return self.__class__.__name__
 
+    def get_fingerprint_data(self) -> List[Any]:
+        """
+        Get the configuration that determines the outcome of this test.
+
+        :return: list of items to include in the fingerprint
+        """
+        return [self.__class__.__name__, self.name, self.descr, self.marks]
+
+    def fingerprint(self) -> str:
+        """
+        Hash identifying the configuration of this test. This changes
+        whenever a change to the test could change its outcome.
+        """
+        return fingerprint(*self.get_fingerprint_data())
+
     def __str__(self) -> str:
         rv = self.name.replace("_", " ")
         if self.descr:
@@ -101,9 +123,13 @@ class BaseTest(magic.MagicBase):
 
         test_output = None
         ctx = self.create_test(wrapped)
-        with ctx.catch():
-            test_output = self.run(wrapped)
-        return self.format_feedback(ctx, test_output)
+        exercise = self.exercise.name if self.exercise is not None else None
+        started = time.perf_counter()
+        with metrics.measure('test', exercise=exercise, test=self.name):
+            with ctx.catch():
+                test_output = self.run(wrapped)
+        runtime = time.perf_counter() - started
+        return self.format_feedback(ctx, test_output)._replace(runtime=runtime)
 
     def create_test(self, other: Union[Callable, Type]) -> ExecutionContext:
         """
@@ -156,7 +182,7 @@ class BaseTest(magic.MagicBase):
 
         :param test_output:
         :param context:
-        :return: TestFeedback named tuple (test, mark, feedback
+        :return: TestFeedback named tuple (test, mark, feedback, passed)
         """
         success = self.get_success(context, test_output)
         outcome = "Pass" if success else "Fail"
@@ -171,7 +197,7 @@ class BaseTest(magic.MagicBase):
             feedback.append(self.format_error(err))
         if warnings:
             feedback.append(self.format_warnings(warnings))
-        return TestFeedback(self.name, marks, "\n".join(feedback))
+        return TestFeedback(self.name, marks, "\n".join(feedback), bool(success))
 
 
 class ExecutionFailedError(Exception):
@@ -236,6 +262,15 @@ class CallTest(BaseTest):
         else:
             return rv
 
+    def get_fingerprint_data(self) -> List[Any]:
+        return super().get_fingerprint_data() + [
+            self.call_args,
+            self.call_kwargs,
+            self.expected,
+            self.expects_error,
+            self.tolerance,
+        ]
+
     def create_test(self, other: Callable) -> ExecutionContext:
         return ExecutionContext()
 
@@ -304,6 +339,8 @@ class TimingTest(BaseTest):
         **kwargs: Any,
     ):
         super().__init__(**kwargs)
+        # Targets measured from the model solution vary from run to run.
+        self.explicit_targets = isinstance(cases, dict)
         if isinstance(cases, dict):
             # cases from dict - preset targets
             cases = [
@@ -334,6 +371,13 @@ class TimingTest(BaseTest):
     def create_test(self, other: Callable):
         return ExecutionContext()
 
+    def get_fingerprint_data(self) -> List[Any]:
+        if self.explicit_targets:
+            cases = self.cases
+        else:
+            cases = [(case.call_args, case.call_kwargs) for case in self.cases]
+        return super().get_fingerprint_data() + [cases, self.tolerance]
+
     def get_target(self, call: Call):
         return time_run(self.exercise.func, call.args, call.kwargs)
 
@@ -387,6 +431,9 @@ class Test(BaseTest):
     def get_name(self) -> str:
         return self.test_func.__name__
 
+    def get_fingerprint_data(self) -> List[Any]:
+        return super().get_fingerprint_data() + [self.test_func]
+
     def create_test(self, other: Callable) -> ExecutionContext:
         ctx = ExecutionContext()
         ctx.add_context(self.exercise.set_function(other))
@@ -424,6 +471,11 @@ class MethodTest(CallTest):
         self.inst_kwargs = inst_kwargs
         super().__init__(call_args, call_kwargs, **kwargs)
 
+    def get_fingerprint_data(self) -> List[Any]:
+        return super().get_fingerprint_data() + [
+            self.method, self.inst_args, self.inst_kwargs
+        ]
+
     def get_expected(self):
         inst = self.exercise.func(* self.inst_args, ** self.inst_kwargs)
         func = getattr(inst, self.method)
@@ -463,6 +515,11 @@ class MethodTimingTest(TimingTest):
         self.inst_kwargs = inst_kwargs
         super().__init__(cases, tolerance, **kwargs)
 
+    def get_fingerprint_data(self) -> List[Any]:
+        return super().get_fingerprint_data() + [
+            self.method, self.inst_args, self.inst_kwargs
+        ]
+
     def get_target(self, call: Call) -> float:
         inst = self.exercise(* self.inst_args, ** self.inst_kwargs)
         func = getattr(inst, self.method)
@@ -491,6 +548,11 @@ class InteractionTest(BaseTest):
         self.success_criteria = []
         super().__init__(**kwargs)
 
+    def get_fingerprint_data(self) -> List[Any]:
+        return super().get_fingerprint_data() + [
+            self.cls, self.inst_call, self.success_criteria
+        ]
+
     def create_proxy_ns(self, ns: typing.Dict[str, typing.Any]):
         """
         Create proxy class namespace for test
@@ -18,10 +18,12 @@
 """Command line interface for MarkingPy."""
 import importlib.util
 import sys
+import tarfile
+import zipfile
 
 
 import statistics
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from functools import partial
 from pathlib import Path
 import traceback
@@ -29,6 +31,10 @@ import traceback
 from .import markscheme as _markscheme
 from .import users
 from .import finders
+from .import grader
+from .import distributed
+from .import watch
+from .import storage
 
 
 
@@ -86,6 +92,265 @@ class TerminalCommands:
         print('Creating new marking scheme')
 
 
+def add_grader_arguments(parser):
+    """
+    Add the options used to configure the grader and grading pipeline.
+    """
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help=(
+            "Grade submissions on a pool of this many worker processes."
+        ),
+    )
+    parser.add_argument(
+        "--fork-server",
+        action="store_true",
+        help=(
+            "Grade each submission in a process forked from a template that"
+            " has already loaded the marking scheme and preload modules."
+        ),
+    )
+    parser.add_argument(
+        "--max-tasks-per-child",
+        type=int,
+        help=(
+            "Number of submissions each worker process grades before it is"
+            " replaced. Only used with --workers."
+        ),
+    )
+    parser.add_argument(
+        "--exercise-processes",
+        type=int,
+        help=(
+            "Run this many exercises of each submission at once, each in a"
+            " process forked after the submission is loaded (UNIX only). Use"
+            " with --workers or --fork-server, so exercises are forked from"
+            " single-threaded worker processes."
+        ),
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=("auto", "longest-first", "finder"),
+        help=(
+            "Order in which submissions are graded. longest-first grades the"
+            " submissions expected to take longest first, based on their"
+            " runtimes in earlier runs."
+        ),
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        default=None,
+        help="Show the progress of the run, the throughput and the ETA.",
+    )
+    parser.add_argument(
+        "--status-file",
+        type=str,
+        help="Path of a JSON file rewritten with the progress of the run.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help=(
+            "Measure the time taken by each stage of grading and each test,"
+            " and write the results to METRICS.json and METRICS.prom."
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            "Grade every submission, ignoring any cached results and"
+            " compiled submissions."
+        ),
+    )
+    parser.add_argument(
+        "--compile-workers",
+        type=int,
+        help="Compile submissions ahead of grading on this many processes.",
+    )
+    parser.add_argument(
+        "--lint-workers",
+        type=int,
+        help="Number of threads used to lint submissions.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Wall-clock time limit in seconds for grading each submission.",
+    )
+    parser.add_argument(
+        "--exercise-timeout",
+        type=float,
+        help="Wall-clock time limit in seconds for each exercise.",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=int,
+        help="Memory limit in megabytes for each submission (UNIX only).",
+    )
+    parser.add_argument(
+        "--cpu-limit",
+        type=int,
+        help="CPU time limit in seconds for each submission (UNIX only).",
+    )
+
+
+def add_finder_arguments(parser, wrappers=True):
+    """
+    Add the options used to find the submissions in the target directory.
+
+    :param wrappers: If false, the options for finders that wrap the
+        directory finder are not added.
+    """
+    parser.add_argument(
+        "--include",
+        action="append",
+        help=(
+            "Glob pattern of the files to load from the target directory."
+            " May be given more than once. Defaults to *.py."
+        ),
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        help=(
+            "Glob pattern of the files and directories to skip. May be given"
+            " more than once."
+        ),
+    )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="Search the subdirectories of the target directory.",
+    )
+    parser.add_argument(
+        "--per-directory",
+        action="store_true",
+        help=(
+            "Load one submission from each directory in the target directory,"
+            " named after the directory."
+        ),
+    )
+    if not wrappers:
+        return
+
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help=(
+            "Only grade the submissions in shard I of N, numbered from 1,"
+            " chosen by a hash of the submission reference."
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        type=str,
+        metavar="MANIFEST",
+        help=(
+            "Only grade the submissions added or changed since they were last"
+            " graded, as recorded in the manifest file MANIFEST."
+        ),
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Read up to this many submissions ahead on background threads.",
+    )
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as I/N into the index of the shard, counted from 0,
+    and the number of shards.
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f"invalid shard {value!r}, expected I/N") from None
+
+    if not 1 <= index <= count:
+        raise ArgumentTypeError(f"shard {index} is not in the range 1 to {count}")
+
+    return index - 1, count
+
+
+def create_finder(target, args, default=None):
+    """
+    Create the finder for the target directory from the options added by
+    :func:`add_finder_arguments`. The options are removed from *args*.
+
+    :param target: Target directory, zip file or tar file, or None.
+    :param default: Finder used if no target directory was given.
+    :return: Finder, which may be None if there is no target or default.
+    """
+    include = args.pop('include') or ("*.py",)
+    exclude = args.pop('exclude') or ()
+    recursive = args.pop('recursive')
+    per_directory = args.pop('per_directory')
+    shard = args.pop('shard', None)
+    incremental = args.pop('incremental', None)
+    prefetch = args.pop('prefetch', None)
+    finder = default
+    if target is not None and zipfile.is_zipfile(target):
+        finder = finders.ZipFinder(
+            target, include=include, exclude=exclude, per_directory=per_directory
+        )
+    elif target is not None and Path(target).is_file() and tarfile.is_tarfile(target):
+        finder = finders.TarFinder(
+            target, include=include, exclude=exclude, per_directory=per_directory
+        )
+    elif target is not None:
+        finder = finders.DirectoryFinder(
+            target,
+            include=include,
+            exclude=exclude,
+            recursive=recursive,
+            per_directory=per_directory,
+        )
+    # Sharding is applied first, so the other wrappers only see the
+    # submissions in this shard.
+    if shard and finder is not None:
+        finder = finders.ShardFinder(finder, *shard)
+    if incremental and finder is not None:
+        finder = finders.IncrementalFinder(finder, incremental)
+    if prefetch and finder is not None:
+        finder = finders.PrefetchingFinder(finder, ahead=prefetch)
+    return finder
+
+
+def configure_grader(markscheme, args):
+    """
+    Configure the grader and grading pipeline of the marking scheme from
+    the options added by :func:`add_grader_arguments`. The options are
+    removed from *args*.
+    """
+    if args.pop('no_cache'):
+        markscheme.cache = None
+        markscheme.code_cache = None
+    lint_workers = args.pop('lint_workers')
+    if lint_workers is not None:
+        markscheme.stage_workers['lint'] = lint_workers
+    workers = args.pop('workers')
+    max_tasks = args.pop('max_tasks_per_child')
+    limits = {
+        'timeout': args.pop('timeout'),
+        'exercise_timeout': args.pop('exercise_timeout'),
+        'cpu_limit': args.pop('cpu_limit'),
+        'memory_limit': args.pop('memory_limit'),
+    }
+    if limits['memory_limit'] is not None:
+        limits['memory_limit'] *= 2 ** 20
+    if args.pop('fork_server'):
+        markscheme.grader = grader.ForkServerGrader(workers, max_tasks, **limits)
+    elif workers is not None:
+        markscheme.grader = grader.PoolGrader(workers, max_tasks, **limits)
+    elif any(v is not None for v in limits.values()):
+        markscheme.grader = grader.ProcessGrader(**limits)
+
+
 def handle_marking_scheme(path, args, root_parser):
     # noinspection PyBroadException
     try:
@@ -128,14 +393,160 @@ def handle_marking_scheme(path, args, root_parser):
             " This option is only used for validation."
         ),
     )
+    add_grader_arguments(run_parser)
+    add_finder_arguments(run_parser)
+    run_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Skip the submissions already graded with this marking scheme,"
+            " continuing an interrupted run. Needs a SQLite marks database."
+        ),
+    )
     run_parser.add_argument(
         "target",
         type=str,
         default=None,
-        required=False,
-        help=("Target directory for checking."),
+        nargs="?",
+        help=("Target directory, zip file or tar file for checking."),
     )
     run_parser.set_defaults(func=partial(run_ms, markscheme))
+    serve_parser = sub_parsers.add_parser(
+        'serve-work',
+        help=(
+            "Hand out the submissions to markingpy workers, which may run on "
+            "other hosts, and store the results they send back. Workers are "
+            "authenticated with the key in the MARKINGPY_AUTHKEY environment "
+            "variable. If it is not set, a key is generated and printed, "
+            "unless listening on a Unix socket, which only its owner can use."
+        ),
+    )
+    serve_parser.add_argument(
+        "--address",
+        default="localhost:8765",
+        help="host:port or path of a Unix socket to listen on.",
+    )
+    serve_parser.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        default=5.0,
+        help="Interval in seconds at which workers send heartbeats.",
+    )
+    serve_parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        help=(
+            "Time in seconds without a heartbeat after which the submissions"
+            " held by a worker are handed out again."
+        ),
+    )
+    serve_parser.add_argument(
+        "--submission-path", type=str, help="Path to submissions."
+    )
+    add_finder_arguments(serve_parser)
+    serve_parser.add_argument(
+        "--marks-db",
+        type=str,
+        help="Path to database to store submission results and feedback.",
+    )
+    serve_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Skip the submissions already graded with this marking scheme,"
+            " continuing an interrupted run. Needs a SQLite marks database."
+        ),
+    )
+    serve_parser.add_argument(
+        "target",
+        type=str,
+        default=None,
+        nargs="?",
+        help=("Target directory, zip file or tar file for checking."),
+    )
+    serve_parser.set_defaults(func=partial(serve_work, markscheme))
+    watch_parser = sub_parsers.add_parser(
+        'watch',
+        help=(
+            "Grade the submissions in the target directory as they are added"
+            " or changed, writing the results to the marks database, until"
+            " interrupted."
+        ),
+    )
+    watch_parser.add_argument(
+        "--marks-db",
+        type=str,
+        help="Path to database to store submission results and feedback.",
+    )
+    add_grader_arguments(watch_parser)
+    add_finder_arguments(watch_parser, wrappers=False)
+    watch_parser.add_argument(
+        "--debounce",
+        type=float,
+        default=2.0,
+        help="Time in seconds a file must be unchanged before it is graded.",
+    )
+    watch_parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="Time in seconds between scans of the directory when polling.",
+    )
+    watch_parser.add_argument(
+        "--polling",
+        action="store_true",
+        help="Poll the directory for changes instead of using inotify.",
+    )
+    watch_parser.add_argument(
+        "--new-only",
+        action="store_true",
+        help=(
+            "Only grade submissions once they are added or changed, not the"
+            " submissions already in the directory."
+        ),
+    )
+    watch_parser.add_argument(
+        "target",
+        type=str,
+        default=None,
+        nargs="?",
+        help=("Target directory to watch."),
+    )
+    watch_parser.set_defaults(func=partial(watch_submissions, markscheme))
+    worker_parser = sub_parsers.add_parser(
+        'worker',
+        help=(
+            "Grade submissions handed out by a markingpy serve-work"
+            " coordinator using this marking scheme."
+        ),
+    )
+    worker_parser.add_argument(
+        "address", help="host:port or path of the Unix socket of the coordinator."
+    )
+    add_grader_arguments(worker_parser)
+    worker_parser.set_defaults(func=partial(work, markscheme))
+    merge_parser = sub_parsers.add_parser(
+        'merge',
+        help=(
+            "Merge the marks databases of separate runs, such as the shards"
+            " of a cohort, into the marks database of this marking scheme,"
+            " reporting submissions with conflicting records."
+        ),
+    )
+    merge_parser.add_argument(
+        "--output",
+        type=str,
+        help="Path of the SQLite database to merge into.",
+    )
+    merge_parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Replace conflicting records with those in later databases.",
+    )
+    merge_parser.add_argument(
+        "databases", nargs="+", help="SQLite marks databases to merge."
+    )
+    merge_parser.set_defaults(func=partial(merge, markscheme))
     summary_parser = sub_parsers.add_parser(
         'summary',
         help=(
@@ -212,12 +623,81 @@ def handle_marking_scheme(path, args, root_parser):
 
 
 def run_ms(markscheme, args):
-    target = args.pop('target')
-    if target is not None:
-        markscheme.finder = finders.DirectoryFinder(target)
-    markscheme.update_config(vars(args))
+    args = vars(args)
+    markscheme.finder = create_finder(args.pop('target'), args, markscheme.finder)
+    resume = args.pop('resume')
+    configure_grader(markscheme, args)
+    markscheme.update_config(args)
+    markscheme.validate()
+    markscheme.run(resume=resume)
+
+
+def serve_work(markscheme, args):
+    args = vars(args)
+    markscheme.finder = create_finder(args.pop('target'), args, markscheme.finder)
+    coordinator = distributed.Coordinator(
+        markscheme,
+        args.pop('address'),
+        heartbeat_interval=args.pop('heartbeat_interval'),
+        lease_timeout=args.pop('lease_timeout'),
+    )
+    resume = args.pop('resume')
+    markscheme.update_config(args)
+    print(f'Serving work on {coordinator.address}')
+    if coordinator.generated_authkey:
+        print(
+            f'Start workers with {distributed.AUTHKEY_ENV}='
+            f'{coordinator.authkey.decode()} in their environment'
+        )
+    coordinator.serve(resume)
+
+
+def watch_submissions(markscheme, args):
+    args = vars(args)
+    finder = create_finder(args.pop('target'), args, markscheme.finder)
+    if not isinstance(finder, finders.DirectoryFinder):
+        sys.exit('markingpy watch: the submissions must be in a directory')
+
+    watcher = watch.SubmissionWatcher(
+        markscheme,
+        finder,
+        debounce=args.pop('debounce'),
+        poll_interval=args.pop('poll_interval'),
+        use_inotify=not args.pop('polling'),
+    )
+    new_only = args.pop('new_only')
+    configure_grader(markscheme, args)
+    markscheme.update_config(args)
     markscheme.validate()
-    markscheme.run()
+    print(f'Watching {finder.path} for submissions')
+    watcher.run(grade_existing=not new_only)
+
+
+def work(markscheme, args):
+    args = vars(args)
+    address = args.pop('address')
+    configure_grader(markscheme, args)
+    markscheme.update_config(args)
+    markscheme.validate()
+    distributed.Worker(markscheme, address).run()
+
+
+def merge(markscheme, args):
+    args = vars(args)
+    output = args.pop('output')
+    db = storage.SQLiteDB(Path(output).expanduser()) if output else markscheme.db
+    if not isinstance(db, storage.SQLiteDB):
+        sys.exit('markingpy merge: the marks database is not a SQLite database')
+
+    conflicts = {}
+    for path in args['databases']:
+        for ref in db.merge(path, overwrite=args['overwrite']):
+            conflicts.setdefault(ref, []).append(path)
+    print(f"Merged {len(args['databases'])} databases into {db.path}")
+    for ref, paths in sorted(conflicts.items()):
+        print(f"Conflicting records for {ref} in {', '.join(paths)}")
+    if conflicts and not args['overwrite']:
+        sys.exit(1)
 
 
 def summary(markscheme, args):
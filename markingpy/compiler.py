@@ -18,23 +18,159 @@
 Helper module to compile files that might contain syntax errors.
 """
 # Based on the Python Standard Library code module.
+import tokenize
+from bisect import bisect_left, bisect_right
 from codeop import PyCF_DONT_IMPLY_DEDENT
 from collections import namedtuple, deque
+from itertools import islice
 
-from typing import Type, Tuple, Any
+from typing import Type, Tuple, Any, List, Callable, Optional
 
 __all__ = ['Chunk', 'RemovedChunk', 'Compiler', 'Reason']
 # Chunk = namedtuple('Chunk', ('line_start', 'line_end', 'content'))
 Reason = namedtuple("Reason", ("removed_at", "exc"))
+# Keywords that continue the compound statement on the preceding lines.
+CONTINUATION_KEYWORDS = frozenset(("else", "elif", "except", "finally"))
+_SKIPPED_TOKENS = frozenset(
+    (
+        tokenize.NL,
+        tokenize.NEWLINE,
+        tokenize.COMMENT,
+        tokenize.INDENT,
+        tokenize.DEDENT,
+        tokenize.ENCODING,
+        tokenize.ENDMARKER,
+    )
+)
+
+
+def _indented_starts(lines: List[str]) -> List[int]:
+    """
+    Find the lines that appear to start top-level statements using only
+    their indentation.
+    """
+    starts = []
+    decorated = continued = False
+    for row, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+
+        if not line[0].isspace() and not continued and not decorated:
+            keyword = stripped.split(None, 1)[0].rstrip(":")
+            if keyword not in CONTINUATION_KEYWORDS and stripped[0] not in ")]}":
+                starts.append(row)
+        decorated = stripped.startswith("@")
+        continued = stripped.endswith("\\")
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return starts
+
+
+def _block_end(
+    lines: List[str], starts: List[int], index: int
+) -> Optional[int]:
+    """
+    Find the index in *starts* of the block that follows the block
+    starting at ``starts[index]`` by tokenizing the source from the start
+    of the block.
+
+    Starts that lie inside a multi-line string or brackets of the block
+    are skipped. If the block contains an unclosed string or bracket,
+    tokenizing reaches the end of the source and None is returned.
+    """
+    end = index + 1
+    readline = (line + "\n" for line in islice(lines, starts[index], None)).__next__
+    new_statement = False
+    try:
+        for tok in tokenize.generate_tokens(readline):
+            if end == len(starts):
+                break
+
+            if tok.type == tokenize.NEWLINE:
+                new_statement = True
+            elif new_statement and tok.type not in _SKIPPED_TOKENS:
+                new_statement = False
+                row = starts[index] + tok.start[0] - 1
+                if row >= starts[end]:
+                    end = bisect_left(starts, row, end)
+                    if end < len(starts) and starts[end] == row:
+                        return end
+    except tokenize.TokenError:
+        return None
+
+    except SyntaxError:
+        return index + 1
+
+    return len(starts)
+
+
+def split_blocks(
+    lines: List[str], compiles: Optional[Callable[[int, int], bool]] = None
+) -> List[Tuple[int, int]]:
+    """
+    Split source code into blocks of top-level statements.
+
+    Each block contains a single top-level statement, including any
+    decorators and continuation clauses such as ``else`` and ``except``,
+    followed by any blank lines and comments. The statements are found
+    by the indentation of the lines, and lines that only appear to start
+    statements because they are inside a multi-line string or brackets
+    are skipped by tokenizing the source from the start of each block.
+    A block that compiles cannot end inside a string or brackets, so if
+    *compiles* is given, only the blocks it rejects are tokenized. Once a
+    block contains a string or bracket that is never closed, tokenizing
+    it reads the rest of the source, so that block and all of the blocks
+    after it are found by indentation alone.
+
+    :param lines: Lines of the source code.
+    :param compiles: Function called with the (start, end) range of each
+        block found by indentation, that returns whether it compiles.
+    :return: List of (start, end) ranges of line indices covering all
+        of the lines.
+    """
+    starts = _indented_starts(lines)
+    blocks = []
+    index = 0
+    tokenizable = True
+    while index < len(starts):
+        end = index + 1
+        stop = starts[end] if end < len(starts) else len(lines)
+        if tokenizable and (compiles is None or not compiles(starts[index], stop)):
+            end = _block_end(lines, starts, index)
+            if end is None:
+                tokenizable = False
+                end = index + 1
+            stop = starts[end] if end < len(starts) else len(lines)
+        blocks.append((starts[index], stop))
+        index = end
+    return blocks
 
 
 class Chunk:
-    __slots__ = ["line_start", "line_end", "content"]
+    """
+    Range of lines of source code.
 
-    def __init__(self, line_start: int, line_end: int, content: str):
+    The lines are shared by all of the chunks of a source, and the
+    content of a chunk is only joined when it is needed.
+
+    :param lines: Lines of the source code.
+    :param line_start: Index of the first line of the chunk.
+    :param line_end: Index of the last line of the chunk.
+    """
+    __slots__ = ["lines", "line_start", "line_end"]
+
+    def __init__(self, lines: List[str], line_start: int, line_end: int):
+        self.lines = lines
         self.line_start = line_start
         self.line_end = line_end
-        self.content = content
+
+    @property
+    def content(self) -> str:
+        return "\n".join(self.lines[self.line_start:self.line_end + 1])
+
+    def __len__(self) -> int:
+        return max(0, self.line_end - self.line_start + 1)
 
     def __iter__(self):
         yield from (self.line_start, self.line_end, self.content)
@@ -44,17 +180,19 @@ class Chunk:
             self.__class__.__name__ +
             "(" +
             repr(self.line_start) +
+            ", " +
             repr(self.line_end) +
+            ", " +
             repr(self.content) +
             ")"
         )
 
 
 class RemovedChunk(Chunk):
-    __slots__ = ["line_start", "line_end", "content", "reasons"]
+    __slots__ = ["reasons"]
 
-    def __init__(self, line_start: int, line_end: int, content: str):
-        super().__init__(line_start, line_end, content)
+    def __init__(self, lines: List[str], line_start: int, line_end: int):
+        super().__init__(lines, line_start, line_end)
         self.reasons = []
 
     def is_adjacent(self, other: Type[Chunk]) -> bool:
@@ -70,17 +208,11 @@ class RemovedChunk(Chunk):
                 self.reasons.append(r)
 
     def join(self, other: 'RemovedChunk') -> 'RemovedChunk':
-        if self.line_start > other.line_end:
-            # other first
-            content = "\n".join([other.content, self.content])
-            start = other.line_start
-            end = self.line_end
-        else:
-            # this first
-            content = "\n".join([self.content, other.content])
-            start = self.line_start
-            end = other.line_end
-        new_removed = RemovedChunk(start, end, content)
+        new_removed = RemovedChunk(
+            self.lines,
+            min(self.line_start, other.line_start),
+            max(self.line_end, other.line_end),
+        )
         new_removed.add_reason(* self.reasons, * other.reasons)
         return new_removed
 
@@ -107,7 +239,11 @@ class Compiler:
         """
         self.filename = filename
         self.mode = mode
+        self.lines = []
+        # Removed chunks are kept sorted by their first line, which is also
+        # kept in removed_starts to find adjacent chunks by bisection.
         self.removed_chunks = []
+        self.removed_starts = []
         self.chunks = []
         self.removed = 0
         self.to_process = deque()
@@ -126,31 +262,89 @@ class Compiler:
             source, filename, mode, flags, dont_inherit, optimize
         )
 
+    def joins(self, first: RemovedChunk, second: RemovedChunk) -> bool:
+        """
+        Test whether a removed chunk is adjacent to a later removed chunk,
+        or separated from it only by blank lines.
+        """
+        return first.is_adjacent(second) or not any(
+            line.strip()
+            for line in islice(self.lines, first.line_end + 1, second.line_start)
+        )
+
+    def add_removed(self, removed_chunk: RemovedChunk):
+        """
+        Add a removed chunk, joining it with any removed chunks that are
+        adjacent to it or separated from it only by blank lines.
+        """
+        pos = bisect_left(self.removed_starts, removed_chunk.line_start)
+        first, last = pos, pos
+        if pos > 0 and self.joins(self.removed_chunks[pos - 1], removed_chunk):
+            first -= 1
+        if (
+            pos < len(self.removed_chunks) and
+            self.joins(removed_chunk, self.removed_chunks[pos])
+        ):
+            last += 1
+        for c in self.removed_chunks[first:last]:
+            removed_chunk = c.join(removed_chunk)
+        self.removed_chunks[first:last] = [removed_chunk]
+        self.removed_starts[first:last] = [removed_chunk.line_start]
+
+    def is_removed(self, index: int) -> bool:
+        """
+        Test whether a line is in a removed chunk.
+        """
+        pos = bisect_right(self.removed_starts, index) - 1
+        return pos >= 0 and self.removed_chunks[pos].line_end >= index
+
     def remove_line(
         self, chunk: Chunk, lineno: int, reason: Exception
     ) -> Tuple[Chunk, Chunk]:
         """
-        Remove a line from the source.
+        Remove the line containing an error from a block of the source,
+        together with the rest of the statements in the block.
+
+        The lines after the error in a block belong to the same top-level
+        statement, and cannot compile without the lines before them, so
+        they are removed at once rather than one line per compilation.
+        Any blank lines and comments at the end of the block are kept.
         """
-        lines = chunk.content.splitlines()
-        reason.lineno = chunk.line_start + lineno - 1
+        last = chunk.line_end
+        while last > chunk.line_start and (
+            not chunk.lines[last].strip() or
+            chunk.lines[last].lstrip().startswith("#")
+        ):
+            last -= 1
+        index = min(chunk.line_start + max(lineno or 1, 1) - 1, last)
+        reason.lineno = index + 1
         self.removed += 1
-        removed_chunk = RemovedChunk(reason.lineno, reason.lineno, lines[lineno - 1])
+        removed_chunk = RemovedChunk(chunk.lines, index, last)
         removed_chunk.add_reason(Reason(self.removed, reason))
-        adjacent = [c for c in self.removed_chunks if c.is_adjacent(removed_chunk)]
-        if not adjacent:
-            self.removed_chunks.append(removed_chunk)
-        else:
-            for c in adjacent:
-                removed_chunk = c.join(removed_chunk)
-                self.removed_chunks.remove(c)
-            self.removed_chunks.append(removed_chunk)
-        # print('Removing line', reason.lineno, lines[lineno-1])
+        self.add_removed(removed_chunk)
         return (
-            Chunk(chunk.line_start, lineno - 2, "\n".join(lines[: lineno - 1])),
-            Chunk(reason.lineno, chunk.line_end, "\n".join(lines[lineno:])),
+            Chunk(chunk.lines, chunk.line_start, index - 1),
+            Chunk(chunk.lines, last + 1, chunk.line_end),
         )
 
+    def compiles(self, chunk: Chunk) -> bool:
+        """
+        Test whether a chunk compiles on its own.
+        """
+        try:
+            # noinspection PyArgumentList
+            compile(
+                chunk.content,
+                self.filename,
+                self.mode,
+                PyCF_DONT_IMPLY_DEDENT,
+                optimize=0,
+            )
+        except SyntaxError:
+            return False
+
+        return True
+
     def try_compile(self, chunk: Chunk):
         """
         Try compiling a chunk.
@@ -174,10 +368,10 @@ class Compiler:
         """
         lineno = err.lineno
         before, after = self.remove_line(chunk, lineno, err)
-        if before.content:
+        if before:
             self.to_process.append(before)
-        if after.content:
-            self.to_process.append(after)
+        if after:
+            self.chunks.append(after)
 
     def compile_source(
         self,
@@ -196,14 +390,49 @@ class Compiler:
         syntax errors will not be compiled, and those names
         will not be contained in the locals.
 
+        The source is split into blocks of top-level statements, which
+        are compiled independently. A block that fails to compile is cut
+        at the error: the rest of the block is removed and only the lines
+        before the error are compiled again.
+
         Arguments:
             Source - string containing source to be compiled.
         """
-        self.to_process.append(Chunk(0, len(source.splitlines()), source))
+        self.lines = lines = source.splitlines()
+        try:
+            # noinspection PyArgumentList
+            compile(source, self.filename, self.mode, PyCF_DONT_IMPLY_DEDENT)
+        except SyntaxError:
+            compiled = set()
+
+            def compiles(start, end):
+                if not self.compiles(Chunk(lines, start, end - 1)):
+                    return False
+
+                compiled.add(start)
+                return True
+
+            for start, end in split_blocks(lines, compiles):
+                if start in compiled:
+                    self.chunks.append(Chunk(lines, start, end - 1))
+                else:
+                    self.to_process.append(Chunk(lines, start, end - 1))
+        else:
+            self.chunks.append(Chunk(lines, 0, len(lines) - 1))
+            # noinspection PyArgumentList
+            return (
+                source,
+                compile(source, filename, mode, flags, dont_inherit, optimize),
+            )
+
         while self.to_process:
             self.try_compile(self.to_process.popleft())
+        # Blank lines between removed chunks are removed with them.
+        self.chunks = [c for c in self.chunks if not self.is_removed(c.line_start)]
         self.sort_chunks()
-        new_source = "\n".join(c.content for c in self.chunks)
+        new_source = "\n".join(
+            line for c in self.chunks for line in lines[c.line_start:c.line_end + 1]
+        )
         # noinspection PyArgumentList
         return (
             new_source,
@@ -0,0 +1,509 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Distributed grading over several hosts.
+
+A :class:`Coordinator` loads the submissions with the marking scheme finder
+and hands them out to :class:`Worker` processes, which may run on other
+hosts. Each worker grades the submissions it receives with its own copy of
+the marking scheme and sends the records back to the coordinator, which
+writes them to the marks database.
+
+Workers send a heartbeat for the submissions they hold at regular
+intervals. If a worker disconnects, or its heartbeats stop, its
+submissions are handed out to another worker.
+
+Messages are pickled, so workers are authenticated with a key whenever
+the coordinator listens on a TCP port, which any user of the host can
+connect to. The only exception is a Unix socket, which is created so that
+only its owner can connect to it.
+"""
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, address_type
+from typing import Optional, Tuple, Union
+
+from .import finders
+from .import storage
+from .import submission
+from .grader import Record
+
+logger = logging.getLogger(__name__)
+__all__ = ['Coordinator', 'Worker', 'parse_address']
+AUTHKEY_ENV = 'MARKINGPY_AUTHKEY'
+ADDRESS = Union[str, Tuple[str, int]]
+_POLL_INTERVAL = 0.5
+
+
+def parse_address(address: str) -> ADDRESS:
+    """
+    Parse an address given as ``host:port`` or the path of a Unix socket.
+
+    :return: (host, port) tuple or path.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host or 'localhost', int(port)
+
+    return address
+
+
+def _is_unix_socket(address: ADDRESS) -> bool:
+    """
+    Whether the address is the path of a Unix socket, rather than a TCP
+    address, a Windows named pipe or a Linux abstract socket, which have
+    no file permissions.
+    """
+    return address_type(address) == 'AF_UNIX' and not address.startswith('\0')
+
+
+def _get_authkey(authkey: Union[str, bytes, None]) -> Optional[bytes]:
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    return authkey
+
+
+class _Lease:
+    """
+    A submission handed out to a worker.
+    """
+
+    def __init__(self, reference, source, worker, expires):
+        self.reference = reference
+        self.source = source
+        self.worker = worker
+        self.expires = expires
+
+
+class Coordinator:
+    """
+    Hand out submissions to remote workers and store the records they send
+    back.
+
+    :param markscheme: Marking scheme used to find the submissions. Records
+        are written to the marking scheme database.
+    :param address: ``host:port`` or path of a Unix socket to listen on.
+    :param authkey: Key used to authenticate workers. Defaults to the
+        value of the ``MARKINGPY_AUTHKEY`` environment variable. If neither
+        is set, a random key is generated, unless listening on a Unix
+        socket, which is then only accessible to its owner. A generated key
+        is available as :attr:`authkey`, and :attr:`generated_authkey` is
+        true.
+    :param heartbeat_interval: Interval in seconds at which workers send
+        heartbeats.
+    :param lease_timeout: Time in seconds without a heartbeat after which
+        the submissions held by a worker are handed out again. Defaults to
+        three heartbeat intervals.
+    :param max_attempts: Number of times a submission is handed out before
+        it is recorded as failed.
+    """
+
+    def __init__(
+        self,
+        markscheme,
+        address: Union[str, ADDRESS] = 'localhost:0',
+        authkey: Union[str, bytes, None] = None,
+        heartbeat_interval: float = 5.0,
+        lease_timeout: Optional[float] = None,
+        max_attempts: int = 3,
+    ):
+        self.markscheme = markscheme
+        if isinstance(address, str):
+            address = parse_address(address)
+        self.authkey = _get_authkey(authkey)
+        unix_socket = _is_unix_socket(address)
+        self.generated_authkey = self.authkey is None and not unix_socket
+        if self.generated_authkey:
+            self.authkey = secrets.token_hex(16).encode()
+        self.heartbeat_interval = heartbeat_interval
+        if lease_timeout is None:
+            lease_timeout = 3 * heartbeat_interval
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        if unix_socket:
+            # The socket is created with mode 0600, so that it is never
+            # accessible to other users.
+            umask = os.umask(0o177)
+            try:
+                self.listener = Listener(address, authkey=self.authkey)
+            finally:
+                os.umask(umask)
+        else:
+            self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+        self.scheme_fingerprint = markscheme.fingerprint()
+        self.lock = threading.Condition()
+        self.submissions = None
+        self.pending = deque()
+        self.leases = {}
+        self.attempts = {}
+        self.done = set()
+        self.exhausted = False
+        self.worker_count = 0
+        self.closed = False
+
+    @property
+    def finished(self) -> bool:
+        return self.exhausted and not self.pending and not self.leases
+
+    def next_submission(self):
+        """
+        Get the next submission to hand out, loading it with the marking
+        scheme finder if none are waiting to be handed out again.
+
+        :return: (reference, source) or None.
+        """
+        if self.pending:
+            return self.pending.popleft()
+
+        while not self.exhausted:
+            try:
+                sub = next(self.submissions)
+            except StopIteration:
+                self.exhausted = True
+                self.lock.notify_all()
+                break
+
+            if sub.reference not in self.done and sub.reference not in self.leases:
+                return sub.reference, sub.raw_source
+
+        return None
+
+    def get_work(self, worker: int):
+        """
+        Reply to a request for work from a worker.
+        """
+        with self.lock:
+            item = self.next_submission()
+            if item is not None:
+                ref, source = item
+                self.attempts[ref] = self.attempts.get(ref, 0) + 1
+                expires = time.monotonic() + self.lease_timeout
+                self.leases[ref] = _Lease(ref, source, worker, expires)
+                logger.debug(f'Handing out {ref} to worker {worker}')
+                return 'work', ref, source
+
+            if self.finished:
+                return ('stop',)
+
+            return 'wait', min(self.heartbeat_interval, _POLL_INTERVAL)
+
+    def heartbeat(self, worker: int, references):
+        with self.lock:
+            expires = time.monotonic() + self.lease_timeout
+            for ref in references:
+                lease = self.leases.get(ref)
+                if lease is not None and lease.worker == worker:
+                    lease.expires = expires
+
+    def add_record(self, record: Record):
+        """
+        Store a record sent by a worker. Records for submissions that have
+        already been stored are ignored.
+        """
+        with self.lock:
+            if record.id in self.done:
+                return
+
+            self.markscheme.db.add_record(record)
+            if self.markscheme.finder is not None:
+                self.markscheme.finder.mark_stored(record.id)
+            self.done.add(record.id)
+            self.leases.pop(record.id, None)
+            self.lock.notify_all()
+
+    def add_results(self, reference: str, results):
+        """
+        Store the results sent by a worker, unless the record of the
+        submission has already been stored.
+        """
+        with self.lock:
+            if reference not in self.done:
+                self.markscheme.db.add_results(reference, results)
+
+    def release(self, lease: _Lease, reason: str):
+        """
+        Hand out the submission of a lost lease again, or record it as
+        failed if it has been handed out too many times. Must be called
+        with the lock held.
+        """
+        del self.leases[lease.reference]
+        ref = lease.reference
+        if self.attempts[ref] >= self.max_attempts:
+            logger.error(f'Grading {ref} failed: {reason}')
+            msg = f'Grading failed after {self.attempts[ref]} attempts: {reason}'
+            self.markscheme.db.add_record(Record(ref, 0, msg))
+            self.done.add(ref)
+            self.lock.notify_all()
+        else:
+            logger.warning(f'{ref}: {reason}, handing out again')
+            self.pending.append((ref, lease.source))
+            self.lock.notify_all()
+
+    def release_worker(self, worker: int, reason: str):
+        with self.lock:
+            for lease in list(self.leases.values()):
+                if lease.worker == worker:
+                    self.release(lease, reason)
+
+    def expire_leases(self):
+        with self.lock:
+            now = time.monotonic()
+            for lease in list(self.leases.values()):
+                if now >= lease.expires:
+                    self.release(lease, f'Worker {lease.worker} stopped responding')
+
+    def handle(self, conn, worker: int):
+        """
+        Handle the messages from a worker until it disconnects.
+        """
+        try:
+            kind, name, scheme_fingerprint = conn.recv()
+            if kind != 'hello':
+                return
+
+            if scheme_fingerprint != self.scheme_fingerprint:
+                logger.error(f'Worker {name} is using a different marking scheme')
+                conn.send(('reject', 'Marking scheme does not match coordinator'))
+                return
+
+            logger.info(f'Worker {worker} connected: {name}')
+            conn.send(('welcome', worker, self.heartbeat_interval))
+            while True:
+                kind, *data = conn.recv()
+                if kind == 'request':
+                    conn.send(self.get_work(worker))
+                elif kind == 'heartbeat':
+                    self.heartbeat(worker, data[0])
+                elif kind == 'record':
+                    self.add_record(Record(*data[0]))
+                elif kind == 'results':
+                    self.add_results(*data)
+                elif kind == 'runtime':
+                    with self.lock:
+                        self.markscheme.db.add_runtime(*data)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            self.release_worker(worker, f'Worker {worker} disconnected')
+
+    def accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, AuthenticationError) as err:
+                if self.closed:
+                    break
+
+                logger.warning(f'Failed to accept worker connection: {err}')
+                continue
+
+            with self.lock:
+                self.worker_count += 1
+                worker = self.worker_count
+            threading.Thread(
+                target=self.handle, args=(conn, worker), daemon=True
+            ).start()
+
+    def serve(self, resume: bool = False):
+        """
+        Hand out the submissions until every submission has been graded.
+
+        :param resume: If true, submissions whose record has already been
+            stored with this marking scheme are skipped.
+        """
+        run_id, submissions = self.markscheme.start_run(resume, parallel=True)
+        self.submissions = iter(submissions)
+        logger.info(f'Coordinator listening on {self.address}')
+        threading.Thread(target=self.accept, daemon=True).start()
+        try:
+            while True:
+                with self.lock:
+                    if not (self.pending or self.leases or self.exhausted):
+                        # Check for more submissions, so the coordinator
+                        # stops once the last one has been graded.
+                        item = self.next_submission()
+                        if item is not None:
+                            self.pending.append(item)
+                    if self.finished:
+                        break
+
+                    self.lock.wait(self.heartbeat_interval)
+                self.expire_leases()
+        finally:
+            self.closed = True
+            self.listener.close()
+        self.markscheme.finish_run(run_id)
+        logger.info(f'Coordinator finished: {len(self.done)} submissions graded')
+
+
+class _RemoteConnection:
+    """
+    Connection from a worker to the coordinator.
+
+    Messages are sent from several threads of the grading pipeline, so
+    sending is guarded by a lock. Replies are only received by the thread
+    that requests work.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.held = set()
+
+    def send(self, msg):
+        with self.lock:
+            self.conn.send(msg)
+
+    def request(self, msg):
+        with self.lock:
+            self.conn.send(msg)
+            return self.conn.recv()
+
+
+class RemoteFinder(finders.BaseFinder):
+    """
+    Finder that requests submissions from a :class:`Coordinator`.
+    """
+
+    def __init__(self, remote: _RemoteConnection):
+        self.remote = remote
+
+    def get_submissions(self, **kwargs):
+        while True:
+            try:
+                kind, *data = self.remote.request(('request',))
+            except (EOFError, OSError):
+                return
+
+            if kind == 'stop':
+                return
+
+            if kind == 'wait':
+                time.sleep(data[0])
+                continue
+
+            ref, source = data
+            self.remote.held.add(ref)
+            yield submission.Submission(ref, source)
+
+
+class RemoteStorage(storage.StorageABC):
+    """
+    Storage that sends records back to a :class:`Coordinator`.
+    """
+
+    def __init__(self, remote: _RemoteConnection):
+        self.remote = remote
+
+    def add_record(self, record):
+        self.remote.send(('record', tuple(record)))
+        self.remote.held.discard(record.id)
+
+    def add_runtime(self, record_id, runtime, size):
+        self.remote.send(('runtime', record_id, runtime, size))
+
+    def add_results(self, record_id, results):
+        self.remote.send(('results', record_id, results))
+
+    def get_record(self, record_id):
+        raise NotImplementedError('Records are stored by the coordinator')
+
+    def get_all(self):
+        raise NotImplementedError('Records are stored by the coordinator')
+
+
+class Worker:
+    """
+    Grade submissions handed out by a :class:`Coordinator`.
+
+    The worker grades submissions with the grading pipeline of the marking
+    scheme, using its grader, linter and result cache, but takes the
+    submissions from the coordinator and sends the records back to it
+    rather than using the marking scheme finder and database. The marking
+    scheme must be the same as the one used by the coordinator.
+
+    :param markscheme: Marking scheme used to grade the submissions.
+    :param address: ``host:port`` or path of the Unix socket of the
+        coordinator.
+    :param authkey: Key used to authenticate with the coordinator.
+        Defaults to the value of the ``MARKINGPY_AUTHKEY`` environment
+        variable.
+    :param name: Name identifying this worker in the coordinator logs.
+        Defaults to the host name and process id.
+    """
+
+    def __init__(
+        self,
+        markscheme,
+        address: Union[str, ADDRESS],
+        authkey: Union[str, bytes, None] = None,
+        name: Optional[str] = None,
+    ):
+        self.markscheme = markscheme
+        if isinstance(address, str):
+            address = parse_address(address)
+        self.address = address
+        self.authkey = _get_authkey(authkey)
+        self.name = name if name else f'{socket.gethostname()}:{os.getpid()}'
+
+    def send_heartbeats(self, remote: _RemoteConnection, interval: float, stop):
+        while not stop.wait(interval):
+            try:
+                remote.send(('heartbeat', list(remote.held)))
+            except (EOFError, OSError):
+                break
+
+    def run(self):
+        """
+        Grade submissions until the coordinator has none left.
+        """
+        conn = Client(self.address, authkey=self.authkey)
+        remote = _RemoteConnection(conn)
+        stop = threading.Event()
+        try:
+            reply = remote.request(('hello', self.name, self.markscheme.fingerprint()))
+            if reply[0] == 'reject':
+                raise RuntimeError(f'Coordinator rejected worker: {reply[1]}')
+
+            _, worker, interval = reply
+            logger.info(f'Connected to coordinator as worker {worker}')
+            threading.Thread(
+                target=self.send_heartbeats, args=(remote, interval, stop), daemon=True
+            ).start()
+            ms = self.markscheme
+            saved = ms.finder, ms.db, ms.schedule
+            # Submissions are scheduled by the coordinator.
+            ms.finder = RemoteFinder(remote)
+            ms.db = RemoteStorage(remote)
+            ms.schedule = 'finder'
+            try:
+                ms.run()
+            finally:
+                ms.finder, ms.db, ms.schedule = saved
+        finally:
+            stop.set()
+            conn.close()
@@ -16,15 +16,22 @@
 #
 #
 """Execution context for running tests"""
+import os
+import pickle
+import signal
 import sys
 import logging
+import threading
+from collections import deque
 from io import StringIO
 from contextlib import ( redirect_stdout, redirect_stderr, contextmanager, ExitStack)
 from importlib import import_module
 from warnings import catch_warnings
 
+from .import metrics
+
 logger = logging.getLogger(__name__)
-__all__ = ['ExecutionContext']
+__all__ = ['ExecutionContext', 'ForkedCall']
 
 
 class ExecutionContext:
@@ -84,22 +91,217 @@ class ExecutionContext:
             self.do_clean_up()
 
 
+class ForkedCall:
+    """
+    Call a function in a forked child process.
+
+    The child is a copy-on-write copy of the current process, so the
+    function and its arguments are not pickled, and any state changed by
+    the call is discarded when the child exits. The return value is
+    pickled and sent back through a pipe, and is retrieved using
+    :func:`result`.
+
+    Availability: UNIX
+
+    :param func: Function to call.
+    :param args: Arguments for the call.
+    """
+
+    def __init__(self, func, *args):
+        read_fd, write_fd = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(read_fd)
+            # noinspection PyBroadException
+            try:
+                payload = pickle.dumps((func(*args), None))
+            except BaseException as err:
+                payload = pickle.dumps((None, f'{err.__class__.__name__}: {err}'))
+            with os.fdopen(write_fd, 'wb') as f:
+                f.write(payload)
+            os._exit(0)
+
+        os.close(write_fd)
+        self.fd = read_fd
+
+    def result(self):
+        """
+        Wait for the child process and return the result of the call.
+
+        :raises: RuntimeError if the call raised an exception or the child
+            exited without returning a result.
+        """
+        with os.fdopen(self.fd, 'rb') as f:
+            data = f.read()
+        os.waitpid(self.pid, 0)
+        if not data:
+            raise RuntimeError('Forked process exited unexpectedly.')
+
+        rv, error = pickle.loads(data)
+        if error is not None:
+            raise RuntimeError(error)
+
+        return rv
+
+    def kill(self):
+        """
+        Kill the child process, discarding the result of the call.
+        """
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        os.close(self.fd)
+        os.waitpid(self.pid, 0)
+
+
 class TestRun:
     """
     Test runner to run the test cases for each exercise.
+
+    The submission code is executed once, and the exercises are run in the
+    resulting namespace. If *processes* is given, each exercise is run in
+    a child forked after the code is executed, so that up to *processes*
+    exercises run at once and no exercise sees changes made to the
+    namespace by another.
+
+    Forking is only safe in a process running a single thread, since a
+    lock held by another thread at the time of the fork (for instance by a
+    thread writing to a stream) stays locked forever in the child. The
+    workers of :class:`markingpy.PoolGrader` and
+    :class:`markingpy.ForkServerGrader` run a single thread, but with an
+    in-process grader the children are forked from the process running
+    the grading pipeline threads, and a warning is logged.
+
+    :param exercises: Exercises to run.
+    :param preload_modules: Modules to import before running submissions.
+    :param processes: Number of exercises to run at once in forked
+        children (UNIX only). Defaults to None, which runs the exercises
+        one after another in the current process.
+    :param collect_metrics: Whether processes running the task on behalf
+        of the grader should collect timing metrics.
     """
 
-    def __init__(self, exercises, preload_modules):
+    def __init__(
+        self, exercises, preload_modules, processes=None, collect_metrics=False
+    ):
+        if processes is not None and not hasattr(os, 'fork'):
+            raise RuntimeError('Forked exercises are not available on this platform')
+
+        if processes is not None and processes < 1:
+            raise ValueError(f'Invalid number of exercise processes: {processes}')
+
         self.exercises = exercises
         self.preload_modules = preload_modules
+        self.processes = processes
+        self.collect_metrics = collect_metrics
+        self.preloaded = False
+        self.warned_threads = False
+
+    def preload(self):
+        """
+        Import the preload modules, if this has not already been done.
+        """
+        if not self.preloaded:
+            for mod in self.preload_modules:
+                import_module(mod)
+            self.preloaded = True
 
     def exec_ns(self, code):
         ns = {}
         exec (code, ns)
         return ns
 
+    def iter_results(self, code, indices=None):
+        """
+        Run the exercises, yielding the feedback for each exercise as
+        soon as it is available.
+
+        :param code: Compiled submission code.
+        :param indices: Indices of the exercises to run. Defaults to all
+            exercises.
+        :return: generator yielding pairs (index, feedback)
+        """
+        if indices is None:
+            indices = range(len(self.exercises))
+        if not indices:
+            return
+
+        self.preload()
+        with metrics.measure('exec'):
+            ns = self.exec_ns(code)
+        if self.processes is not None:
+            yield from self.iter_forked(ns, indices)
+            return
+
+        for index in indices:
+            yield index, self.exercises[index].run(ns)
+
+    def run_forked(self, index, ns):
+        """
+        Run an exercise in a forked child.
+
+        :return: The feedback for the exercise and the metrics samples
+            collected while running it.
+        """
+        if metrics.active() is not None:
+            # Start afresh rather than use the parent's metrics, whose lock
+            # may have been held by another thread when the child forked.
+            metrics.activate(metrics.Metrics())
+        return self.exercises[index].run(ns), metrics.drain()
+
+    def iter_forked(self, ns, indices):
+        """
+        Run each exercise in a forked child, yielding the feedback in
+        exercise order.
+        """
+        if threading.active_count() > 1 and not self.warned_threads:
+            logger.warning(
+                'Forking exercise processes from a process running other'
+                ' threads, which can deadlock; grade with --workers or'
+                ' --fork-server to fork from single-threaded workers'
+            )
+            self.warned_threads = True
+        running = deque()
+        indices = iter(indices)
+        try:
+            while True:
+                while len(running) < self.processes:
+                    index = next(indices, None)
+                    if index is None:
+                        break
+
+                    running.append((index, ForkedCall(self.run_forked, index, ns)))
+                if not running:
+                    break
+
+                index, call = running.popleft()
+                try:
+                    result, samples = call.result()
+                    active = metrics.active()
+                    if active is not None:
+                        active.add_samples(samples)
+                except RuntimeError as err:
+                    logger.debug(f'Forked exercise {index} failed: {err}')
+                    result = self.exercises[index].failed(f'Exercise failed: {err}')
+                yield index, result
+
+        finally:
+            for _, call in running:
+                call.kill()
+
     def __call__(self, code):
-        for mod in self.preload_modules:
-            import_module(mod)
-        ns = self.exec_ns(code)
-        return [ex.run(ns) for ex in self.exercises]
+        return [result for _, result in self.iter_results(code)]
+
+    def failed(self, msg, indices=None):
+        """
+        Feedback for a submission that could not be graded.
+
+        :param msg: Reason the submission could not be graded.
+        :param indices: Indices of the exercises that could not be run.
+            Defaults to all exercises.
+        :return: list of feedback for each exercise
+        """
+        if indices is None:
+            indices = range(len(self.exercises))
+        return [self.exercises[index].failed(msg) for index in indices]
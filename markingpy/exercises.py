@@ -28,7 +28,7 @@ from typing import ( Union, Dict, Any, Type, Callable, Optional, Tuple, Iterable
 
 
 from .cases import Test, TimingTest, CallTest, Call
-from .utils import log_calls
+from .utils import log_calls, fingerprint
 from .import cases
 
 ARGS = Tuple[Any, ...]
@@ -64,9 +64,20 @@ class ExerciseError(Exception):
     pass
 
 
-ExerciseFeedback = namedtuple(
-    "ExerciseFeedback", ("marks", "total_marks", "feedback", "per_test")
-)
+class ExerciseFeedback(
+    namedtuple("ExerciseFeedback", ("marks", "total_marks", "feedback", "per_test"))
+):
+    __slots__ = ()
+    failed = False
+
+
+class FailedExerciseFeedback(ExerciseFeedback):
+    """
+    Feedback for an exercise that could not be run, for instance because
+    the grading process timed out or crashed.
+    """
+    __slots__ = ()
+    failed = True
 
 
 def record_call(*args: Any, **kwargs: Any) -> Call:
@@ -206,6 +217,19 @@ class Exercise(ExerciseBase):
     def total_marks(self) -> int:
         return sum(t.marks for t in self.tests)
 
+    def fingerprint(self) -> str:
+        """
+        Hash identifying this exercise and the configuration of its tests.
+        """
+        return fingerprint(
+            self.__class__.__name__,
+            self.name,
+            self.descr,
+            self.submission_name,
+            self.func,
+            *(test.fingerprint() for test in self.tests),
+        )
+
     def add_test(
         self,
         *args,
@@ -286,6 +310,15 @@ class Exercise(ExerciseBase):
         feedback.append(f"Score for {self.name}: {score} / {self.total_marks}")
         return ExerciseFeedback(score, self.total_marks, "\n".join(feedback), results)
 
+    def failed(self, msg: str) -> ExerciseFeedback:
+        """
+        Create the feedback for an exercise that could not be run.
+
+        :param msg: Reason the exercise could not be run.
+        :return: namedtuple containing marks, total_marks, feedback
+        """
+        return FailedExerciseFeedback(0, self.total_marks, f"{self.name}\n{msg}", [])
+
     def run(self, namespace: Dict[str, Any]) -> ExerciseFeedback:
         """
         Run the test suite on submission.
@@ -19,7 +19,8 @@ A finder is an object that makes submission code available to the grader.
 Several finders are provided by default and, unless otherwise specified,
 the :class:`DirectoryFinder` object is used. This finder retrieves all
 Python (`.py`) files in the path specified when the tool is invoked using
-the command line. Other builtin finders include a null finder, used for
+the command line, and can also search subdirectories or load one submission
+from each subdirectory. Other builtin finders include a null finder, used for
 testing, and a SQLite finder that retrieves submissions form a database.
 
 Each finder object should support a single method, :func:`get_submissions`,
@@ -27,14 +28,49 @@ that returns a generator yielding :class:`submission.Submission` objects.
 """
 
 from abc import ABC, abstractmethod
+import fnmatch
+import hashlib
+import json
+import os
+import re
 import sqlite3
+import tarfile
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Union, List, Generator, Optional, Any
+from typing import (
+    Union,
+    List,
+    Generator,
+    Optional,
+    Any,
+    Iterator,
+    Tuple,
+    Sequence,
+    Callable,
+    Pattern,
+)
 
 from .import submission
 
-__all__ = ["BaseFinder", "DirectoryFinder", "SQLiteFinder", "NullFinder"]
+__all__ = [
+    "BaseFinder",
+    "DirectoryFinder",
+    "SQLiteFinder",
+    "NullFinder",
+    "PrefetchingFinder",
+    "ArchiveFinder",
+    "ZipFinder",
+    "TarFinder",
+    "IncrementalFinder",
+    "ShardFinder",
+]
 SUB_GENERATOR = Generator[submission.Submission, None, None]
+# Pairs of a submission reference and a function that loads its source.
+LOADERS = Iterator[Tuple[str, Callable[[], Optional[str]]]]
 
 
 class BaseFinder(ABC):
@@ -43,60 +79,446 @@ class BaseFinder(ABC):
     def get_submissions(self, **kwargs):
         """Load submissions using this finder. Return a generator."""
 
+    def get_loaders(self) -> Optional[LOADERS]:
+        """
+        Find the submissions without loading their sources.
+
+        Finders that can find submissions separately from reading them
+        return an iterator of (reference, loader) pairs, where calling the
+        loader returns the source of the submission, or None if there is
+        no submission after all. This allows the sources to be read ahead
+        by a :class:`PrefetchingFinder`. The default returns None.
+        """
+        return None
+
+    def start_run(self, scheme_fingerprint: Optional[str] = None):
+        """
+        Called before the submissions are found for a grading run.
+
+        :param scheme_fingerprint: Fingerprint of the marking scheme used
+            for the run. The default does nothing.
+        """
+
+    def mark_stored(self, reference: str):
+        """
+        Called once a submission found for a run has been graded and its
+        record stored. The default does nothing.
+        """
+
+    def finish_run(self):
+        """
+        Called once the submissions found for a run have all been graded
+        and stored. Finders that keep track of the submissions they have
+        found between runs update their state here, so submissions found
+        by a run that did not finish are found again. The default does
+        nothing.
+        """
+
+
+def _compile_patterns(patterns: Sequence[str]) -> Optional[Pattern]:
+    if not patterns:
+        return None
+
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
 
 class DirectoryFinder(BaseFinder):
     """
     Load submissions from a directory.
+
+    Glob patterns are matched against both the name of each file or
+    directory and its path relative to *path*, using ``/`` as the separator.
+    Submissions are loaded one at a time while the directory is walked.
+
+    :param path: Directory containing the submissions.
+    :param include: Patterns of the files to load. Defaults to ``*.py``.
+    :param exclude: Patterns of the files and directories to skip.
+    :param recursive: If true, subdirectories are searched too, and the
+        reference of each submission is its relative path without the file
+        extension. Default False.
+    :param per_directory: If true, each directory in *path* contains a single
+        submission, named after the directory, whose source is the matching
+        files in the directory joined in the order they are found. Files
+        directly in *path* are ignored. Default False.
     """
 
-    def __init__(self, path: Union[str, Path]):
+    def __init__(
+        self,
+        path: Union[str, Path],
+        include: Sequence[str] = ("*.py",),
+        exclude: Sequence[str] = (),
+        recursive: bool = False,
+        per_directory: bool = False,
+    ):
         path = self.path = Path(path)
         if path.exists() and not path.is_dir():
             print(path)
             raise NotADirectoryError("Expected a directory")
 
+        self.include = _compile_patterns(include)
+        self.exclude = _compile_patterns(exclude)
+        self.recursive = recursive
+        self.per_directory = per_directory
+
+    def is_excluded(self, name: str, relpath: str) -> bool:
+        exclude = self.exclude
+        return exclude is not None and bool(
+            exclude.match(name) or exclude.match(relpath)
+        )
+
+    def is_included(self, name: str, relpath: str) -> bool:
+        include = self.include
+        return include is None or bool(include.match(name) or include.match(relpath))
+
+    def iter_files(
+        self, path: Optional[str] = None, prefix: str = ""
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Walk a directory, in order of name, yielding the files to load.
+
+        The walk uses :func:`os.scandir`, so the type of each entry is
+        usually known without a further call to stat.
+
+        :param path: Directory to walk. Defaults to the finder path.
+        :param prefix: Relative path of the directory, ending with ``/``.
+        :return: Iterator of (relative path, path) pairs.
+        """
+        stack = [(str(self.path) if path is None else path, prefix)]
+        while stack:
+            dirpath, prefix = stack.pop()
+            with os.scandir(dirpath) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            subdirs = []
+            for entry in entries:
+                relpath = prefix + entry.name
+                if self.is_excluded(entry.name, relpath):
+                    continue
+
+                if entry.is_dir():
+                    if self.recursive:
+                        subdirs.append((entry.path, relpath + "/"))
+                elif entry.is_file() and self.is_included(entry.name, relpath):
+                    yield relpath, entry.path
+            stack.extend(reversed(subdirs))
+
     def get_file_list(self) -> Optional[List[Path]]:
-        try:
-            return [
-                file
-                for file in self.path.iterdir()
-                if file.is_file()
-                if file.name.endswith(".py")
-            ]
-
-        except AttributeError:
+        if not self.path.is_dir():
             return None
 
-    def get_submissions(self) -> SUB_GENERATOR:
-        file_list = self.get_file_list()
-        if file_list is None:
+        return [Path(path) for _, path in self.iter_files()]
+
+    def load_directory(self, path: str, prefix: str) -> Optional[str]:
+        """
+        Load the source of a submission from the files in a directory.
+        """
+        paths = [path for _, path in self.iter_files(path, prefix)]
+        if not paths:
+            return None
+
+        return "\n".join(Path(path).read_text() for path in paths)
+
+    def get_loaders(self) -> LOADERS:
+        if not self.path.is_dir():
             raise RuntimeError('No submissions found')
 
-        for file in file_list:
-            ref = file.name[:-3]
-            source = file.read_text()
-            yield submission.Submission(ref, source)
+        if not self.per_directory:
+            for relpath, path in self.iter_files():
+                yield os.path.splitext(relpath)[0], Path(path).read_text
+            return
+
+        with os.scandir(self.path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            if entry.is_dir() and not self.is_excluded(entry.name, entry.name):
+                load = partial(self.load_directory, entry.path, entry.name + "/")
+                yield entry.name, load
+
+    def get_submissions(self) -> SUB_GENERATOR:
+        for ref, load in self.get_loaders():
+            source = load()
+            if source is not None:
+                yield submission.Submission(ref, source)
+
+
+class ArchiveFinder(BaseFinder):
+    """
+    Base class for finders that load submissions from the members of an
+    archive, which are read straight from the archive without extracting
+    it. Subclasses implement :func:`iter_members`.
+
+    Glob patterns are matched against both the name of each member and its
+    path after stripping, and exclude patterns also against the name of
+    each directory that contains it.
+
+    :param path: Path of the archive.
+    :param include: Patterns of the members to load. Defaults to ``*.py``.
+    :param exclude: Patterns of the members and directories to skip.
+    :param strip: Number of leading directories removed from the path of
+        each member, as with ``tar --strip-components``. Default 0.
+    :param per_directory: If true, each top-level directory in the archive
+        (after stripping) contains a single submission, named after the
+        directory, whose source is the matching members in the directory
+        joined together. Members outside a directory are ignored. Default
+        False.
+    :param reference: Function that takes the path of a member (after
+        stripping) and returns the reference of its submission. Defaults to
+        the path without its extension. Not used with *per_directory*.
+    :param encoding: Encoding of the sources. Default 'utf-8'.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        include: Sequence[str] = ("*.py",),
+        exclude: Sequence[str] = (),
+        strip: int = 0,
+        per_directory: bool = False,
+        reference: Optional[Callable[[str], str]] = None,
+        encoding: str = "utf-8",
+    ):
+        self.path = Path(path)
+        self.include = _compile_patterns(include)
+        self.exclude = _compile_patterns(exclude)
+        self.strip = strip
+        self.per_directory = per_directory
+        self.reference = reference
+        self.encoding = encoding
+
+    @abstractmethod
+    def iter_members(self) -> Iterator[Tuple[str, Callable[[], bytes]]]:
+        """
+        Iterate over the files in the archive.
+
+        :return: Iterator of (path, read) pairs, where *read* returns the
+            contents of the member. It is only called before the iterator
+            is advanced.
+        """
+
+    def get_path(self, name: str) -> Optional[str]:
+        """
+        Get the path of a member after stripping, or None if the member
+        should be skipped.
+        """
+        while name.startswith("./"):
+            name = name[2:]
+        parts = name.split("/")[self.strip:]
+        if not parts:
+            return None
+
+        path = "/".join(parts)
+        exclude = self.exclude
+        if exclude is not None and (
+            exclude.match(path) or any(exclude.match(p) for p in parts)
+        ):
+            return None
+
+        include = self.include
+        if include is not None and not (
+            include.match(parts[-1]) or include.match(path)
+        ):
+            return None
+
+        return path
+
+    def get_reference(self, path: str) -> str:
+        if self.reference is not None:
+            return self.reference(path)
+
+        return os.path.splitext(path)[0]
+
+    def get_submissions(self, **kwargs: Any) -> SUB_GENERATOR:
+        if not self.path.is_file():
+            raise RuntimeError(f"Archive {self.path} does not exist")
+
+        directory, sources = None, []
+        for name, read in self.iter_members():
+            path = self.get_path(name)
+            if path is None:
+                continue
+
+            if not self.per_directory:
+                source = read().decode(self.encoding)
+                yield submission.Submission(self.get_reference(path), source)
+                continue
+
+            top, sep, _ = path.partition("/")
+            if not sep:
+                continue
+
+            if top != directory:
+                if sources:
+                    yield submission.Submission(directory, "\n".join(sources))
+                directory, sources = top, []
+            sources.append(read().decode(self.encoding))
+        if sources:
+            yield submission.Submission(directory, "\n".join(sources))
+
+
+class ZipFinder(ArchiveFinder):
+    """
+    Load submissions from the members of a zip file.
+
+    Members are read in archive order, or in order of their path with
+    *per_directory*, so each directory is read together.
+    """
+
+    def iter_members(self) -> Iterator[Tuple[str, Callable[[], bytes]]]:
+        with zipfile.ZipFile(self.path) as archive:
+            members = [info for info in archive.infolist() if not info.is_dir()]
+            if self.per_directory:
+                members.sort(key=lambda info: info.filename)
+            for info in members:
+                yield info.filename, partial(archive.read, info)
+
+
+class TarFinder(ArchiveFinder):
+    """
+    Load submissions from the members of a tar file, which may be
+    compressed.
+
+    The archive is read in a single pass as a stream, so with
+    *per_directory* the members of each directory must be stored together.
+    """
+
+    def iter_members(self) -> Iterator[Tuple[str, Callable[[], bytes]]]:
+        with tarfile.open(self.path, "r|*") as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, partial(self.read_member, archive, member)
+
+    @staticmethod
+    def read_member(archive: tarfile.TarFile, member: tarfile.TarInfo) -> bytes:
+        with archive.extractfile(member) as file:
+            return file.read()
 
 
 class SQLiteFinder(BaseFinder):
+    """
+    Load submissions from a table in a SQLite database.
+
+    Rows are fetched in batches over a single connection, which is kept
+    open between runs.
+
+    :param path: Path to the database.
+    :param table: Name of the table containing the submissions.
+    :param ref_field: Column containing the submission references.
+    :param source_field: Column containing the submission sources.
+    :param changed_field: Column containing a timestamp or version number
+        that increases whenever a submission changes. If given, only the
+        rows where it is greater than the watermark are loaded, and once
+        every row loaded has been graded the watermark is advanced to the
+        greatest value loaded.
+    :param since: Initial watermark. Defaults to None, which loads every
+        row on the first run.
+    :param state_path: Path of a JSON file in which the watermark is kept
+        between runs. The watermark in this file takes precedence over
+        *since*.
+    :param batch_size: Number of rows fetched at a time. Default 500.
+    :param read_only: If true (default), the database is opened in
+        read-only mode.
+    """
 
     def __init__(
-        self, path: Union[str, Path], table: str, ref_field: str, source_field: str
+        self,
+        path: Union[str, Path],
+        table: str,
+        ref_field: str,
+        source_field: str,
+        changed_field: Optional[str] = None,
+        since: Any = None,
+        state_path: Union[str, Path, None] = None,
+        batch_size: int = 500,
+        read_only: bool = True,
     ):
         self.path = Path(path)
         self.table = table
         self.ref_field = ref_field
         self.source_field = source_field
+        self.changed_field = changed_field
+        self.state_path = Path(state_path).expanduser() if state_path else None
+        self.since = since
+        if self.state_path is not None and self.state_path.exists():
+            self.since = json.loads(self.state_path.read_text())['since']
+        self.batch_size = batch_size
+        self.read_only = read_only
+        self.conn = None
+        # Watermark to advance to once the run finishes.
+        self.latest = None
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Get the connection to the database, opening it if necessary.
+        """
+        if self.conn is None:
+            if self.read_only:
+                uri = self.path.resolve().as_uri() + "?mode=ro"
+                self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            else:
+                self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def query(self) -> Tuple[str, tuple]:
+        """
+        Get the query that selects the submissions, and its parameters.
+        """
+        fields = f"{self.ref_field}, {self.source_field}"
+        if self.changed_field is None:
+            return f"SELECT {fields} FROM {self.table}", ()
+
+        query = f"SELECT {fields}, {self.changed_field} FROM {self.table}"
+        if self.since is None:
+            return f"{query} ORDER BY {self.changed_field}", ()
+
+        return (
+            f"{query} WHERE {self.changed_field} > ? ORDER BY {self.changed_field}",
+            (self.since,),
+        )
+
+    def set_since(self, since: Any):
+        """
+        Advance the watermark, saving it to the state file if there is one.
+        """
+        self.since = since
+        if self.state_path is not None:
+            tmp = self.state_path.with_name(f".{self.state_path.name}.tmp")
+            tmp.write_text(json.dumps({'since': since}))
+            os.replace(tmp, self.state_path)
 
     def get_submissions(self, **kwargs: Any) -> SUB_GENERATOR:
         if not self.path.exists():
             raise RuntimeError(f"Path {self.path} does not exist")
 
-        conn = sqlite3.connect(self.path)
-        for ref, source in conn.execute(
-            f"SELECT {self.ref_field}, {self.source_field} FROM {self.table}"
-        ):
-            yield submission.Submission(ref, source)
+        query, params = self.query()
+        cursor = self.connect().execute(query, params)
+        latest = self.since
+        self.latest = None
+        try:
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    if self.changed_field is not None:
+                        latest = row[2]
+                    yield submission.Submission(row[0], row[1])
+
+        finally:
+            cursor.close()
+        self.latest = latest
+
+    def finish_run(self):
+        """
+        Advance the watermark to the greatest value loaded by the run.
+        """
+        latest, self.latest = self.latest, None
+        if latest is not None and latest != self.since:
+            self.set_since(latest)
 
 
 class NullFinder(BaseFinder):
@@ -106,3 +528,335 @@ class NullFinder(BaseFinder):
 
     def get_submissions(self, **kwargs: Any) -> SUB_GENERATOR:
         yield from self.subs
+
+
+class PrefetchingFinder(BaseFinder):
+    """
+    Wrap a finder to read submissions ahead of the grader on background
+    threads.
+
+    If the wrapped finder provides loaders (see :func:`BaseFinder.get_loaders`),
+    the sources are read by a pool of threads. Otherwise, the submissions
+    are taken from the wrapped finder on a single background thread.
+    Submissions are yielded in the order of the wrapped finder.
+
+    :param finder: Finder to wrap.
+    :param ahead: Maximum number of submissions read ahead. Default 16.
+    :param threads: Number of threads reading sources. Default 4.
+    :param max_bytes: Maximum total size in bytes of the sources that have
+        been read ahead, beyond which no more are read until some have been
+        taken. At least one submission is always read. Default 64 MiB.
+    """
+
+    def __init__(
+        self,
+        finder: BaseFinder,
+        ahead: int = 16,
+        threads: int = 4,
+        max_bytes: int = 64 * 2 ** 20,
+    ):
+        self.finder = finder
+        self.ahead = max(1, ahead)
+        self.threads = max(1, threads)
+        self.max_bytes = max_bytes
+
+    def get_loaders(self) -> Optional[LOADERS]:
+        return self.finder.get_loaders()
+
+    def start_run(self, scheme_fingerprint: Optional[str] = None):
+        self.finder.start_run(scheme_fingerprint)
+
+    def mark_stored(self, reference: str):
+        self.finder.mark_stored(reference)
+
+    def finish_run(self):
+        self.finder.finish_run()
+
+    def get_submissions(self, **kwargs: Any) -> SUB_GENERATOR:
+        loaders = self.finder.get_loaders()
+        if loaders is None:
+            yield from self.prefetch_stream(self.finder.get_submissions(**kwargs))
+        else:
+            yield from self.prefetch_loaders(loaders)
+
+    def prefetch_loaders(self, loaders: LOADERS) -> SUB_GENERATOR:
+        """
+        Read sources ahead with a pool of threads.
+        """
+        window = deque()
+        with ThreadPoolExecutor(self.threads, "prefetch") as pool:
+            try:
+                for ref, load in loaders:
+                    while window and not self.has_room(window):
+                        sub = self.take(window)
+                        if sub is not None:
+                            yield sub
+
+                    window.append((ref, pool.submit(load)))
+                while window:
+                    sub = self.take(window)
+                    if sub is not None:
+                        yield sub
+
+            finally:
+                for _, future in window:
+                    future.cancel()
+
+    def has_room(self, window: deque) -> bool:
+        if len(window) >= self.ahead:
+            return False
+
+        size = sum(
+            len(future.result() or "") for _, future in window if future.done()
+        )
+        return size < self.max_bytes
+
+    @staticmethod
+    def take(window: deque) -> Optional[submission.Submission]:
+        ref, future = window.popleft()
+        source = future.result()
+        if source is None:
+            return None
+
+        return submission.Submission(ref, source)
+
+    def prefetch_stream(self, submissions: Iterator) -> SUB_GENERATOR:
+        """
+        Take submissions ahead from an iterator on a background thread.
+        """
+        buffer = deque()
+        cond = threading.Condition()
+        state = {'size': 0, 'done': False, 'error': None, 'stop': False}
+
+        def full():
+            return buffer and (
+                len(buffer) >= self.ahead or state['size'] >= self.max_bytes
+            )
+
+        def produce():
+            # noinspection PyBroadException
+            try:
+                for sub in submissions:
+                    with cond:
+                        while full() and not state['stop']:
+                            cond.wait()
+                        if state['stop']:
+                            return
+
+                        buffer.append(sub)
+                        state['size'] += len(sub.raw_source)
+                        cond.notify_all()
+            except BaseException as err:
+                state['error'] = err
+            finally:
+                with cond:
+                    state['done'] = True
+                    cond.notify_all()
+
+        thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                with cond:
+                    while not buffer and not state['done']:
+                        cond.wait()
+                    if not buffer:
+                        break
+
+                    sub = buffer.popleft()
+                    state['size'] -= len(sub.raw_source)
+                    cond.notify_all()
+                yield sub
+
+            if state['error'] is not None:
+                raise state['error']
+
+        finally:
+            with cond:
+                state['stop'] = True
+                cond.notify_all()
+
+
+class IncrementalFinder(BaseFinder):
+    """
+    Wrap a finder to load only the submissions that were added or changed
+    since they were last graded.
+
+    A manifest records a hash of the source of each submission that has
+    been graded and stored, together with the fingerprint of the marking
+    scheme it was graded with. For a :class:`DirectoryFinder` that loads a
+    single file for each submission, the path, size and modification time
+    of the file are recorded too, and files whose size and modification
+    time have not changed are not read at all. The manifest is rewritten
+    once a run has finished, and only records the submissions whose
+    records were stored, so submissions found by a run that did not
+    finish are loaded again. If the marking scheme has changed, every
+    submission is loaded.
+
+    :param finder: Finder to wrap.
+    :param manifest: Path of the JSON manifest file.
+    """
+
+    def __init__(self, finder: BaseFinder, manifest: Union[str, Path]):
+        self.finder = finder
+        self.manifest = Path(manifest).expanduser()
+        self.scheme = None
+        # Entries of the previous manifest, the entries to record and the
+        # entries of the submissions loaded but not yet stored.
+        self.previous = {}
+        self.entries = None
+        self.pending = {}
+
+    def load_manifest(self) -> dict:
+        """
+        Get the manifest entries recorded with the current marking scheme.
+        """
+        if not self.manifest.exists():
+            return {}
+
+        manifest = json.loads(self.manifest.read_text())
+        if manifest.get('scheme') != self.scheme:
+            return {}
+
+        return manifest['submissions']
+
+    def save_manifest(self, entries: dict):
+        if not self.manifest.parent.exists():
+            self.manifest.parent.mkdir(parents=True)
+        tmp = self.manifest.with_name(f".{self.manifest.name}.tmp")
+        tmp.write_text(json.dumps({'scheme': self.scheme, 'submissions': entries}))
+        os.replace(tmp, self.manifest)
+
+    @staticmethod
+    def hash_source(source: str) -> str:
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def start_run(self, scheme_fingerprint: Optional[str] = None):
+        self.scheme = scheme_fingerprint
+        self.finder.start_run(scheme_fingerprint)
+
+    def mark_stored(self, reference: str):
+        entry = self.pending.pop(reference, None)
+        if entry is not None:
+            self.entries[reference] = entry
+        self.finder.mark_stored(reference)
+
+    def finish_run(self):
+        """
+        Rewrite the manifest. Submissions that were loaded but not stored
+        keep their previous entry, if they had one.
+        """
+        if self.entries is not None:
+            entries = self.entries
+            for ref in self.pending:
+                if ref in self.previous:
+                    entries[ref] = self.previous[ref]
+            self.save_manifest(entries)
+            self.previous, self.entries, self.pending = {}, None, {}
+        self.finder.finish_run()
+
+    def iter_files(self) -> SUB_GENERATOR:
+        """
+        Load the changed files of a :class:`DirectoryFinder`.
+        """
+        finder = self.finder
+        if not finder.path.is_dir():
+            raise RuntimeError('No submissions found')
+
+        for relpath, path in finder.iter_files():
+            ref = os.path.splitext(relpath)[0]
+            stat = os.stat(path)
+            entry = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            old = self.previous.get(ref)
+            if old is not None and all(old.get(k) == v for k, v in entry.items()):
+                self.entries[ref] = old
+                continue
+
+            source = Path(path).read_text()
+            entry['hash'] = self.hash_source(source)
+            if old is None or old.get('hash') != entry['hash']:
+                self.pending[ref] = entry
+                yield submission.Submission(ref, source)
+            else:
+                self.entries[ref] = entry
+
+    def get_submissions(self, **kwargs: Any) -> SUB_GENERATOR:
+        self.previous = self.load_manifest()
+        self.entries = {}
+        self.pending = {}
+        finder = self.finder
+        if isinstance(finder, DirectoryFinder) and not finder.per_directory:
+            yield from self.iter_files()
+            return
+
+        for sub in finder.get_submissions(**kwargs):
+            entry = {'hash': self.hash_source(sub.raw_source)}
+            old = self.previous.get(sub.reference)
+            if old is None or old.get('hash') != entry['hash']:
+                self.pending[sub.reference] = entry
+                yield sub
+            else:
+                self.entries[sub.reference] = entry
+
+
+class ShardFinder(BaseFinder):
+    """
+    Wrap a finder to find only the submissions in one shard of the cohort.
+
+    Submissions are assigned to shards by a hash of their reference, so
+    separate jobs grading the shards of a cohort agree on which job grades
+    each submission without any coordination. If the wrapped finder
+    provides loaders, the submissions in other shards are not read.
+
+    :param finder: Finder to wrap.
+    :param index: Index of the shard, from 0 to *count* - 1.
+    :param count: Number of shards.
+    """
+
+    def __init__(self, finder: BaseFinder, index: int, count: int):
+        if not 0 <= index < count:
+            raise ValueError(f"Shard {index} is not in the range 0 to {count - 1}")
+
+        self.finder = finder
+        self.index = index
+        self.count = count
+
+    @staticmethod
+    def shard_of(reference: str, count: int) -> int:
+        """
+        Get the shard that the submission with *reference* belongs to.
+        """
+        digest = hashlib.sha256(reference.encode()).digest()
+        return int.from_bytes(digest[:8], "big") % count
+
+    def in_shard(self, reference: str) -> bool:
+        return self.shard_of(reference, self.count) == self.index
+
+    def start_run(self, scheme_fingerprint: Optional[str] = None):
+        self.finder.start_run(scheme_fingerprint)
+
+    def mark_stored(self, reference: str):
+        self.finder.mark_stored(reference)
+
+    def finish_run(self):
+        self.finder.finish_run()
+
+    def get_loaders(self) -> Optional[LOADERS]:
+        loaders = self.finder.get_loaders()
+        if loaders is None:
+            return None
+
+        return ((ref, load) for ref, load in loaders if self.in_shard(ref))
+
+    def get_submissions(self, **kwargs: Any) -> SUB_GENERATOR:
+        loaders = self.get_loaders()
+        if loaders is None:
+            for sub in self.finder.get_submissions(**kwargs):
+                if self.in_shard(sub.reference):
+                    yield sub
+            return
+
+        for ref, load in loaders:
+            source = load()
+            if source is not None:
+                yield submission.Submission(ref, source)
@@ -21,11 +21,23 @@ Grading tool for python files.
 
 import abc
 import logging
+import marshal
 import multiprocessing as mp
-from collections import namedtuple
+import os
+import signal
+import threading
+import time
+from collections import namedtuple, deque
+from multiprocessing import reduction
+from multiprocessing.connection import Connection, wait
+
+from .import metrics
+from .utils import set_limits
 
 logger = logging.getLogger(__name__)
-__all__ = ['SimpleGrader', 'ProcessGrader', "Record"]
+__all__ = [
+    'SimpleGrader', 'ProcessGrader', 'PoolGrader', 'ForkServerGrader', "Record"
+]
 Record = namedtuple('Record', ('id', 'score', 'feedback'))
 
 
@@ -33,6 +45,11 @@ class GraderABC(abc.ABC):
     """
     Abstract base class for graders.
     """
+    db = None
+    progress = None
+    # Whether tasks run on the calling thread, where they redirect the
+    # standard streams and catch warnings for the whole process.
+    in_process = False
 
     @abc.abstractmethod
     def submit(self, task, submission):
@@ -54,63 +71,765 @@ class GraderABC(abc.ABC):
         """
         pass
 
+    def start(self, task):
+        """
+        Prepare to grade submissions with *task*. This is called before
+        the grading pipeline starts its threads, and does nothing by
+        default.
+
+        :param task: Grading task that will be passed to :func:`grade`.
+        """
+
+    def stop(self):
+        """
+        Release anything set up by :func:`start`.
+        """
+
+    def grade(self, task, submissions):
+        """
+        Grade a stream of submissions, yielding each submission once it has
+        been graded.
+
+        The default implementation submits each submission in turn. Graders
+        that can run several tasks at once override this method, and need
+        not yield submissions in the order they are received.
+
+        :param task: Grading task to complete
+        :param submissions: Iterable of submissions to grade.
+        """
+        for submission in submissions:
+            self.submit(task, submission)
+            yield submission
+
+    def report_start(self, worker, submission):
+        """
+        Tell the progress tracker, if one is set, that a worker has started
+        grading a submission.
+        """
+        if self.progress is not None:
+            self.progress.start(worker, submission.reference)
+
+    def report_finish(self, worker, submission):
+        """
+        Tell the progress tracker, if one is set, that a worker has
+        finished grading a submission.
+        """
+        if self.progress is not None:
+            self.progress.finish(worker, submission.reference)
+
+    @staticmethod
+    def get_pending(task, submission):
+        """
+        Get the indices of the exercises that have to be run for a
+        submission. Exercises that already have a result in
+        :attr:`Submission.exercise_results` are not run again.
+        """
+        done = submission.exercise_results
+        return [i for i in range(len(task.exercises)) if i not in done]
+
+    def process_result(self, submission, result):
+        """
+        Add the result of a grading task to the submission and write the
+        record to the database, if one is set.
+
+        :param submission: Submission that was graded.
+        :param result: List of exercise feedback for every exercise.
+        """
+        submission.exercise_results = dict(enumerate(result))
+        mark = sum(res.marks for res in result)
+        total_mark = sum(res.total_marks for res in result)
+        feedback = '\n'.join(res.feedback for res in result)
+        submission.add_feedback('tests', feedback)
+        submission.score = mark
+        submission.percentage = mark * 100 / total_mark
+        submission.record = Record(
+            submission.reference, submission.percentage, feedback
+        )
+        if self.db:
+            self.db.add_record(submission.record)
+
 
 class SimpleGrader(GraderABC):
     """
     Simple grader class. Grading tasks are completed in process.
     """
+    in_process = True
 
     def __init__(self):
         self.db = None
 
     def submit(self, task, submission):
-        result = task(submission.compile())
-        mark = sum(res.marks for res in result)
-        total_mark = sum(res.total_marks for res in result)
-        feedback = '\n'.join(res.feedback for res in result)
-        submission.add_feedback('tests', feedback)
-        if self.db:
-            self.db.add_record(
-                Record(submission.reference, mark * 100 / total_mark, feedback)
-            )
+        results = dict(submission.exercise_results)
+        pending = self.get_pending(task, submission)
+        code = submission.compile()
+        start = time.monotonic()
+        self.report_start('main', submission)
+        try:
+            with metrics.submission(submission.reference):
+                results.update(task.iter_results(code, pending))
+        finally:
+            self.report_finish('main', submission)
+        if pending:
+            submission.runtime = time.monotonic() - start
+        self.process_result(submission, [results[i] for i in sorted(results)])
 
     def set_db(self, db):
         self.db = db
 
 
-def _task_worker(task, code, result):
-    result.value = task(code)
+def _exit_reason(status):
+    """
+    Describe why a grading process exited.
+
+    :param status: Exit code of the process, negative if the process was
+        killed by a signal.
+    """
+    sigxcpu = getattr(signal, 'SIGXCPU', None)
+    if sigxcpu is not None and status == -sigxcpu:
+        return 'CPU time limit exceeded.'
+
+    if status is not None and status < 0:
+        return f'Grading process killed by signal {-status}.'
+
+    return f'Grading process exited unexpectedly (status {status}).'
 
 
-class ProcessGrader(GraderABC):
+def _kill(process):
     """
-    Grader that runs each grading task in a separate process, thus
-    providing runtime isolation. However, this incurs additional
-    resource costs and is significantly slower than a simple grader.
+    Kill a process. :meth:`multiprocessing.Process.kill` needs Python 3.7,
+    and is the same as terminating the process on Windows.
+    """
+    sigkill = getattr(signal, 'SIGKILL', None)
+    if sigkill is None:
+        process.terminate()
+        return
+
+    try:
+        os.kill(process.pid, sigkill)
+    except OSError:
+        pass
+
+
+def _run_task(task, conn, task_id, code, indices):
+    """
+    Run the grading task, sending the feedback for each exercise as soon
+    as it is available, followed by an error message if the task failed
+    and the metrics samples collected while running the task.
+    """
+    # noinspection PyBroadException
+    try:
+        for index, result in task.iter_results(marshal.loads(code), indices):
+            conn.send(('exercise', task_id, index, result))
+    except BaseException as err:
+        conn.send(('error', task_id, f'{err.__class__.__name__}: {err}'))
+    samples = metrics.drain()
+    if samples:
+        conn.send(('metrics', task_id, samples))
+
+
+def _run_forked(task, conn, task_id, code, indices, memory_limit, cpu_limit):
+    """
+    Run the grading task in a child process forked from this worker.
+
+    :return: Reason the child exited abnormally, or None.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if memory_limit is not None or cpu_limit is not None:
+                set_limits(memory_limit, cpu_limit)
+            _run_task(task, conn, task_id, code, indices)
+        finally:
+            os._exit(0)
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        return _exit_reason(-os.WTERMSIG(status))
+
+    if os.WEXITSTATUS(status):
+        return _exit_reason(os.WEXITSTATUS(status))
+
+    return None
+
+
+def _pool_worker(task, conn, isolate=False, memory_limit=None, cpu_limit=None):
+    """
+    Worker loop for :class:`PoolGrader`.
+
+    Receives ``(task_id, code, indices)`` messages, where *code* is a
+    marshalled code object and *indices* are the indices of the exercises
+    to run, until the connection is closed or ``None`` is received. The
+    feedback for each exercise is sent back as an ``exercise`` message,
+    followed by a ``done`` message. If *isolate* is true, each task is run
+    in a child forked from the worker.
+    """
+    # Interrupts are handled by the parent, which shuts the pool down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(os, 'setpgid'):
+        # Run in a new process group so that stuck tasks can be killed
+        # along with any processes they have started.
+        os.setpgid(0, 0)
+    # Samples are collected in this process and sent back after each task.
+    collect = getattr(task, 'collect_metrics', False)
+    metrics.activate(metrics.Metrics() if collect else None)
+    task.preload()
+    if not isolate and memory_limit is not None:
+        set_limits(memory=memory_limit)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+
+        if msg is None:
+            break
+
+        task_id, code, indices = msg
+        reason = None
+        if isolate:
+            reason = _run_forked(
+                task, conn, task_id, code, indices, memory_limit, cpu_limit
+            )
+        else:
+            if cpu_limit is not None:
+                set_limits(cpu_time=cpu_limit)
+            _run_task(task, conn, task_id, code, indices)
+        conn.send(('done', task_id, reason))
+    conn.close()
+
+
+def _template_loop(task, conn, isolate, memory_limit, cpu_limit):
+    """
+    Loop of the template process of a :class:`PoolGrader`, which forks
+    the worker processes.
+
+    Receives ``('start',)`` messages, to which it replies with the pid of
+    a new worker followed by the grader's end of a pipe to the worker, and
+    ``('wait', pid, timeout)`` messages, to which it replies with the exit
+    code of the worker once it has exited, or None if it is still running
+    after *timeout* seconds. Stops when the connection is closed or
+    ``None`` is received.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+
+        if msg is None:
+            break
+
+        if msg[0] == 'start':
+            parent_conn, child_conn = mp.Pipe()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    conn.close()
+                    parent_conn.close()
+                    _pool_worker(task, child_conn, isolate, memory_limit, cpu_limit)
+                    status = 0
+                finally:
+                    os._exit(status)
+
+            child_conn.close()
+            conn.send(pid)
+            reduction.send_handle(conn, parent_conn.fileno(), None)
+            parent_conn.close()
+        else:
+            _, pid, timeout = msg
+            conn.send(_wait_pid(pid, timeout))
+    conn.close()
+
+
+def _wait_pid(pid, timeout=None):
+    """
+    Wait for a child process to exit.
+
+    :return: Exit code of the process, negative if it was killed by a
+        signal, or None if it is still running after *timeout* seconds.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        flags = 0 if deadline is None else os.WNOHANG
+        done, status = os.waitpid(pid, flags)
+        if done:
+            if os.WIFSIGNALED(status):
+                return -os.WTERMSIG(status)
+
+            return os.WEXITSTATUS(status)
+
+        if time.monotonic() >= deadline:
+            return None
+
+        time.sleep(0.01)
+
+
+class _TemplateProcess:
+    """
+    Handle for a worker process forked from a :class:`_Template`, with
+    the parts of the :class:`multiprocessing.Process` interface used by
+    :class:`_Worker`.
+    """
+
+    def __init__(self, template, pid):
+        self.template = template
+        self.pid = pid
+        self.exitcode = None
+
+    def join(self, timeout=None):
+        if self.exitcode is None:
+            self.exitcode = self.template.wait(self.pid, timeout)
+
+    def is_alive(self):
+        self.join(0)
+        return self.exitcode is None
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+class _Template:
     """
+    Process from which the workers of a :class:`PoolGrader` are forked.
 
-    def __init__(self, method=None):
-        self.context = ctx = mp.get_context(method)
-        self.manager = ctx.Manager()
+    Forking a process while other threads are running copies any locks
+    those threads hold, such as the locks of the logging module, into the
+    child, where they are never released. The template is started before
+    the grading pipeline starts its threads, so the workers that replace
+    those that are recycled or killed during the run are forked from a
+    process with a single thread.
+    """
+
+    def __init__(self, context, task, isolate=False, memory_limit=None, cpu_limit=None):
+        self.task = task
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_template_loop,
+            args=(task, child_conn, isolate, memory_limit, cpu_limit),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        # Workers are started from the grade stage, and the template is
+        # stopped from the thread that runs the pipeline.
+        self.lock = threading.Lock()
+
+    def start_worker(self):
+        with self.lock:
+            self.conn.send(('start',))
+            pid = self.conn.recv()
+            conn = Connection(reduction.recv_handle(self.conn))
+        return _Worker(conn, _TemplateProcess(self, pid))
+
+    def wait(self, pid, timeout=None):
+        with self.lock:
+            self.conn.send(('wait', pid, timeout))
+            return self.conn.recv()
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(1)
+            if self.process.is_alive():
+                _kill(self.process)
+                self.process.join()
+            self.conn.close()
+
+
+class _Job:
+    """
+    Progress of grading a submission in a :class:`PoolGrader`.
+    """
+
+    def __init__(self, task_id, submission, pending):
+        self.task_id = task_id
+        self.submission = submission
+        self.code = marshal.dumps(submission.compile())
+        self.pending = pending
+        self.results = dict(submission.exercise_results)
+        self.error = None
+        self.started = None
+
+
+class _Worker:
+    """
+    Handle for a worker process in a :class:`PoolGrader` pool.
+    """
+
+    def __init__(self, conn, process):
+        self.conn = conn
+        self.process = process
+        self.completed = 0
+        self.job = None
+        self.last_progress = None
+
+    @classmethod
+    def start(cls, context, task, isolate=False, memory_limit=None, cpu_limit=None):
+        """
+        Start a worker process with the start method of *context*.
+        """
+        conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=_pool_worker,
+            args=(task, child_conn, isolate, memory_limit, cpu_limit),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        return cls(conn, process)
+
+    def send(self, job):
+        self.job = job
+        self.last_progress = time.monotonic()
+        if job.started is None:
+            job.started = self.last_progress
+        self.conn.send((job.task_id, job.code, job.pending))
+
+    def receive(self):
+        """
+        Handle the messages received from the worker process.
+
+        :return: True if the current job has finished.
+        """
+        job = self.job
+        try:
+            while self.conn.poll():
+                kind, task_id, *data = self.conn.recv()
+                assert task_id == job.task_id
+                if kind == 'exercise':
+                    index, result = data
+                    job.results[index] = result
+                    job.pending.remove(index)
+                    self.last_progress = time.monotonic()
+                elif kind == 'metrics':
+                    active = metrics.active()
+                    if active is not None:
+                        active.add_samples(data[0], job.submission.reference)
+                elif kind == 'error' and job.error is None:
+                    job.error = f'Grading failed: {data[0]}'
+                elif kind == 'done':
+                    if data[0] is not None and job.error is None:
+                        job.error = data[0]
+                    break
+
+            else:
+                return False
+
+        except EOFError:
+            self.process.join()
+            if job.error is None:
+                job.error = _exit_reason(self.process.exitcode)
+        self.job = None
+        self.completed += 1
+        return True
+
+    def kill(self):
+        """
+        Kill the worker process along with any processes it has started.
+        """
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            _kill(self.process)
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+
+class PoolGrader(GraderABC):
+    """
+    Grader that runs grading tasks on a pool of long-lived worker processes.
+
+    Each worker holds the grading task and receives compiled submissions
+    from the grader over a pipe, so the cost of starting a process and
+    transferring the task is paid once per worker rather than once per
+    submission. Submissions are yielded from :func:`grade` in the order
+    they finish.
+
+    Workers send the feedback for each exercise as soon as it is
+    available. If a submission runs for longer than *timeout*, or an
+    exercise runs for longer than *exercise_timeout*, the worker is killed
+    and replaced. The submission keeps the feedback for the exercises that
+    finished. If only the exercise time limit was exceeded, the remaining
+    exercises are run on a fresh worker.
+
+    When the workers are started by forking, :func:`start` starts a
+    template process from which the workers for the task are forked, so
+    that workers started while other threads are running, such as those
+    of the grading pipeline, are not forked from a process with several
+    threads.
+
+    :param workers: Number of worker processes. Defaults to the number of
+        CPUs.
+    :param max_tasks_per_child: Number of tasks a worker completes before
+        it is replaced by a fresh process. Defaults to None, which keeps
+        each worker for the whole run.
+    :param method: Start method for the worker processes. See
+        :func:`multiprocessing.get_context`.
+    :param timeout: Wall-clock time limit in seconds for each submission.
+    :param exercise_timeout: Wall-clock time limit in seconds for each
+        exercise.
+    :param memory_limit: Limit in bytes on the address space of the
+        processes that run submissions (UNIX only).
+    :param cpu_limit: Limit in seconds on the CPU time used by each
+        submission (UNIX only).
+    """
+    isolate = False
+
+    def __init__(
+        self,
+        workers=None,
+        max_tasks_per_child=None,
+        method=None,
+        timeout=None,
+        exercise_timeout=None,
+        memory_limit=None,
+        cpu_limit=None,
+    ):
+        if set_limits is None and not (memory_limit is None and cpu_limit is None):
+            raise RuntimeError('Resource limits are not available on this platform')
+
+        self.context = mp.get_context(method)
+        self.workers = workers if workers else os.cpu_count() or 1
+        self.max_tasks_per_child = max_tasks_per_child
+        self.timeout = timeout
+        self.exercise_timeout = exercise_timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
         self.task_id = 0
         self.db = None
+        self.template = None
 
-    def submit(self, task, submission):
-        self.task_id += 1
-        result = self.manager.Value(f'result-{self.task_id}', None)
-        proc = self.context.Process(
-            target=_task_worker, args=(task, submission.compile(), result)
-        )
-        proc.start()
-        proc.join()
-        mark = sum(res.marks for res in result.value)
-        total_mark = sum(res.total_marks for res in result.value)
-        feedback = '\n'.join(res.feedback for res in result.value)
-        submission.add_feedback('tests', feedback)
-        if self.db:
-            self.db.add_record(
-                Record(submission.reference, mark * 100 / total_mark, feedback)
+    def start(self, task):
+        """
+        Start the template process that forks the workers for *task*, if
+        the workers are started by forking.
+        """
+        self.stop()
+        if self.context.get_start_method() == 'fork' and reduction.HAVE_SEND_HANDLE:
+            self.template = _Template(
+                self.context, task, self.isolate, self.memory_limit, self.cpu_limit
             )
 
+    def stop(self):
+        if self.template is not None:
+            self.template.stop()
+            self.template = None
+
+    def start_worker(self, task):
+        if self.template is not None and self.template.task is task:
+            return self.template.start_worker()
+
+        return _Worker.start(
+            self.context, task, self.isolate, self.memory_limit, self.cpu_limit
+        )
+
+    def submit(self, task, submission):
+        for _ in self.grade(task, (submission,)):
+            pass
+
+    def recycle(self, worker, task):
+        """
+        Replace the worker with a new process if it has exited or has
+        reached the maximum number of tasks.
+        """
+        limit = self.max_tasks_per_child
+        if worker.process.is_alive() and (limit is None or worker.completed < limit):
+            return worker
+
+        logger.debug(f'Recycling worker {worker.process.pid}')
+        worker.stop()
+        return self.start_worker(task)
+
+    def get_deadline(self, worker):
+        """
+        Get the time at which the job on the worker exceeds its time limit.
+
+        :return: Deadline as a :func:`time.monotonic` time, or None.
+        """
+        deadlines = []
+        if self.timeout is not None:
+            deadlines.append(worker.job.started + self.timeout)
+        if self.exercise_timeout is not None:
+            deadlines.append(worker.last_progress + self.exercise_timeout)
+        return min(deadlines, default=None)
+
+    def get_wait_timeout(self, workers):
+        deadlines = [d for d in map(self.get_deadline, workers) if d is not None]
+        if not deadlines:
+            return None
+
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def time_out(self, task, worker):
+        """
+        Kill a worker whose job has exceeded its time limit.
+
+        :return: True if the remaining exercises should be run on a new
+            worker.
+        """
+        job = worker.job
+        worker.kill()
+        now = time.monotonic()
+        if self.timeout is not None and now >= job.started + self.timeout:
+            msg = f'Time limit for submission ({self.timeout}s) exceeded.'
+            rerun = False
+        else:
+            msg = f'Time limit for exercise ({self.exercise_timeout}s) exceeded.'
+            rerun = True
+        logger.warning(f'{job.submission.reference}: {msg}')
+        if job.pending:
+            index = job.pending.pop(0)
+            job.results[index] = task.failed(msg, (index,))[0]
+        if rerun and job.pending:
+            return True
+
+        job.error = msg
+        return False
+
+    def finish(self, task, job):
+        sub = job.submission
+        if job.started is not None:
+            sub.runtime = time.monotonic() - job.started
+        if job.error is not None:
+            logger.error(f'Grading {sub.reference} failed: {job.error}')
+            job.results.update(zip(job.pending, task.failed(job.error, job.pending)))
+        self.process_result(sub, [job.results[i] for i in sorted(job.results)])
+        return sub
+
+    def grade(self, task, submissions):
+        submissions = iter(submissions)
+        retry = deque()
+        idle = []
+        busy = {}
+        exhausted = False
+        try:
+            while True:
+                while len(busy) < self.workers and (retry or not exhausted):
+                    if retry:
+                        job = retry.popleft()
+                    else:
+                        try:
+                            sub = next(submissions)
+                        except StopIteration:
+                            exhausted = True
+                            break
+
+                        self.task_id += 1
+                        job = _Job(self.task_id, sub, self.get_pending(task, sub))
+                        if not job.pending:
+                            yield self.finish(task, job)
+                            continue
+
+                    worker = idle.pop() if idle else self.start_worker(task)
+                    worker.send(job)
+                    self.report_start(worker.process.pid, job.submission)
+                    busy[worker.conn] = worker
+                if not busy:
+                    break
+
+                finished = []
+                timeout = self.get_wait_timeout(busy.values())
+                for conn in wait(list(busy), timeout):
+                    worker = busy[conn]
+                    job = worker.job
+                    if worker.receive():
+                        self.report_finish(worker.process.pid, job.submission)
+                        del busy[conn]
+                        idle.append(self.recycle(worker, task))
+                        finished.append(job)
+                now = time.monotonic()
+                for conn, worker in list(busy.items()):
+                    deadline = self.get_deadline(worker)
+                    if deadline is not None and now >= deadline:
+                        del busy[conn]
+                        job = worker.job
+                        self.report_finish(worker.process.pid, job.submission)
+                        if self.time_out(task, worker):
+                            retry.append(job)
+                        else:
+                            finished.append(job)
+                for job in finished:
+                    yield self.finish(task, job)
+
+        finally:
+            for worker in idle + list(busy.values()):
+                worker.stop()
+
     def set_db(self, db):
         self.db = db
+
+
+class ProcessGrader(PoolGrader):
+    """
+    Grader that runs each grading task in a separate process, thus
+    providing runtime isolation. However, this incurs additional
+    resource costs and is significantly slower than a simple grader.
+
+    This is a :class:`PoolGrader` with a single worker that is replaced
+    after every task. Keyword arguments are forwarded to
+    :class:`PoolGrader`.
+    """
+
+    def __init__(self, method=None, **limits):
+        super().__init__(workers=1, max_tasks_per_child=1, method=method, **limits)
+
+
+class ForkServerGrader(PoolGrader):
+    """
+    Grader that forks a fresh process for each submission from a warm
+    template process.
+
+    The preload modules are imported once, before the templates are
+    started. Each template is forked from the grader, so the marking
+    scheme (including the model solutions and expected values) is
+    inherited rather than pickled. Each submission is graded in a child
+    forked from a template, which shares the template's memory
+    copy-on-write, so submissions are isolated from one another at a
+    fraction of the cost of starting a new process.
+
+    Availability: UNIX
+
+    :param workers: Number of template processes, and hence the number of
+        submissions graded at once. Defaults to the number of CPUs.
+    :param max_tasks_per_child: Number of tasks a template handles before
+        it is replaced. Defaults to None.
+
+    Keyword arguments are forwarded to :class:`PoolGrader`. Resource
+    limits are applied to the child for each submission rather than the
+    template.
+    """
+    isolate = True
+
+    def __init__(self, workers=None, max_tasks_per_child=None, **limits):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Fork server grading is not available on this platform')
+
+        super().__init__(workers, max_tasks_per_child, method='fork', **limits)
+
+    def start(self, task):
+        task.preload()
+        super().start(task)
+
+    def grade(self, task, submissions):
+        task.preload()
+        yield from super().grade(task, submissions)
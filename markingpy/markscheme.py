@@ -18,19 +18,33 @@
 import importlib
 import importlib.util
 import logging
+import marshal
+import multiprocessing as mp
+import sys
 import warnings
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import partial
+
 from inspect import isclass, isfunction
 from pathlib import Path
 from typing import ( Optional, Type, Dict, Tuple, Any, TYPE_CHECKING, Union)
 
+from .import __version__
+from .import cache as _cache
 from .import finders
 from .import storage
 from .import grader as _grader
 from .import execution
 from .import exercises
+from .import metrics as _metrics
+from .import pipeline
+from .import progress as _progress
+from .submission import Submission
 
-from .utils import log_calls
+from .utils import log_calls, fingerprint
 
 if TYPE_CHECKING:
     import importlib.machinery
@@ -64,6 +78,41 @@ def get_spec_path_or_module(
     return spec
 
 
+def _compile_source(reference, source, cache, collect_metrics):
+    """
+    Compile a submission source in a compile worker process.
+
+    :return: Tuple of the recovered source, the marshalled code object, the
+        compilation feedback and any metrics samples.
+    """
+    _metrics.activate(_metrics.Metrics() if collect_metrics else None)
+    sub = Submission(reference, source)
+    with _metrics.measure('compile', reference):
+        code = sub.compile(cache)
+    return (
+        sub.source,
+        marshal.dumps(code),
+        sub.feedback['compilation'],
+        _metrics.drain(),
+    )
+
+
+def _compile_pool(workers):
+    """
+    Create the pool of processes that compile submissions.
+
+    The pool is created by a pipeline thread, and a process forked while
+    other threads hold locks can deadlock, so the workers are started by
+    a fork server where it is available and are spawned otherwise. Python
+    3.6 cannot choose how the workers of a pool are started.
+    """
+    if sys.version_info < (3, 7):
+        return ProcessPoolExecutor(workers)
+
+    method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(workers, mp_context=mp.get_context(method))
+
+
 class SubmissionLoadError(Exception):
     pass
 
@@ -98,6 +147,55 @@ class MarkingScheme:
         *mark*, *total*, and *percentage*. For example, the 'all' builtin is
         equivalent to ``'{mark}/{total} ({percentage})'``.
     :param marks_db: Path to database to store submission results and feedback.
+    :param stage_workers: Number of threads to use for each stage of the
+        grading pipeline, by stage name. The compile and lint stages can
+        use several threads. The grade and store stages always use a
+        single thread; use a :class:`markingpy.PoolGrader` to grade
+        submissions in parallel. With a grader that runs the tests in
+        process, such as :class:`markingpy.SimpleGrader`, every stage runs
+        on the calling thread.
+    :param queue_size: Maximum number of submissions waiting between two
+        stages of the grading pipeline.
+    :param cache: :class:`markingpy.ResultCache` or path to the cache
+        database used to store grading results. A submission whose source
+        has already been graded with the same marking scheme is not graded
+        again, and only the exercises that have changed are run for a
+        submission graded with an earlier version of the marking scheme.
+        Defaults to None, which disables the cache.
+    :param code_cache: :class:`markingpy.CodeCache` or path to the
+        directory used to store compiled submissions, so submissions whose
+        source has not changed are not compiled again. Defaults to None,
+        which disables the cache.
+    :param compile_workers: Number of processes used to compile
+        submissions. If given, submissions are compiled in a pool of
+        processes ahead of grading, instead of on the threads of the
+        compile stage. Defaults to None.
+    :param exercise_processes: Number of exercises to run at once for each
+        submission. Each exercise is run in a child process forked after
+        the submission code is executed, so exercises cannot affect one
+        another (UNIX only). Children should be forked from the
+        single-threaded worker processes of a pool grader, see
+        :class:`markingpy.execution.TestRun`. Defaults to None, which runs
+        the exercises one after another.
+    :param schedule: Order in which submissions are graded. Either
+        'finder', which grades submissions in the order they are found;
+        'longest-first', which grades the submissions expected to take
+        longest first, based on the runtimes recorded in the marks
+        database or, for new submissions, the size of their source; or
+        'auto' (default), which uses 'longest-first' when the grader runs
+        several submissions at once. Submissions must all be loaded before
+        grading starts to order them.
+    :param metrics: Path to which timing metrics are written at the end of
+        each run. If given, the wall-clock time, CPU time and peak RSS
+        are measured for compiling, linting and executing each submission
+        and for each test, and written as a JSON report with the suffix
+        ``.json`` and in the Prometheus text format with the suffix
+        ``.prom``. Defaults to None, which disables metrics.
+    :param progress: If true, a progress line showing the number of
+        submissions graded, the throughput, the ETA and the longest running
+        submission is shown while grading. Default False.
+    :param status_file: Path of a JSON file that is rewritten with the
+        progress of the run every second, for dashboards. Defaults to None.
     """
 
     def __init__(
@@ -110,12 +208,32 @@ class MarkingScheme:
         linter: Optional['syntax.CodeStyleCheckerABC'] = None,
         marks_db: Optional[storage.StorageABC] = None,
         preload_modules: Optional[list] = None,
+        stage_workers: Optional[Dict[str, int]] = None,
+        queue_size: int = 8,
+        cache: Union[str, Path, _cache.ResultCache, None] = None,
+        code_cache: Union[str, Path, _cache.CodeCache, None] = None,
+        compile_workers: Optional[int] = None,
+        exercise_processes: Optional[int] = None,
+        schedule: str = 'auto',
+        metrics: Union[str, Path, None] = None,
+        progress: bool = False,
+        status_file: Union[str, Path, None] = None,
         **kwargs: Any,
     ):
         # Set up variables
         self.marks = marks
         self.score_style = score_style
         self.preload_modules = preload_modules if preload_modules else []
+        self.stage_workers = stage_workers if stage_workers else {}
+        self.queue_size = queue_size
+        self.cache = cache
+        self.code_cache = code_cache
+        self.compile_workers = compile_workers
+        self.exercise_processes = exercise_processes
+        self.schedule = schedule
+        self.metrics = metrics
+        self.progress = progress
+        self.status_file = status_file
         if marks_db is None:
             marks_db = storage.CSVStorageDB(Path("marks.csv"))
         self.db = marks_db
@@ -204,6 +322,82 @@ class MarkingScheme:
 
         yield from self.finder.get_submissions()
 
+    def count_submissions(self, resume=False) -> Optional[int]:
+        """
+        Estimate the number of submissions a run will grade, without
+        loading them.
+
+        If the finder provides loaders, the submissions it finds are
+        counted. Otherwise, the number of submissions with a runtime in the
+        marks database is used, if there are any.
+
+        :param resume: Whether submissions already stored with this
+            marking scheme are skipped.
+        :return: Number of submissions, or None if it cannot be estimated.
+        """
+        completed = self.db.get_completed(self.fingerprint()) if resume else set()
+        loaders = self.finder.get_loaders() if self.finder is not None else None
+        if loaders is not None:
+            return sum(1 for ref, _ in loaders if ref not in completed)
+
+        history = self.db.get_runtimes()
+        if not history:
+            return None
+
+        return len(history.keys() - completed)
+
+    def estimate_runtimes(self, submissions) -> list:
+        """
+        Estimate the time taken to grade each submission.
+
+        The runtime recorded in the marks database is used for submissions
+        that have been graded before. Other submissions are assumed to
+        take time proportional to the size of their source, at the
+        average rate of the recorded runtimes.
+
+        :param submissions: List of submissions.
+        :return: List of estimated runtimes.
+        """
+        history = self.db.get_runtimes()
+        total_runtime = sum(runtime for runtime, _ in history.values())
+        total_size = sum(size for _, size in history.values())
+        rate = total_runtime / total_size if total_size and total_runtime else 1.0
+        estimates = []
+        for sub in submissions:
+            if sub.reference in history:
+                estimates.append(history[sub.reference][0])
+            else:
+                estimates.append(rate * len(sub.raw_source))
+        return estimates
+
+    def order_submissions(self, submissions, parallel: Optional[bool] = None):
+        """
+        Order the submissions for grading according to the schedule.
+
+        :param submissions: Iterable of submissions.
+        :param parallel: Whether several submissions are graded at once,
+            used by the 'auto' schedule. Defaults to whether the grader
+            has more than one worker.
+        :return: Iterable of submissions.
+        """
+        schedule = self.schedule
+        if schedule == 'auto':
+            if parallel is None:
+                parallel = getattr(self.grader, 'workers', 1) > 1
+            schedule = 'longest-first' if parallel else 'finder'
+        if schedule == 'finder':
+            return submissions
+
+        if schedule != 'longest-first':
+            raise MarkingSchemeError(f'Unknown schedule {schedule}')
+
+        submissions = list(submissions)
+        estimates = self.estimate_runtimes(submissions)
+        order = sorted(
+            range(len(submissions)), key=estimates.__getitem__, reverse=True
+        )
+        return [submissions[i] for i in order]
+
     def format_return(self, score: int, total_score: int) -> str:
         """
         Format the returned score.
@@ -286,24 +480,381 @@ class MarkingScheme:
 
         :return:
         """
-        return execution.TestRun(self.exercises, self.preload_modules)
+        return execution.TestRun(
+            self.exercises,
+            self.preload_modules,
+            self.exercise_processes,
+            collect_metrics=self.metrics is not None,
+        )
+
+    def exercise_fingerprints(self) -> list:
+        """
+        Hashes identifying each exercise. The hash of an exercise changes
+        whenever a change to the exercise, its tests, the preload modules or
+        the markingpy version could change its result.
+        """
+        return [
+            fingerprint(__version__, self.preload_modules, ex.fingerprint())
+            for ex in self.exercises
+        ]
+
+    def fingerprint(self) -> str:
+        """
+        Hash identifying the marking scheme. This changes whenever a change
+        to the exercises, tests, linter configuration or markingpy version
+        could change the grade of a submission.
+        """
+        linter = self.linter
+        return fingerprint(
+            __version__,
+            self.preload_modules,
+            linter.__class__.__name__,
+            vars(linter) if linter is not None else None,
+            *self.exercise_fingerprints(),
+        )
+
+    def get_grader_limits(self) -> dict:
+        """
+        Get the time, memory and CPU limits applied by the grader.
+        """
+        return {
+            name: getattr(self.grader, name, None)
+            for name in ('timeout', 'exercise_timeout', 'memory_limit', 'cpu_limit')
+        }
+
+    def get_cache(self) -> Optional[_cache.ResultCache]:
+        """
+        Get the result cache, opening the cache database if necessary.
+        """
+        if isinstance(self.cache, (str, Path)):
+            self.cache = _cache.ResultCache(self.cache)
+        return self.cache
+
+    def get_code_cache(self) -> Optional[_cache.CodeCache]:
+        """
+        Get the cache of compiled submissions.
+        """
+        if isinstance(self.code_cache, (str, Path)):
+            self.code_cache = _cache.CodeCache(self.code_cache)
+        return self.code_cache
+
+    def lookup_submission(self, scheme_fingerprint, exercise_fingerprints, sub):
+        """
+        Cache lookup stage of the grading pipeline.
+
+        If the result for the whole marking scheme is not cached, the
+        cached results of individual exercises are restored so that only
+        the remaining exercises are run.
+        """
+        sub.cached = self.cache.get_submission(sub, scheme_fingerprint)
+        if sub.cached:
+            # The exercise results are stored in the marks database too.
+            self.cache.get_exercises(sub, self.exercises, exercise_fingerprints)
+        else:
+            found = sub.cached_exercises = self.cache.get_exercises(
+                sub, self.exercises, exercise_fingerprints
+            )
+            if found:
+                logger.debug(
+                    f'{sub.reference}: {found} of {len(self.exercises)} '
+                    f'exercise results restored from cache'
+                )
+        return sub
+
+    def cache_submission(self, scheme_fingerprint, exercise_fingerprints, sub):
+        """
+        Cache store stage of the grading pipeline.
+
+        The result for the whole marking scheme is not cached if any
+        exercise failed to run, such as when the grader time limit was
+        exceeded, so the submission is graded again in the next run.
+        """
+        if not any(r.failed for r in sub.exercise_results.values()):
+            self.cache.put_submission(sub, scheme_fingerprint)
+        self.cache.put_exercises(sub, exercise_fingerprints)
+        return sub
+
+    def compile_submission(self, sub):
+        """
+        Compile stage of the grading pipeline.
+        """
+        with _metrics.measure('compile', sub.reference):
+            sub.compile(self.get_code_cache())
+        return sub
+
+    def compile_submissions(self, submissions):
+        """
+        Compile stage of the grading pipeline that compiles submissions in
+        a pool of :attr:`compile_workers` processes.
+
+        Up to two submissions per process are compiled ahead of the
+        submission being yielded, and submissions are yielded in the order
+        they are received.
+        """
+        cache = self.get_code_cache()
+        collected = _metrics.active()
+        window = deque()
+        with _compile_pool(self.compile_workers) as pool:
+
+            def finish():
+                sub, future = window.popleft()
+                source, code, feedback, samples = future.result()
+                sub.source = source
+                sub.code = marshal.loads(code)
+                sub.add_feedback('compilation', feedback)
+                if collected is not None:
+                    collected.add_samples(samples, sub.reference)
+                return sub
+
+            for sub in submissions:
+                future = pool.submit(
+                    _compile_source,
+                    sub.reference,
+                    sub.raw_source,
+                    cache,
+                    collected is not None,
+                )
+                window.append((sub, future))
+                if len(window) >= 2 * self.compile_workers:
+                    yield finish()
+
+            while window:
+                yield finish()
+
+    def lint_submission(self, sub):
+        """
+        Lint stage of the grading pipeline.
+        """
+        with _metrics.measure('lint', sub.reference):
+            lint_report = self.linter.check(sub)
+        sub.add_feedback('style', lint_report)
+        return sub
+
+    def grade_submission(self, task, sub):
+        """
+        Grade stage of the grading pipeline for graders that run the tests
+        in process.
+        """
+        self.grader.submit(task, sub)
+        return sub
+
+    def store_submission(self, sub, progress=None):
+        """
+        Store stage of the grading pipeline.
+        """
+        # Results are added first, so a coordinator that ignores records
+        # it already has also ignores their results.
+        results = self.get_results(sub)
+        if results:
+            self.db.add_results(sub.reference, results)
+        self.db.add_record(sub.record)
+        if self.finder is not None:
+            self.finder.mark_stored(sub.reference)
+        # A submission that only ran some exercises would appear quicker to
+        # grade than it is, so only complete runs are recorded.
+        if sub.runtime is not None and not sub.cached_exercises:
+            self.db.add_runtime(sub.reference, sub.runtime, len(sub.raw_source))
+        if progress is not None:
+            progress.complete(sub.reference)
+        return sub
+
+    def get_results(self, sub):
+        """
+        Get the marks of a graded submission for each exercise and test,
+        in the form passed to :func:`markingpy.storage.StorageABC.add_results`.
+        """
+        results = []
+        for index, result in sorted(sub.exercise_results.items()):
+            exercise = self.exercises[index]
+            if result.per_test:
+                tests = [
+                    (test.name, feedback.mark, feedback.passed, feedback.runtime)
+                    for test, feedback in zip(exercise.tests, result.per_test)
+                ]
+            else:
+                # None of the tests ran, because the exercise failed or the
+                # function was not found, so each of them failed.
+                tests = [(test.name, 0, False, None) for test in exercise.tests]
+            results.append((exercise.name, result.marks, result.total_marks, tests))
+        return results
+
+    def create_progress(self, total=None) -> Optional[_progress.Progress]:
+        """
+        Create the progress tracker for a run, if progress reporting is
+        enabled.
+
+        :param total: Number of submissions, if known.
+        """
+        reporters = []
+        if self.progress:
+            reporters.append(_progress.TTYReporter())
+        if self.status_file is not None:
+            reporters.append(_progress.JSONReporter(self.status_file))
+        if not reporters:
+            return None
+
+        return _progress.Progress(total, reporters)
+
+    @contextmanager
+    def collect_metrics(self):
+        """
+        Context manager that collects metrics for a run and writes them
+        when it exits.
+        """
+        collected = _metrics.Metrics()
+        with _metrics.collecting(collected):
+            try:
+                yield collected
+
+            finally:
+                collected.write(self.metrics)
+
+    def create_pipeline(self, submissions, progress=None, task=None):
+        """
+        Create the grading pipeline for the submissions.
+
+        The stages are compile, lint (if a linter is set), grade and store.
+        If a result cache is set, submissions are looked up in the cache
+        first, and cached submissions skip the compile, lint and grade
+        stages. Otherwise, only the exercises without a cached result are
+        run.
+
+        :param submissions: Iterable of submissions to grade.
+        :param progress: :class:`markingpy.Progress` instance that is told
+            when each submission has been stored.
+        :param task: Grading task passed to the grader. Defaults to a new
+            task from :func:`create_grading_task`.
+        :return: :class:`markingpy.pipeline.Pipeline` instance
+        """
+        workers = self.stage_workers
+        if task is None:
+            task = self.create_grading_task()
+        cache = self.get_cache()
+        # Records are written by the store stage, not the grader.
+        self.grader.set_db(None)
+        # Tests run in process redirect sys.stdout and sys.stderr and catch
+        # warnings, which would capture the output of the other stages and
+        # of the caller, so then every stage runs on the calling thread.
+        in_process = self.grader.in_process
+        pipe = pipeline.Pipeline(submissions, self.queue_size, threaded=not in_process)
+
+        def cached(sub):
+            return sub.cached
+
+        if cache is not None:
+            # Results may depend on the grader limits, such as a test that
+            # runs out of memory, so they are part of the cache keys.
+            limits = self.get_grader_limits()
+            scheme_fingerprint = fingerprint(self.fingerprint(), limits)
+            exercise_fingerprints = [
+                fingerprint(f, limits) for f in self.exercise_fingerprints()
+            ]
+            lookup = partial(
+                self.lookup_submission, scheme_fingerprint, exercise_fingerprints
+            )
+            pipe.add_stage('lookup', lookup)
+        if self.compile_workers:
+            pipe.add_stream_stage('compile', self.compile_submissions, cached)
+        else:
+            pipe.add_stage(
+                'compile', self.compile_submission, workers.get('compile', 1), cached
+            )
+        if self.linter:
+            pipe.add_stage(
+                'lint', self.lint_submission, workers.get('lint', 1), cached
+            )
+        if in_process:
+            pipe.add_stage('grade', partial(self.grade_submission, task), bypass=cached)
+        else:
+            pipe.add_stream_stage('grade', partial(self.grader.grade, task), cached)
+        pipe.add_stage('store', partial(self.store_submission, progress=progress))
+        if cache is not None:
+            store = partial(
+                self.cache_submission, scheme_fingerprint, exercise_fingerprints
+            )
+            pipe.add_stage('cache', store, bypass=cached)
+        return pipe
+
+    def start_run(self, resume=False, parallel=None):
+        """
+        Start a grading run in the marks database and get the submissions
+        to grade.
+
+        :param resume: If true, submissions whose record has already been
+            stored with this marking scheme are skipped.
+        :param parallel: Passed to :func:`order_submissions`.
+        :return: Run identifier and iterable of submissions.
+        """
+        scheme_fingerprint = self.fingerprint()
+        # Raises an error before the run starts if the database cannot
+        # resume runs.
+        completed = self.db.get_completed(scheme_fingerprint) if resume else None
+        run_id = self.db.start_run(scheme_fingerprint)
+        if self.finder is not None:
+            self.finder.start_run(scheme_fingerprint)
+        submissions = self.get_submissions()
+        if resume:
+            logger.info(f'Resuming: {len(completed)} submissions already graded')
+            submissions = (s for s in submissions if s.reference not in completed)
+        return run_id, self.order_submissions(submissions, parallel)
+
+    def grade_submissions(self, resume=False):
+        """
+        Grade the submissions, yielding each submission once graded and
+        stored.
+
+        This is a generator.
+
+        :param resume: If true, submissions whose record has already been
+            stored with this marking scheme are skipped.
+        """
+        task = self.create_grading_task()
+        with ExitStack() as stack:
+            # The grader may fork processes, which is only safe before the
+            # finder, progress reporter and pipeline start their threads.
+            self.grader.start(task)
+            stack.callback(self.grader.stop)
+            run_id, submissions = self.start_run(resume)
+            total = len(submissions) if isinstance(submissions, list) else None
+            progress = self.create_progress(total)
+            if progress is not None and total is None:
+                progress.total = self.count_submissions(resume)
+            if self.metrics is not None:
+                stack.enter_context(self.collect_metrics())
+            if progress is not None:
+                stack.enter_context(progress.reporting())
+                self.grader.progress = progress
+                stack.callback(setattr, self.grader, 'progress', None)
+            yield from self.create_pipeline(submissions, progress, task)
+        self.finish_run(run_id)
+
+    def finish_run(self, run_id):
+        """
+        Finish a grading run once every submission has been graded and
+        stored.
+
+        :param run_id: Run identifier returned by :func:`start_run`.
+        """
+        self.db.finish_run(run_id)
+        if isinstance(self.cache, _cache.ResultCache):
+            self.cache.flush()
+        if self.finder is not None:
+            self.finder.finish_run()
 
     @log_calls
-    def run(self, generate=False):
+    def run(self, generate=False, resume=False):
         """
         Grade the submissions.
 
-        :param generate: If true is passed, each submission will be passed
-        to the caller via a yield. Default False.
+        :param generate: If true is passed, a generator is returned that
+            yields each submission once it has been graded. Default False.
+        :param resume: If true, submissions whose record has already been
+            stored with this marking scheme are skipped, so that an
+            interrupted run continues from where it stopped. Default False.
         """
-        grader = self.grader
-        grader.set_db(self.db)
-        linter = self.linter
-        task = self.create_grading_task()
-        for sub in self.get_submissions():
-            if linter:
-                lint_report = linter.check(sub)
-                sub.add_feedback('style', lint_report)
-            grader.submit(task, sub)
-            if generate:
-                yield sub
+        graded = self.grade_submissions(resume)
+        if generate:
+            return graded
+
+        for _ in graded:
+            pass
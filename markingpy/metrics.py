@@ -0,0 +1,407 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Timing metrics for the grading of submissions.
+
+While a :class:`Metrics` instance is active, the time taken to compile,
+lint and execute each submission and to run each test is recorded as a
+:class:`Sample`. Measurements are made with :func:`measure`, which does
+nothing when no metrics are active. Processes that grade submissions on
+behalf of the grader collect their own samples, which are sent back to
+the grader with :func:`drain`.
+
+The samples are aggregated into histograms by stage, exercise and test,
+and written as a JSON report and in the Prometheus text format.
+"""
+import json
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+try:
+    import resource
+except ImportError:
+    resource = None
+logger = logging.getLogger(__name__)
+__all__ = ['Metrics', 'Sample']
+# peak_rss is the largest resident set size the process has had since it
+# started, as reported by getrusage, rather than the memory used by the
+# measured stage alone.
+Sample = namedtuple(
+    'Sample', ('stage', 'submission', 'exercise', 'test', 'wall', 'cpu', 'peak_rss')
+)
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, float('inf')
+)
+_ACTIVE = None
+_local = threading.local()
+
+
+if hasattr(time, 'thread_time'):
+    _thread_time = time.thread_time
+elif resource is not None and hasattr(resource, 'RUSAGE_THREAD'):
+
+    def _thread_time() -> float:
+        """
+        CPU time of the current thread in seconds, for Python 3.6, which
+        does not have :func:`time.thread_time`.
+        """
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+
+else:
+    # The CPU time of the other threads is included.
+    _thread_time = time.process_time
+
+
+def _peak_rss() -> Optional[int]:
+    """
+    Peak resident set size of this process in bytes, since it started.
+    """
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Histogram:
+    """
+    Histogram of measurements with cumulative buckets.
+
+    :param buckets: Upper bounds of the buckets, in increasing order.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> List[int]:
+        total = 0
+        rv = []
+        for count in self.counts:
+            total += count
+            rv.append(total)
+        return rv
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'buckets': {
+                _format_bound(le): n for le, n in zip(self.buckets, self.cumulative())
+            },
+        }
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class Metrics:
+    """
+    Collection of timing samples.
+
+    :param buckets: Upper bounds in seconds of the histogram buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def add(self, sample: Sample):
+        with self.lock:
+            self.samples.append(sample)
+
+    def add_samples(self, samples, submission: Optional[str] = None):
+        """
+        Add samples collected in another process.
+
+        :param samples: Iterable of :class:`Sample`.
+        :param submission: Reference of the submission the samples belong
+            to, if they were recorded without one.
+        """
+        if submission is not None:
+            samples = [
+                s._replace(submission=submission) if s.submission is None else s
+                for s in samples
+            ]
+        with self.lock:
+            self.samples.extend(samples)
+
+    def drain(self) -> List[Sample]:
+        """
+        Remove and return the samples collected so far.
+        """
+        with self.lock:
+            samples, self.samples = self.samples, []
+        return samples
+
+    def histograms(self, keys=('stage', 'exercise', 'test')) -> Dict[tuple, dict]:
+        """
+        Aggregate the samples into histograms.
+
+        :param keys: Fields of :class:`Sample` to group the samples by.
+        :return: dict mapping groups to dicts containing histograms of the
+            wall and CPU time, and the peak RSS.
+        """
+        groups = {}
+        with self.lock:
+            samples = list(self.samples)
+        for sample in samples:
+            key = tuple(getattr(sample, k) for k in keys)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    'wall': Histogram(self.buckets),
+                    'cpu': Histogram(self.buckets),
+                    'peak_rss': None,
+                }
+            group['wall'].add(sample.wall)
+            group['cpu'].add(sample.cpu)
+            if sample.peak_rss is not None:
+                group['peak_rss'] = max(group['peak_rss'] or 0, sample.peak_rss)
+        return groups
+
+    def report(self) -> dict:
+        """
+        Create a report of the samples.
+
+        Stages are summarised by stage, and tests by exercise and test,
+        with the tests taking the most time in total first. The total time
+        taken by each stage is also given for each submission.
+        """
+        stages = {
+            stage: self._summary(group)
+            for (stage,), group in self.histograms(('stage',)).items()
+        }
+        tests = [
+            dict(exercise=exercise, test=test, **self._summary(group))
+            for (stage, exercise, test), group in self.histograms().items()
+            if stage == 'test'
+        ]
+        tests.sort(key=lambda t: t['wall']['sum'], reverse=True)
+        submissions = {}
+        with self.lock:
+            samples = list(self.samples)
+        for sample in samples:
+            if sample.submission is None:
+                continue
+
+            stages_for_sub = submissions.setdefault(sample.submission, {})
+            stages_for_sub[sample.stage] = (
+                stages_for_sub.get(sample.stage, 0.0) + sample.wall
+            )
+        return {'stages': stages, 'tests': tests, 'submissions': submissions}
+
+    @staticmethod
+    def _summary(group: dict) -> dict:
+        return {
+            'wall': group['wall'].as_dict(),
+            'cpu': group['cpu'].as_dict(),
+            'peak_rss': group['peak_rss'],
+        }
+
+    def prometheus(self) -> str:
+        """
+        Format the histograms in the Prometheus text exposition format.
+        """
+        groups = self.histograms()
+        lines = []
+        metrics = (
+            ('wall', 'markingpy_wall_seconds', 'Wall-clock time'),
+            ('cpu', 'markingpy_cpu_seconds', 'CPU time'),
+        )
+        for field, name, descr in metrics:
+            lines.append(f'# HELP {name} {descr} by grading stage, exercise and test.')
+            lines.append(f'# TYPE {name} histogram')
+            for key, group in groups.items():
+                hist = group[field]
+                labels = _format_labels(key)
+                for le, count in zip(hist.buckets, hist.cumulative()):
+                    le_label = f'le="{_format_bound(le)}"'
+                    sep = ',' if labels else ''
+                    lines.append(f'{name}_bucket{{{labels}{sep}{le_label}}} {count}')
+                lines.append(f'{name}_sum{{{labels}}} {hist.sum!r}')
+                lines.append(f'{name}_count{{{labels}}} {hist.count}')
+        name = 'markingpy_peak_rss_bytes'
+        lines.append(
+            f'# HELP {name} Peak resident set size of the grading process'
+            ' since it started.'
+        )
+        lines.append(f'# TYPE {name} gauge')
+        for key, group in groups.items():
+            if group['peak_rss'] is not None:
+                lines.append(f'{name}{{{_format_labels(key)}}} {group["peak_rss"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: Union[str, Path]):
+        """
+        Write the JSON report to *path* with the suffix ``.json`` and the
+        Prometheus text to *path* with the suffix ``.prom``.
+        """
+        path = Path(path).expanduser()
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        path.with_suffix('.json').write_text(json.dumps(self.report(), indent=2))
+        path.with_suffix('.prom').write_text(self.prometheus())
+        logger.info(f'Metrics written to {path}')
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: tuple) -> str:
+    names = ('stage', 'exercise', 'test')
+    return ','.join(
+        f'{name}="{_escape(str(value))}"'
+        for name, value in zip(names, key)
+        if value is not None
+    )
+
+
+def activate(metrics: Optional[Metrics]):
+    """
+    Set the metrics that measurements in this process are added to.
+
+    :param metrics: :class:`Metrics` instance, or None to stop measuring.
+    """
+    global _ACTIVE
+    _ACTIVE = metrics
+
+
+def active() -> Optional[Metrics]:
+    return _ACTIVE
+
+
+def drain() -> List[Sample]:
+    """
+    Remove and return the samples collected by the active metrics.
+    """
+    if _ACTIVE is None:
+        return []
+
+    return _ACTIVE.drain()
+
+
+@contextmanager
+def collecting(metrics: Optional[Metrics]):
+    """
+    Context manager that activates *metrics* for its duration.
+    """
+    previous = _ACTIVE
+    activate(metrics)
+    try:
+        yield metrics
+
+    finally:
+        activate(previous)
+
+
+@contextmanager
+def submission(reference: str):
+    """
+    Context manager that labels the measurements made in this thread with
+    the reference of a submission.
+    """
+    previous = getattr(_local, 'submission', None)
+    _local.submission = reference
+    try:
+        yield
+
+    finally:
+        _local.submission = previous
+
+
+@contextmanager
+def _measure(metrics, stage, submission, exercise, test):
+    wall = time.perf_counter()
+    cpu = _thread_time()
+    try:
+        yield
+
+    finally:
+        if submission is None:
+            submission = getattr(_local, 'submission', None)
+        metrics.add(
+            Sample(
+                stage,
+                submission,
+                exercise,
+                test,
+                time.perf_counter() - wall,
+                _thread_time() - cpu,
+                _peak_rss(),
+            )
+        )
+
+
+class _NullContext:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+def measure(
+    stage: str,
+    submission: Optional[str] = None,
+    exercise: Optional[str] = None,
+    test: Optional[str] = None,
+):
+    """
+    Context manager that measures the wall-clock time and CPU time of the
+    current thread for a stage of grading, if metrics are active. The peak
+    RSS of the process since it started is recorded with the times, so it
+    includes the memory used before the stage.
+
+    :param stage: Name of the stage, such as 'compile' or 'test'.
+    :param submission: Reference of the submission. Defaults to the
+        submission set with :func:`submission`.
+    :param exercise: Name of the exercise.
+    :param test: Name of the test.
+    """
+    metrics = _ACTIVE
+    if metrics is None:
+        return _NULL_CONTEXT
+
+    return _measure(metrics, stage, submission, exercise, test)
@@ -0,0 +1,279 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Concurrent pipeline for processing a stream of items in stages.
+
+Each stage of a :class:`Pipeline` runs on its own threads, and stages are
+connected by bounded queues. While one item is being processed by a stage,
+the items behind it are processed by the earlier stages, and a slow stage
+holds back the stages before it rather than letting items pile up in
+memory.
+"""
+import logging
+import queue
+import threading
+from collections import deque
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+__all__ = ['Pipeline']
+_DONE = object()
+_POLL_INTERVAL = 0.1
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _Stage:
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        workers: int,
+        stream: bool,
+        bypass: Optional[Callable[[Any], bool]],
+    ):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.stream = stream
+        self.bypass = bypass
+        self.running = workers
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    """
+    Run a stream of items through a sequence of stages concurrently.
+
+    Stages are added with :func:`add_stage` or :func:`add_stream_stage`,
+    and the pipeline is run by iterating over it, which yields the items
+    that come out of the last stage. Items are only kept in order if every
+    stage has a single worker and preserves order. An exception raised in
+    any stage stops the pipeline and is raised to the caller.
+
+    :param source: Iterable of items to process.
+    :param maxsize: Maximum number of items waiting between two stages.
+    :param threaded: If false, the stages run one after another on the
+        thread that iterates over the pipeline, for stages that change
+        process-wide state such as :data:`sys.stdout`. Default True.
+    """
+
+    def __init__(self, source: Iterable, maxsize: int = 8, threaded: bool = True):
+        self.source = source
+        self.maxsize = maxsize
+        self.threaded = threaded
+        self.stages = []
+        self.stop = threading.Event()
+        self.error = None
+
+    def add_stage(
+        self,
+        name: str,
+        func: Callable[[Any], Any],
+        workers: int = 1,
+        bypass: Optional[Callable[[Any], bool]] = None,
+    ):
+        """
+        Add a stage that applies a function to each item.
+
+        :param name: Name of the stage.
+        :param func: Function called with each item, returning the item to
+            pass to the next stage.
+        :param workers: Number of threads running the stage.
+        :param bypass: Predicate for items that should skip this stage.
+        """
+        self.stages.append(_Stage(name, func, max(1, workers), False, bypass))
+
+    def add_stream_stage(
+        self,
+        name: str,
+        func: Callable[[Iterable], Iterable],
+        bypass: Optional[Callable[[Any], bool]] = None,
+    ):
+        """
+        Add a stage that transforms the stream of items.
+
+        This is used for stages that manage their own concurrency, such as
+        a grader. The stage runs on a single thread.
+
+        :param name: Name of the stage.
+        :param func: Function taking an iterable of items and returning an
+            iterable of items for the next stage.
+        :param bypass: Predicate for items that should skip this stage.
+        """
+        self.stages.append(_Stage(name, func, 1, True, bypass))
+
+    def _get(self, q: queue.Queue) -> Any:
+        while True:
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                if self.stop.is_set():
+                    raise _Stopped
+
+    def _put(self, q: queue.Queue, item: Any):
+        while True:
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return
+
+            except queue.Full:
+                if self.stop.is_set():
+                    raise _Stopped
+
+    def _feed(self, stage: _Stage, in_q: queue.Queue, out_q: queue.Queue) -> Iterator:
+        while True:
+            item = self._get(in_q)
+            if item is _DONE:
+                # Leave the marker for the other workers in this stage.
+                self._put(in_q, _DONE)
+                return
+
+            if stage.bypass is not None and stage.bypass(item):
+                self._put(out_q, item)
+            else:
+                yield item
+
+    def _run_source(self, out_q: queue.Queue):
+        for item in self.source:
+            self._put(out_q, item)
+        self._put(out_q, _DONE)
+
+    def _run_stage(self, stage: _Stage, in_q: queue.Queue, out_q: queue.Queue):
+        items = self._feed(stage, in_q, out_q)
+        if stage.stream:
+            results = stage.func(items)
+            try:
+                for result in results:
+                    self._put(out_q, result)
+            finally:
+                close = getattr(results, 'close', None)
+                if close is not None:
+                    close()
+        else:
+            for item in items:
+                self._put(out_q, stage.func(item))
+        with stage.lock:
+            stage.running -= 1
+            last = not stage.running
+        if last:
+            self._put(out_q, _DONE)
+
+    def _target(self, name: str, func: Callable, *args: Any) -> Callable:
+
+        def target():
+            # noinspection PyBroadException
+            try:
+                func(*args)
+            except _Stopped:
+                pass
+            except BaseException as err:
+                logger.debug(f'Pipeline stage {name} failed: {err}')
+                if self.error is None:
+                    self.error = err
+                self.stop.set()
+
+        return target
+
+    @staticmethod
+    def _apply(stage: _Stage, items: Iterable) -> Iterator:
+        """
+        Run a stage on the items on the current thread.
+        """
+        bypass = stage.bypass
+        if not stage.stream:
+            for item in items:
+                yield item if bypass is not None and bypass(item) else stage.func(item)
+            return
+
+        if bypass is None:
+            yield from stage.func(items)
+            return
+
+        # Items that skip the stage are held until the stage yields its next
+        # item, so they may come out later than in a threaded pipeline.
+        bypassed = deque()
+
+        def feed():
+            for item in items:
+                if bypass(item):
+                    bypassed.append(item)
+                else:
+                    yield item
+
+        for result in stage.func(feed()):
+            while bypassed:
+                yield bypassed.popleft()
+            yield result
+        while bypassed:
+            yield bypassed.popleft()
+
+    def __iter__(self) -> Iterator:
+        if not self.threaded:
+            items = iter(self.source)
+            for stage in self.stages:
+                items = self._apply(stage, items)
+            yield from items
+            return
+
+        queues = [queue.Queue(self.maxsize) for _ in range(len(self.stages) + 1)]
+        threads = [
+            threading.Thread(
+                target=self._target('source', self._run_source, queues[0]),
+                daemon=True,
+            )
+        ]
+        for i, stage in enumerate(self.stages):
+            target = self._target(
+                stage.name, self._run_stage, stage, queues[i], queues[i + 1]
+            )
+            threads.extend(
+                threading.Thread(
+                    target=target, name=f'{stage.name}-{n}', daemon=True
+                )
+                for n in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+        completed = False
+        try:
+            while True:
+                try:
+                    item = self._get(queues[-1])
+                except _Stopped:
+                    break
+
+                if item is _DONE:
+                    break
+
+                yield item
+
+            if self.error is not None:
+                raise self.error
+
+            completed = True
+        finally:
+            self.stop.set()
+            # Each stage stops once it has finished its current item, so
+            # nothing is processed after the pipeline has been closed. The
+            # source might be waiting for its next item, so it is only
+            # joined once it is exhausted.
+            for thread in threads if completed else threads[1:]:
+                thread.join()
@@ -0,0 +1,237 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Progress reporting for grading runs.
+
+The grader tells a :class:`Progress` instance when it starts and finishes
+grading each submission, and on which worker, and the grading pipeline
+tells it when each submission has been stored. While a run is in progress,
+the status is reported periodically by each of the reporters, which
+either rewrite a progress line on a terminal or a JSON status file.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Hashable, Optional, TextIO, Union
+
+logger = logging.getLogger(__name__)
+__all__ = ['Progress', 'TTYReporter', 'JSONReporter']
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '?'
+
+    seconds = int(seconds)
+    if seconds < 60:
+        return f'{seconds}s'
+
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f'{minutes}m{seconds:02d}s'
+
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m'
+
+
+class TTYReporter:
+    """
+    Report progress by rewriting a single line on a terminal.
+
+    :param stream: Stream to write to. Defaults to standard error.
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        self.stream = stream if stream is not None else sys.stderr
+        self.width = 0
+
+    def format(self, status: Dict[str, Any]) -> str:
+        total = status['total']
+        done = f"{status['completed']}/{total}" if total else str(status['completed'])
+        parts = [
+            f'Graded {done}',
+            f"{status['rate']:.2f} subs/s",
+            f"avg {status['average']:.2f}s" if status['average'] else 'avg ?',
+            f"ETA {_format_duration(status['eta'])}",
+        ]
+        workers = status['workers']
+        if workers:
+            slowest = max(workers, key=lambda w: w['running_for'])
+            parts.append(
+                f"{len(workers)} busy, longest {slowest['submission']}"
+                f" ({_format_duration(slowest['running_for'])})"
+            )
+        return ' | '.join(parts)
+
+    def report(self, status: Dict[str, Any], final: bool = False):
+        line = self.format(status)
+        padding = ' ' * max(0, self.width - len(line))
+        self.width = len(line)
+        self.stream.write(f'\r{line}{padding}')
+        if final:
+            self.stream.write('\n')
+        self.stream.flush()
+
+
+class JSONReporter:
+    """
+    Report progress by rewriting a JSON status file.
+
+    The file is replaced atomically, so readers never see a partly
+    written status.
+
+    :param path: Path of the status file.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path).expanduser()
+
+    def report(self, status: Dict[str, Any], final: bool = False):
+        tmp = self.path.with_name(f'.{self.path.name}.tmp')
+        tmp.write_text(json.dumps(dict(status, finished=final), indent=2))
+        os.replace(tmp, self.path)
+
+
+class Progress:
+    """
+    Track the progress of a grading run.
+
+    :param total: Total number of submissions, if known.
+    :param reporters: Reporters used to report the status.
+    :param interval: Time in seconds between reports.
+    :param window: Number of recent submissions used to compute the
+        rolling average time per submission and the rate of completion.
+    """
+
+    def __init__(
+        self,
+        total: Optional[int] = None,
+        reporters=(),
+        interval: float = 1.0,
+        window: int = 50,
+    ):
+        self.total = total
+        self.reporters = list(reporters)
+        self.interval = interval
+        self.durations = deque(maxlen=window)
+        self.completed = 0
+        self.started = time.monotonic()
+        # Times at which the most recent submissions were completed, and
+        # the time the window starts from.
+        self.completions = deque(maxlen=window)
+        self.window_start = self.started
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def start(self, worker: Hashable, reference: str):
+        """
+        Called by the grader when a worker starts grading a submission.
+        """
+        with self.lock:
+            self.workers[worker] = (reference, time.monotonic())
+
+    def finish(self, worker: Hashable, reference: str):
+        """
+        Called by the grader when a worker finishes grading a submission.
+        """
+        with self.lock:
+            current = self.workers.get(worker)
+            if current is not None and current[0] == reference:
+                del self.workers[worker]
+                self.durations.append(time.monotonic() - current[1])
+
+    def complete(self, reference: str):
+        """
+        Called when a submission has been graded and stored.
+        """
+        with self.lock:
+            self.completed += 1
+            completions = self.completions
+            if len(completions) == completions.maxlen:
+                self.window_start = completions.popleft()
+            completions.append(time.monotonic())
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the current status of the run.
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.started
+            completed = self.completed
+            span = now - self.window_start
+            rate = len(self.completions) / span if span > 0 else 0.0
+            average = (
+                sum(self.durations) / len(self.durations) if self.durations else None
+            )
+            eta = None
+            if self.total is not None and rate > 0:
+                eta = max(0, self.total - completed) / rate
+            workers = [
+                {
+                    'worker': str(worker),
+                    'submission': reference,
+                    'running_for': now - started,
+                }
+                for worker, (reference, started) in self.workers.items()
+            ]
+        return {
+            'completed': completed,
+            'total': self.total,
+            'elapsed': elapsed,
+            'rate': rate,
+            'average': average,
+            'eta': eta,
+            'workers': workers,
+        }
+
+    def report(self, final: bool = False):
+        status = self.status()
+        for reporter in self.reporters:
+            # noinspection PyBroadException
+            try:
+                reporter.report(status, final)
+            except Exception:
+                logger.warning('Progress reporter failed', exc_info=True)
+
+    @contextmanager
+    def reporting(self):
+        """
+        Context manager that reports the status periodically on a
+        background thread, and once more when it exits.
+        """
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(self.interval):
+                self.report()
+
+        thread = threading.Thread(target=run, name='progress', daemon=True)
+        thread.start()
+        try:
+            yield self
+
+        finally:
+            stop.set()
+            thread.join()
+            self.report(final=True)
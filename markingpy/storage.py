@@ -20,11 +20,31 @@ import abc
 import sqlite3
 import atexit
 import logging
+import threading
+import time
+import uuid
+import weakref
+from pathlib import Path
 
 from .grader import Record
 
 logger = logging.getLogger(__name__)
 __all__ = ['StorageABC', 'SQLiteDB']
+SUBMISSION_COLUMNS = (
+    'submission_id', 'percentage', 'feedback', 'markscheme_id', 'run_id', 'state'
+)
+RESULT_COLUMNS = {
+    'exercise_results': ('submission_id', 'exercise', 'marks', 'total_marks'),
+    'test_results': (
+        'submission_id', 'exercise', 'test_index', 'test', 'marks', 'passed', 'runtime'
+    ),
+}
+INDEXES = {
+    'submissions_by_scheme': 'submissions (markscheme_id, state)',
+    'submissions_by_run': 'submissions (run_id)',
+    'exercise_results_by_exercise': 'exercise_results (exercise, marks)',
+    'test_results_by_test': 'test_results (exercise, test_index, passed)',
+}
 
 
 class StorageABC(abc.ABC):
@@ -57,6 +77,65 @@ class StorageABC(abc.ABC):
         :return:
         """
 
+    def start_run(self, markscheme_id):
+        """
+        Start a grading run. Records added until the next run is started
+        belong to this run.
+
+        :param markscheme_id: Fingerprint of the marking scheme.
+        :return: Identifier of the run.
+        """
+        return uuid.uuid4().hex
+
+    def finish_run(self, run_id):
+        """
+        Mark a grading run as finished.
+        """
+
+    def get_completed(self, markscheme_id):
+        """
+        Get the submissions whose record has been stored with a marking
+        scheme. The default implementation does not track runs, so runs
+        cannot be resumed.
+
+        :param markscheme_id: Fingerprint of the marking scheme.
+        :return: set of submission references.
+        """
+        raise NotImplementedError(
+            f'{type(self).__name__} does not record the marking scheme of each'
+            ' submission, so a run cannot be resumed. Use a SQLiteDB.'
+        )
+
+    def add_runtime(self, record_id, runtime, size):
+        """
+        Record the time taken to grade a submission. The default
+        implementation does not store runtimes.
+
+        :param record_id: Reference of the submission.
+        :param runtime: Time in seconds taken to grade the submission.
+        :param size: Size of the submission source.
+        """
+
+    def get_runtimes(self):
+        """
+        Get the recorded runtimes.
+
+        :return: dict mapping submission references to (runtime, size)
+            pairs.
+        """
+        return {}
+
+    def add_results(self, record_id, results):
+        """
+        Record the marks obtained by a submission in each exercise and
+        test. The default implementation does not store results.
+
+        :param record_id: Reference of the submission.
+        :param results: List of (exercise, marks, total_marks, tests)
+            tuples, where tests is a list of (test, marks, passed, runtime)
+            tuples in the order of the tests in the exercise.
+        """
+
 
 class CSVStorageDB(StorageABC):
     """
@@ -116,15 +195,60 @@ class CSVStorageDB(StorageABC):
 
 
 class SQLiteDB(StorageABC):
+    """
+    Store records in a SQLite database.
+
+    Besides the record of each submission, the marks obtained in each
+    exercise and the marks, outcome and runtime of each test are stored in
+    the exercise_results and test_results tables, which are indexed by
+    exercise and test for queries over the whole cohort.
+
+    The database is used in WAL mode, and records and runtimes are
+    buffered and written in batches, each in a single transaction. A batch
+    is written once it holds *batch_size* entries or the oldest entry has
+    waited *flush_interval* seconds, before the database is read, when a
+    run finishes, and when the database is closed, which happens at exit
+    if not before. A closed database cannot be used again.
+
+    :param path: Path of the database file.
+    :param batch_size: Maximum number of entries buffered. Default 100.
+    :param flush_interval: Maximum time in seconds an entry is buffered.
+        Default 1.0.
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, batch_size=100, flush_interval=1.0):
         self.path = path
         parent = path.parent
         if not parent.exists():
             logger.debug(f"Creating directory {parent}")
             parent.mkdir(parents=True)
-        self.db = db = sqlite3.connect(str(path))
-        atexit.register(db.close)
+        # Records are written from the store stage of the grading pipeline,
+        # which runs on a separate thread.
+        self.db = db = sqlite3.connect(str(path), check_same_thread=False)
+        db.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode, NORMAL only syncs at checkpoints and stays consistent.
+        db.execute("PRAGMA synchronous = NORMAL")
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.pending_records = []
+        self.pending_runtimes = []
+        self.pending_results = []
+        self.lock = threading.RLock()
+        self.timer = None
+        self.closed = False
+        # The hook only holds a weak reference, so that registering it does
+        # not keep the database alive.
+        ref = weakref.ref(self)
+
+        def close_at_exit():
+            db = ref()
+            if db is not None:
+                db.close()
+
+        self.close_at_exit = close_at_exit
+        atexit.register(close_at_exit)
+        self.run_id = None
+        self.markscheme_id = None
         self.create_table()
 
     def create_table(self):
@@ -133,24 +257,219 @@ class SQLiteDB(StorageABC):
             " submission_id text primary key,"
             " percentage int,"
             " feedback text,"
-            " markscheme_id text"
+            " markscheme_id text,"
+            " run_id text,"
+            " state text"
             ");"
         )
+        # Add the columns missing from databases created by older versions.
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(submissions)")}
+        for column in ('run_id', 'state'):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE submissions ADD COLUMN {column} text")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " run_id text primary key,"
+            " markscheme_id text,"
+            " started real,"
+            " finished real"
+            ");"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS runtimes ("
+            " submission_id text primary key,"
+            " runtime real,"
+            " size int"
+            ");"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS exercise_results ("
+            " submission_id text,"
+            " exercise text,"
+            " marks real,"
+            " total_marks real,"
+            " primary key (submission_id, exercise)"
+            ");"
+        )
+        # Tests are identified by their position, since test names need not
+        # be unique within an exercise.
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS test_results ("
+            " submission_id text,"
+            " exercise text,"
+            " test_index int,"
+            " test text,"
+            " marks real,"
+            " passed int,"
+            " runtime real,"
+            " primary key (submission_id, exercise, test_index)"
+            ");"
+        )
+        for name, definition in INDEXES.items():
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
         self.db.commit()
 
+    def check_open(self):
+        """
+        Raise an error if the database has been closed.
+        """
+        if self.closed:
+            raise RuntimeError(f"Marks database {self.path} is closed")
+
     def add_record(self, record):
-        self.db.execute(
-            "INSERT OR REPLACE INTO"
-            " submissions ("
-            " submission_id,"
-            " percentage,"
-            " feedback,"
-            ") VALUES (?, ?, ?)",
-            (record.id, record.score, record.feedback),
+        # The record and its state are written in a single statement, so a
+        # record is either stored completely and marked done, or not at all.
+        with self.lock:
+            self.check_open()
+            self.pending_records.append(
+                (
+                    record.id,
+                    record.score,
+                    record.feedback,
+                    self.markscheme_id,
+                    self.run_id,
+                )
+            )
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        """
+        Flush the buffered entries if the batch is full, or start a timer
+        that flushes them after the flush interval.
+        """
+        pending = (
+            len(self.pending_records)
+            + len(self.pending_runtimes)
+            + len(self.pending_results)
         )
-        self.db.commit()
+        if pending >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = timer = threading.Timer(self.flush_interval, self.flush_later)
+            timer.daemon = True
+            timer.start()
+
+    def flush_later(self):
+        """
+        Flush the buffered entries when the flush timer expires, unless the
+        database has been closed in the meantime.
+        """
+        with self.lock:
+            if not self.closed:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records, runtimes and results in a single
+        transaction.
+        """
+        with self.lock:
+            self.check_open()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending = self.pending_records, self.pending_runtimes, self.pending_results
+            if not any(pending):
+                return
+
+            with self.db:
+                self.write_results(self.pending_results)
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO"
+                    " submissions ("
+                    " submission_id,"
+                    " percentage,"
+                    " feedback,"
+                    " markscheme_id,"
+                    " run_id,"
+                    " state"
+                    ") VALUES (?, ?, ?, ?, ?, 'done')",
+                    self.pending_records,
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO runtimes (submission_id, runtime, size)"
+                    " VALUES (?, ?, ?)",
+                    self.pending_runtimes,
+                )
+            self.pending_records = []
+            self.pending_runtimes = []
+            self.pending_results = []
+
+    def write_results(self, pending):
+        """
+        Replace the results of the submissions in *pending*, a list of
+        (record_id, results) pairs as passed to :func:`add_results`.
+        """
+        # Only the latest results of a submission graded twice are kept.
+        pending = dict(pending)
+        refs = [(ref,) for ref in pending]
+        exercise_rows = []
+        test_rows = []
+        for ref, results in pending.items():
+            for exercise, marks, total_marks, tests in results:
+                exercise_rows.append((ref, exercise, marks, total_marks))
+                test_rows.extend(
+                    (ref, exercise, index, test, test_marks, passed, runtime)
+                    for index, (test, test_marks, passed, runtime) in enumerate(tests)
+                )
+        for table, rows in (
+            ('exercise_results', exercise_rows), ('test_results', test_rows)
+        ):
+            columns = RESULT_COLUMNS[table]
+            self.db.executemany(f"DELETE FROM {table} WHERE submission_id = ?", refs)
+            self.db.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)})"
+                f" VALUES ({', '.join('?' * len(columns))})",
+                rows,
+            )
+
+    def close(self):
+        """
+        Flush the buffered entries and close the database.
+        """
+        with self.lock:
+            if self.closed:
+                return
+
+            try:
+                self.flush()
+            finally:
+                self.db.close()
+                self.closed = True
+        atexit.unregister(self.close_at_exit)
+
+    def start_run(self, markscheme_id):
+        run_id = uuid.uuid4().hex
+        with self.lock:
+            self.check_open()
+            self.db.execute(
+                "INSERT INTO runs (run_id, markscheme_id, started) VALUES (?, ?, ?)",
+                (run_id, markscheme_id, time.time()),
+            )
+            self.db.commit()
+            self.run_id = run_id
+            self.markscheme_id = markscheme_id
+        return run_id
+
+    def finish_run(self, run_id):
+        with self.lock:
+            self.flush()
+            self.db.execute(
+                "UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), run_id)
+            )
+            self.db.commit()
+
+    def get_completed(self, markscheme_id):
+        self.flush()
+        cur = self.db.execute(
+            "SELECT submission_id FROM submissions"
+            " WHERE markscheme_id = ? AND state = 'done'",
+            (markscheme_id,),
+        )
+        return {ref for ref, in cur}
 
     def get_record(self, record_id):
+        self.flush()
         cur = self.db.execute(
             "SELECT submission_id, percentage, feedback"
             " FROM submissions WHERE"
@@ -160,11 +479,145 @@ class SQLiteDB(StorageABC):
         return cur.fetchone()
 
     def get_all(self):
+        self.flush()
         cur = self.db.execute(
             "SELECT submission_id, percentage, feedback" " FROM submissions"
         )
         return cur.fetchall()
 
+    def add_runtime(self, record_id, runtime, size):
+        with self.lock:
+            self.check_open()
+            self.pending_runtimes.append((record_id, runtime, size))
+            self.schedule_flush()
+
+    def get_runtimes(self):
+        self.flush()
+        cur = self.db.execute("SELECT submission_id, runtime, size FROM runtimes")
+        return {ref: (runtime, size) for ref, runtime, size in cur}
+
+    def add_results(self, record_id, results):
+        with self.lock:
+            self.check_open()
+            self.pending_results.append((record_id, results))
+            self.schedule_flush()
+
+    def get_pass_rates(self, exercise=None):
+        """
+        Get the proportion of the graded submissions that passed each test.
+
+        :param exercise: Name of the exercise whose tests are included.
+            Defaults to all exercises.
+        :return: dict mapping (exercise, test index, test name) to the pass
+            rate, as a fraction.
+        """
+        self.flush()
+        query = "SELECT exercise, test_index, test, AVG(passed) FROM test_results"
+        params = ()
+        if exercise is not None:
+            query += " WHERE exercise = ?"
+            params = (exercise,)
+        query += " GROUP BY exercise, test_index, test"
+        cur = self.db.execute(query, params)
+        return {(ex, index, test): rate for ex, index, test, rate in cur}
+
+    def merge(self, path, overwrite=False):
+        """
+        Merge the records of another marks database into this one.
+
+        The other database is attached to this one and its records are
+        copied with a single statement for each table. A submission that
+        has records in both databases with a different percentage or
+        feedback is a conflict, and the record in this database is kept,
+        along with its exercise and test results, unless *overwrite* is
+        true.
+
+        :param path: Path of the database to merge.
+        :param overwrite: Replace conflicting records with those in the
+            other database.
+        :return: List of the references of conflicting submissions.
+        """
+        if not Path(path).is_file():
+            raise FileNotFoundError(f"No marks database at {path}")
+
+        self.flush()
+        db = self.db
+        db.execute("ATTACH DATABASE ? AS other", (str(path),))
+        try:
+            tables = {
+                name for name, in db.execute(
+                    "SELECT name FROM other.sqlite_master WHERE type = 'table'"
+                )
+            }
+            if 'submissions' not in tables:
+                raise ValueError(f"{path} is not a marks database")
+
+            conflicts = [
+                ref for ref, in db.execute(
+                    "SELECT o.submission_id"
+                    " FROM other.submissions AS o"
+                    " JOIN main.submissions AS m USING (submission_id)"
+                    " WHERE o.percentage IS NOT m.percentage"
+                    " OR o.feedback IS NOT m.feedback"
+                )
+            ]
+            # Databases created by older versions lack some columns.
+            columns = {
+                row[1] for row in db.execute("PRAGMA other.table_info(submissions)")
+            }
+            select = ", ".join(
+                c if c in columns else "NULL" for c in SUBMISSION_COLUMNS
+            )
+            action = "REPLACE" if overwrite else "IGNORE"
+            with db:
+                for table, columns in RESULT_COLUMNS.items():
+                    if table in tables:
+                        self.merge_results(table, columns, overwrite)
+                db.execute(
+                    f"INSERT OR {action} INTO main.submissions"
+                    f" ({', '.join(SUBMISSION_COLUMNS)})"
+                    f" SELECT {select} FROM other.submissions"
+                )
+                if 'runs' in tables:
+                    db.execute(
+                        "INSERT OR IGNORE INTO main.runs"
+                        " (run_id, markscheme_id, started, finished)"
+                        " SELECT run_id, markscheme_id, started, finished"
+                        " FROM other.runs"
+                    )
+                if 'runtimes' in tables:
+                    db.execute(
+                        f"INSERT OR {action} INTO main.runtimes"
+                        " (submission_id, runtime, size)"
+                        " SELECT submission_id, runtime, size FROM other.runtimes"
+                    )
+        finally:
+            db.execute("DETACH DATABASE other")
+        return conflicts
+
+    def merge_results(self, table, columns, overwrite):
+        """
+        Copy the results in *table* of the attached database, keeping the
+        results of the submissions whose records are kept by :func:`merge`.
+        Must be called before the records are copied.
+        """
+        columns = ', '.join(columns)
+        if overwrite:
+            self.db.execute(
+                f"DELETE FROM main.{table} WHERE submission_id IN"
+                " (SELECT submission_id FROM other.submissions)"
+            )
+            condition = ""
+        else:
+            condition = (
+                " WHERE submission_id NOT IN"
+                " (SELECT submission_id FROM main.submissions)"
+            )
+        self.db.execute(
+            f"INSERT OR REPLACE INTO main.{table} ({columns})"
+            f" SELECT {columns} FROM other.{table}{condition}"
+        )
+
 
 def write_csv(
     store_path, submissions, id_heading="Submission ID", score_heading="Score"
@@ -17,10 +17,11 @@
 import os
 import logging
 from collections import namedtuple
-from typing import TYPE_CHECKING, Any
+from typing import TYPE_CHECKING, Any, Optional
 
 if TYPE_CHECKING:
     from types import CodeType
+    from .cache import CodeCache
 from .compiler import Compiler
 from .utils import log_calls
 
@@ -40,14 +41,32 @@ class Submission:
         self.code = None
         self.score = None
         self.percentage = 0
+        self.record = None
+        self.cached = False
+        self.exercise_results = {}
+        # Number of exercise results restored from the result cache.
+        self.cached_exercises = 0
+        self.runtime = None
         self.feedback = {}
 
     @log_calls
-    def compile(self) -> 'CodeType':
+    def compile(self, cache: Optional['CodeCache'] = None) -> 'CodeType':
         """
         Compile the submission source code.
+
+        :param cache: :class:`markingpy.CodeCache` in which compiled
+            submissions are looked up and stored.
         """
         if not self.code:
+            flags = (self.compiler.filename, self.compiler.mode)
+            compiled = None
+            if cache is not None:
+                compiled = cache.get(self.raw_source, flags)
+            if compiled is not None:
+                self.source, self.code, feedback = compiled
+                self.add_feedback("compilation", feedback)
+                return self.code
+
             self.source, self.code = self.compiler(self.raw_source)
             if self.compiler.removed_chunks:
                 feedback = "\n".join(
@@ -59,6 +78,8 @@ class Submission:
             else:
                 feedback = "No compilation errors found."
             self.add_feedback("compilation", feedback)
+            if cache is not None:
+                cache.put(self.raw_source, (self.source, self.code, feedback), flags)
         return self.code
 
     @log_calls
@@ -69,7 +69,7 @@ def mark_scheme(**params: Any) -> markscheme.MarkingScheme:
     if _MARKSCHEME is None:
         conf = dict(config.GLOBAL_CONF["markscheme"])
         if 'marks_db' in conf:
-            conf['marks_db'] = storage.SQLiteDB(Path(conf['marks_db']))
+            conf['marks_db'] = storage.SQLiteDB(Path(conf['marks_db']).expanduser())
         conf.update(**params)
         marking_scheme = markscheme.MarkingScheme(**conf)
         _MARKSCHEME = marking_scheme
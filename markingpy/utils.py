@@ -20,11 +20,14 @@ Utilities for the MarkingPy package.
 """
 
 import ast
+import hashlib
 import logging
+import types
 import typing
 from contextlib import contextmanager
 from functools import wraps
 from inspect import isfunction, Signature, Parameter, stack
+from math import ceil
 from time import time
 
 from typing import ( Any, Set, Callable, Dict, Tuple, ContextManager)
@@ -49,6 +52,7 @@ __all__ = [
     'time_run',
     'str_format_args',
     'TestCaseFunction',
+    'fingerprint',
 ]
 POS_OR_KW = Parameter.POSITIONAL_OR_KEYWORD
 
@@ -191,6 +195,131 @@ def time_run(func: Callable, args: ARGS, kwargs: KWARGS) -> float:
     return runtime
 
 
+def _fingerprint_repr(item: Any, seen: frozenset = frozenset()) -> str:
+    """
+    Representation of an item that does not depend on memory addresses for
+    functions, classes and code objects.
+    """
+    if id(item) in seen:
+        return '<recursion>'
+
+    seen = seen | {id(item)}
+    if isinstance(item, types.CodeType):
+        consts = tuple(_fingerprint_repr(c, seen) for c in item.co_consts)
+        return repr((item.co_code, consts, item.co_names))
+
+    if isinstance(item, (types.FunctionType, types.MethodType)):
+        func = getattr(item, '__func__', item)
+        closure = tuple(
+            _fingerprint_repr(cell.cell_contents, seen)
+            for cell in func.__closure__ or ()
+        )
+        return repr(
+            (
+                func.__qualname__,
+                _fingerprint_repr(func.__code__, seen),
+                _fingerprint_repr(func.__defaults__, seen),
+                closure,
+            )
+        )
+
+    if isinstance(item, type):
+        attrs = sorted(
+            (name, _fingerprint_repr(value, seen))
+            for name, value in vars(item).items()
+            if isinstance(value, (types.FunctionType, classmethod, staticmethod))
+        )
+        return repr((item.__qualname__, attrs))
+
+    if isinstance(item, (classmethod, staticmethod)):
+        return _fingerprint_repr(item.__func__, seen)
+
+    if isinstance(item, (list, tuple)):
+        return repr(tuple(_fingerprint_repr(i, seen) for i in item))
+
+    if isinstance(item, dict):
+        return repr(
+            sorted(
+                (_fingerprint_repr(k, seen), _fingerprint_repr(v, seen))
+                for k, v in item.items()
+            )
+        )
+
+    if isinstance(item, (set, frozenset)):
+        # Set order depends on string hashing, which differs between
+        # processes.
+        return repr(
+            (type(item).__name__, sorted(_fingerprint_repr(i, seen) for i in item))
+        )
+
+    if isinstance(item, _PLAIN_TYPES):
+        return repr(item)
+
+    if isinstance(item, (types.BuiltinFunctionType, types.ModuleType)):
+        return repr((type(item).__name__, _qualified_name(item)))
+
+    # Other objects are identified by the data they would be pickled with,
+    # which does not include their address.
+    try:
+        reduced = item.__reduce_ex__(4)
+    except Exception:
+        logger.warning(
+            f'Cannot fingerprint {_qualified_name(type(item))} object; '
+            f'only its type is included in the fingerprint'
+        )
+        return repr(_qualified_name(type(item)))
+
+    if isinstance(reduced, str):
+        return repr((_qualified_name(type(item)), reduced))
+
+    parts = list(reduced[:3]) + [
+        None if items is None else list(items) for items in reduced[3:5]
+    ]
+    return repr(
+        (_qualified_name(type(item)), tuple(_fingerprint_repr(p, seen) for p in parts))
+    )
+
+
+_PLAIN_TYPES = (
+    type(None),
+    type(Ellipsis),
+    type(NotImplemented),
+    bool,
+    int,
+    float,
+    complex,
+    str,
+    bytes,
+    range,
+    slice,
+)
+
+
+def _qualified_name(item: Any) -> str:
+    name = getattr(item, '__qualname__', None) or getattr(item, '__name__', '')
+    module = getattr(item, '__module__', None)
+    return f'{module}.{name}' if module else name
+
+
+def fingerprint(*items: Any) -> str:
+    """
+    Compute a hash identifying a collection of items.
+
+    Functions and classes are identified by their bytecode, so the
+    fingerprint changes when their code changes. Plain values are
+    identified by their repr, and other objects by the data they would be
+    pickled with, so the fingerprint is the same in every process. Objects
+    that cannot be pickled are only identified by their type.
+
+    :return: Hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    for item in items:
+        digest.update(_fingerprint_repr(item).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
 if resource is not None and signal is not None:
     __all__.append('cpu_linit')
 
@@ -217,5 +346,36 @@ if resource is not None and signal is not None:
             resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
 
 
+    __all__.append('set_limits')
+
+    def set_limits(memory: int = None, cpu_time: float = None):
+        """
+        Limit the resources available to the current process.
+
+        Limits are capped at the existing hard limits.
+
+        Arguments:
+            memory - Maximum size of the address space in bytes.
+            cpu_time - Maximum number of seconds of CPU time, counted
+                       from now. The process receives SIGXCPU, which
+                       terminates it by default, when this is exceeded.
+
+        Availability: UNIX
+        """
+        limits = []
+        if memory is not None:
+            limits.append((resource.RLIMIT_AS, memory))
+        if cpu_time is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = usage.ru_utime + usage.ru_stime
+            limits.append((resource.RLIMIT_CPU, ceil(used + cpu_time)))
+        for limit, value in limits:
+            _, hard = resource.getrlimit(limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.setrlimit(limit, (value, hard))
+
+
 else:
     cpu_limit = None
+    set_limits = None
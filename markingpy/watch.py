@@ -0,0 +1,343 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Watch a directory and grade submissions as they arrive.
+
+A :class:`SubmissionWatcher` keeps the marking scheme loaded and grades
+each submission file that is added or changed, writing the results to the
+marks database. Changes are reported by an :class:`InotifyMonitor` on
+Linux, or otherwise by a :class:`PollingMonitor` that scans the directory
+at regular intervals.
+
+A file is only graded once it has not changed for the debounce interval,
+so files that are still being written are not graded early.
+"""
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .import finders
+from .import submission
+
+logger = logging.getLogger(__name__)
+__all__ = ['SubmissionWatcher', 'InotifyMonitor', 'PollingMonitor']
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT = struct.Struct('iIII')
+
+
+class PollingMonitor:
+    """
+    Report changed submission files by comparing the size and modification
+    time of each file found by a finder at regular intervals.
+
+    :param finder: Finder for the watched directory.
+    :param interval: Time in seconds between scans.
+    """
+
+    def __init__(self, finder: finders.DirectoryFinder, interval: float = 1.0):
+        self.finder = finder
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self) -> Dict[str, tuple]:
+        snapshot = {}
+        for _, path in self.finder.iter_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout: float) -> List[str]:
+        """
+        Wait for up to *timeout* seconds and return the changed files.
+        """
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        changed = [p for p, st in snapshot.items() if self.snapshot.get(p) != st]
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyMonitor:
+    """
+    Report changed submission files using inotify (Linux only).
+
+    :param finder: Finder for the watched directory. Its subdirectories are
+        watched too if it is recursive or loads a submission from each
+        directory.
+    :raises OSError: if inotify is not available.
+    """
+
+    def __init__(self, finder: finders.DirectoryFinder):
+        self.finder = finder
+        name = ctypes.util.find_library('c')
+        self.libc = libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.watches = {}
+        self.watch_tree(str(finder.path))
+
+    @property
+    def recursive(self) -> bool:
+        return self.finder.recursive or self.finder.per_directory
+
+    def watch_tree(self, path: str) -> List[str]:
+        """
+        Watch a directory, and its subdirectories if recursive.
+
+        :return: Files found in the subdirectories, which may have been
+            written before they were watched.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+
+        self.watches[wd] = path
+        files = []
+        if not self.recursive:
+            return files
+
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    files.extend(self.watch_tree(entry.path))
+                elif path != str(self.finder.path):
+                    files.append(entry.path)
+        return files
+
+    def read(self, timeout: float) -> List[str]:
+        """
+        Wait for up to *timeout* seconds and return the changed files.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, rescanning directory')
+                changed.extend(path for _, path in self.finder.iter_files())
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, name)
+            if not mask & IN_ISDIR:
+                changed.append(path)
+            elif self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    changed.extend(self.watch_tree(path))
+                except OSError:
+                    logger.debug(f'Could not watch {path}', exc_info=True)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SubmissionWatcher:
+    """
+    Grade the submissions in a directory as they are added or changed.
+
+    :param markscheme: Marking scheme used to grade the submissions.
+    :param finder: :class:`markingpy.DirectoryFinder` for the watched
+        directory, whose patterns and options select the submissions.
+    :param debounce: Time in seconds a file must be left unchanged before
+        it is graded. Default 2.0.
+    :param poll_interval: Time in seconds between scans when polling.
+    :param use_inotify: If true (default), use inotify where available,
+        and poll otherwise.
+    """
+
+    def __init__(
+        self,
+        markscheme,
+        finder: finders.DirectoryFinder,
+        debounce: float = 2.0,
+        poll_interval: float = 1.0,
+        use_inotify: bool = True,
+    ):
+        self.markscheme = markscheme
+        self.finder = finder
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.hashes = {}
+        self.root = str(finder.path)
+
+    def create_monitor(self):
+        if self.use_inotify:
+            try:
+                return InotifyMonitor(self.finder)
+
+            except (OSError, AttributeError, TypeError):
+                logger.info('inotify is not available, polling for changes')
+        return PollingMonitor(self.finder, self.poll_interval)
+
+    def get_loader(self, path: str):
+        """
+        Get the reference and loader of the submission a file belongs to.
+
+        :return: (reference, loader) pair, or None if the file is not part
+            of a submission.
+        """
+        finder = self.finder
+        relpath = os.path.relpath(path, self.root).replace(os.sep, '/')
+        parts = relpath.split('/')
+        if parts[0] == '..' or any(finder.is_excluded(p, p) for p in parts[:-1]):
+            return None
+
+        if finder.is_excluded(parts[-1], relpath):
+            return None
+
+        if not finder.is_included(parts[-1], relpath):
+            return None
+
+        if finder.per_directory:
+            if len(parts) < 2 or (len(parts) > 2 and not finder.recursive):
+                return None
+
+            directory = os.path.join(self.root, parts[0])
+            return parts[0], partial(finder.load_directory, directory, parts[0] + '/')
+
+        if len(parts) > 1 and not finder.recursive:
+            return None
+
+        return os.path.splitext(relpath)[0], Path(path).read_text
+
+    def load(self, paths) -> Dict[str, tuple]:
+        """
+        Load the submissions that the changed files belong to, skipping
+        those whose source has not changed since they were last graded.
+
+        :return: dict mapping references to pairs of the submission and a
+            hash of its source.
+        """
+        loaders = {}
+        for path in paths:
+            found = self.get_loader(path)
+            if found is not None:
+                loaders.setdefault(*found)
+        subs = {}
+        for ref, load in loaders.items():
+            try:
+                source = load()
+            except FileNotFoundError:
+                continue
+
+            if source is None:
+                continue
+
+            digest = hashlib.sha256(source.encode()).hexdigest()
+            if self.hashes.get(ref) != digest:
+                subs[ref] = (submission.Submission(ref, source), digest)
+        return subs
+
+    def grade(self, subs: Dict[str, tuple]):
+        """
+        Grade submissions loaded by :func:`load`, writing their records to
+        the marks database.
+        """
+        markscheme = self.markscheme
+        finder = markscheme.finder
+        markscheme.finder = finders.NullFinder(*(sub for sub, _ in subs.values()))
+        try:
+            for sub in markscheme.run(generate=True):
+                self.hashes[sub.reference] = subs[sub.reference][1]
+                logger.info(f'Graded {sub.reference}: {sub.percentage}%')
+        finally:
+            markscheme.finder = finder
+
+    def run(self, grade_existing: bool = True, stop: Optional[threading.Event] = None):
+        """
+        Watch the directory and grade submissions until *stop* is set or
+        the process is interrupted.
+
+        :param grade_existing: If true (default), the submissions already
+            in the directory are graded first. Otherwise, they are only
+            graded once they change.
+        :param stop: Event that stops watching when set.
+        """
+        stop = stop if stop is not None else threading.Event()
+        monitor = self.create_monitor()
+        logger.info(f'Watching {self.root} with {monitor.__class__.__name__}')
+        pending = {}
+        existing = [path for _, path in self.finder.iter_files()]
+        if grade_existing:
+            pending.update(dict.fromkeys(existing, 0.0))
+        else:
+            self.hashes.update(
+                (ref, digest) for ref, (_, digest) in self.load(existing).items()
+            )
+        try:
+            while not stop.is_set():
+                now = time.monotonic()
+                for path in monitor.read(min(self.debounce, 0.5)):
+                    pending[path] = now
+                now = time.monotonic()
+                ready = [p for p, t in pending.items() if now - t >= self.debounce]
+                if not ready:
+                    continue
+
+                for path in ready:
+                    del pending[path]
+                # noinspection PyBroadException
+                try:
+                    subs = self.load(ready)
+                    if subs:
+                        self.grade(subs)
+                except Exception:
+                    logger.exception('Failed to grade changed submissions')
+        finally:
+            monitor.close()
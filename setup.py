@@ -15,15 +15,21 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 #
+import re
+
 from setuptools import setup
 
 with open("README.md", "rt", encoding="utf-8") as f:
     long_description = f.read()
+# The version is defined in the package, which cannot be imported before its
+# dependencies are installed.
+with open("markingpy/__init__.py", "rt", encoding="utf-8") as f:
+    version = re.search(r'^__version__ = "([^"]+)"', f.read(), re.M).group(1)
 setup(
     name="markingpy",
     author="Sam Morley",
     author_email="sam@inakleinbottle.com",
-    version="1.0.0",
+    version=version,
     description="Program for automatic grading of Python code.",
     long_description=long_description,
     long_description_content_type="text/markdown",
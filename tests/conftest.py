@@ -0,0 +1,73 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Fixtures shared by the tests
+import pytest
+
+from markingpy import (
+    FunctionExercise, MarkingScheme, NullFinder, SimpleGrader, SQLiteDB
+)
+
+
+def add(a, b):
+    return a + b
+
+
+class CountingGrader(SimpleGrader):
+    """
+    Grader that records the submissions it grades and the exercises it
+    runs for each of them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.graded = []
+        self.pending = {}
+
+    def submit(self, task, submission):
+        self.graded.append(submission.reference)
+        self.pending[submission.reference] = self.get_pending(task, submission)
+        super().submit(task, submission)
+
+
+@pytest.fixture
+def counting_grader():
+    return CountingGrader()
+
+
+@pytest.fixture
+def make_scheme():
+    """
+    Factory for validated marking schemes with an exercise for the function
+    add, which has a single test worth one mark.
+
+    The factory takes the path of the marks database, the submissions to
+    grade and the grader, and passes any other keyword arguments to
+    :class:`markingpy.MarkingScheme`.
+    """
+
+    def make(path, subs=(), grader=None, **kwargs):
+        ex = FunctionExercise(add, name='add')
+        ex.add_test_call((1, 2), {}, marks=1)
+        ms = MarkingScheme(
+            finder=NullFinder(*subs), marks_db=SQLiteDB(path), grader=grader, **kwargs
+        )
+        ms.add_exercise(ex)
+        ms.validate()
+        return ms
+
+    return make
@@ -20,7 +20,15 @@ from textwrap import dedent
 import pytest
 
 from markingpy import (
-    MarkingScheme, exercise, SimpleGrader, ProcessGrader, NullFinder, Submission, Call
+    MarkingScheme,
+    exercise,
+    SimpleGrader,
+    ProcessGrader,
+    PoolGrader,
+    ForkServerGrader,
+    NullFinder,
+    Submission,
+    Call,
 )
 
 
@@ -91,7 +99,9 @@ def finder(submission1, submission2):
     return NullFinder(submission1, submission2)
 
 
-@pytest.fixture(params=(SimpleGrader(), ProcessGrader()))
+@pytest.fixture(
+    params=(SimpleGrader(), ProcessGrader(), PoolGrader(2), ForkServerGrader(2))
+)
 def markscheme(request, function_exercise, class_exercise, finder):
     ms = MarkingScheme(grader=request.param, finder=finder)
     ms.add_exercise(function_exercise)
@@ -101,7 +111,7 @@ def markscheme(request, function_exercise, class_exercise, finder):
 
 
 def test_grader(markscheme):
-    submissions = list(markscheme.run(generate=True))
+    submissions = sorted(markscheme.run(generate=True), key=lambda s: s.reference)
     assert len(submissions) == 2
     out = '''function_exercise
 CallTest
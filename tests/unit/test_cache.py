@@ -0,0 +1,300 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+import os
+import subprocess
+import sys
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from markingpy import (
+    CachedResult,
+    CodeCache,
+    CompiledSubmission,
+    FunctionExercise,
+    NullFinder,
+    ResultCache,
+    Submission,
+)
+import markingpy
+from markingpy.utils import fingerprint
+
+
+def mul(a, b):
+    return a * b
+
+
+@pytest.fixture
+def scheme(tmp_path, make_scheme, counting_grader):
+    return make_scheme(
+        tmp_path / 'marks.db', grader=counting_grader, cache=tmp_path / 'cache.db'
+    )
+
+
+MUL = 'def mul(a, b):\n    return a * b\n'
+
+
+def submissions():
+    return [
+        Submission('good', f'def add(a, b):\n    return a + b\n{MUL}'),
+        Submission('bad', f'def add(a, b):\n    return a - b\n{MUL}'),
+    ]
+
+
+def add_mul_exercise(scheme):
+    ex = FunctionExercise(mul, name='mul')
+    ex.add_test_call((2, 3), {}, marks=1)
+    ex.validate()
+    scheme.add_exercise(ex)
+    return ex
+
+
+def test_cache_get_put(tmp_path):
+    cache = ResultCache(tmp_path / 'cache.db')
+    result = CachedResult(1, 50.0, {'tests': 'feedback'})
+    assert cache.get('source', 'scheme') is None
+    cache.put('source', 'scheme', result)
+    assert cache.get('source', 'scheme') == result
+    assert cache.get('source', 'other scheme') is None
+    assert cache.get('other source', 'scheme') is None
+
+
+def test_cache_eviction(tmp_path):
+    cache = ResultCache(tmp_path / 'cache.db', max_size=25)
+    for i in range(5):
+        cache.put(f'source {i}', 'scheme', CachedResult(i, i, {}))
+    assert cache.size <= 25
+    assert cache.get('source 0', 'scheme') is None
+    assert cache.get('source 4', 'scheme') is not None
+    # Reopening the cache keeps track of the stored size.
+    cache.close()
+    assert ResultCache(tmp_path / 'cache.db', max_size=25).size == cache.size
+
+
+def test_cache_batches_writes(tmp_path):
+    cache = ResultCache(tmp_path / 'cache.db', batch_size=3, flush_interval=60)
+    other = ResultCache(tmp_path / 'cache.db')
+    assert cache.db.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+    result = CachedResult(1, 50.0, {})
+    cache.put('a', 'scheme', result)
+    cache.put('b', 'scheme', result)
+    assert other.get('a', 'scheme') is None
+    assert cache.get('a', 'scheme') == result
+    cache.put('c', 'scheme', result)
+    assert other.get('a', 'scheme') == result
+    assert cache.get('a', 'scheme') == result
+    assert cache.used
+    cache.close()
+    assert not cache.used
+    assert ResultCache(tmp_path / 'cache.db').size == cache.size
+    other.close()
+
+
+def test_scheme_fingerprint_changes_with_tests(scheme):
+    before = scheme.fingerprint()
+    assert scheme.fingerprint() == before
+    scheme.exercises[0].add_test_call((2, 2), {}, marks=1)
+    assert scheme.fingerprint() != before
+
+
+class Point:
+
+    def __init__(self, x, tags):
+        self.x = x
+        self.tags = tags
+
+
+FINGERPRINT_SCRIPT = """
+from markingpy.utils import fingerprint
+class Point:
+    def __init__(self, x, tags):
+        self.x = x
+        self.tags = tags
+print(fingerprint(Point(1, {'a', 'b', 'c'}), {'d', 'e'}))
+"""
+
+
+def test_fingerprint_is_stable_across_processes():
+    assert fingerprint(Point(1, set())) == fingerprint(Point(1, set()))
+    assert fingerprint(Point(1, set())) != fingerprint(Point(2, set()))
+    root = os.path.dirname(os.path.dirname(markingpy.__file__))
+    digests = {
+        subprocess.run(
+            [sys.executable, '-c', FINGERPRINT_SCRIPT],
+            env=dict(os.environ, PYTHONHASHSEED=str(seed), PYTHONPATH=root),
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        for seed in (1, 2, 3)
+    }
+    assert len(digests) == 1
+
+
+def test_run_uses_cached_results(scheme):
+    scheme.finder = NullFinder(*submissions())
+    first = {sub.reference: sub for sub in scheme.run(generate=True)}
+    assert sorted(scheme.grader.graded) == ['bad', 'good']
+    scheme.grader.graded.clear()
+    scheme.finder = NullFinder(*submissions())
+    second = {sub.reference: sub for sub in scheme.run(generate=True)}
+    assert scheme.grader.graded == []
+    for ref, sub in second.items():
+        assert sub.cached
+        assert sub.code is None
+        assert sub.record == first[ref].record
+        assert sub.feedback == first[ref].feedback
+    records = sorted(scheme.db.get_all())
+    assert records == [tuple(second[ref].record) for ref in ('bad', 'good')]
+    # Results of cached submissions are stored with their records.
+    assert scheme.db.get_pass_rates() == {('add', 0, 'CallTest'): 0.5}
+
+
+def test_run_without_cache(scheme):
+    scheme.finder = NullFinder(*submissions())
+    scheme.run()
+    scheme.cache = None
+    scheme.grader.graded.clear()
+    scheme.finder = NullFinder(*submissions())
+    scheme.run()
+    assert sorted(scheme.grader.graded) == ['bad', 'good']
+
+
+def test_cache_exercise_result(scheme, tmp_path):
+    cache = ResultCache(tmp_path / 'cache.db')
+    ex = scheme.exercises[0]
+    result = ex.run({'add': ex.func})
+    cache.put_exercise('source', 'exercise', result)
+    assert cache.get_exercise('source', 'other', ex) is None
+    restored = cache.get_exercise('source', 'exercise', ex)
+    assert restored.marks == result.marks
+    assert restored.total_marks == result.total_marks
+    assert restored.feedback == result.feedback
+    assert [r.test for r in restored.per_test] == ex.tests
+    assert [r.mark for r in restored.per_test] == [r.mark for r in result.per_test]
+    assert [r.passed for r in restored.per_test] == [True]
+    assert restored.per_test[0].runtime == result.per_test[0].runtime
+
+
+def fail_first_exercise(grader):
+    """
+    Make the first exercise fail to run on the grader, as if it timed out.
+    """
+    submit = grader.submit
+
+    def fail(task, submission):
+        if 0 in grader.get_pending(task, submission):
+            submission.exercise_results[0] = task.failed('Timed out', (0,))[0]
+        submit(task, submission)
+
+    grader.submit = fail
+    grader.timeout = 1.0
+
+
+def test_failed_results_are_not_cached(scheme):
+    add_mul_exercise(scheme)
+    grader = scheme.grader
+    fail_first_exercise(grader)
+    scheme.finder = NullFinder(*submissions())
+    scheme.run()
+    assert grader.pending == {'good': [1], 'bad': [1]}
+    scheme.finder = NullFinder(*submissions())
+    graded = {sub.reference: sub for sub in scheme.run(generate=True)}
+    # The failed exercise was not cached, so it is run (and fails) again,
+    # while the other exercise comes from the cache.
+    assert grader.pending == {'good': [], 'bad': []}
+    assert graded['good'].exercise_results[0].failed
+    assert not graded['good'].cached
+    # Results are cached separately for different grader limits.
+    del grader.submit, grader.timeout
+    scheme.finder = NullFinder(*submissions())
+    scheme.run()
+    assert grader.pending == {'good': [0, 1], 'bad': [0, 1]}
+
+
+def test_run_only_changed_exercises(scheme):
+    mul_ex = add_mul_exercise(scheme)
+    scheme.finder = NullFinder(*submissions())
+    first = {sub.reference: sub for sub in scheme.run(generate=True)}
+    assert scheme.grader.pending == {'good': [0, 1], 'bad': [0, 1]}
+    runtimes = scheme.db.get_runtimes()
+    assert set(runtimes) == {'good', 'bad'}
+    # Changing one exercise only reruns that exercise.
+    mul_ex.add_test_call((4, 5), {}, marks=1)
+    scheme.finder = NullFinder(*submissions())
+    second = {sub.reference: sub for sub in scheme.run(generate=True)}
+    assert scheme.grader.pending == {'good': [1], 'bad': [1]}
+    # Runtimes of partly cached runs are not recorded.
+    assert scheme.db.get_runtimes() == runtimes
+    for ref, sub in second.items():
+        assert not sub.cached
+        old, new = first[ref].exercise_results, sub.exercise_results
+        assert new[0].feedback == old[0].feedback
+        assert new[1].total_marks == 2
+        assert sub.feedback['tests'].startswith(old[0].feedback)
+    assert second['good'].score == 3
+    assert second['bad'].score == 2
+
+
+def test_code_cache_get_put(tmp_path):
+    cache = CodeCache(tmp_path / 'code')
+    code = compile(MUL, '<input>', 'exec')
+    assert cache.get(MUL) is None
+    cache.put(MUL, CompiledSubmission(MUL, code, 'feedback'))
+    source, cached_code, feedback = cache.get(MUL)
+    assert (source, feedback) == (MUL, 'feedback')
+    ns = {}
+    exec(cached_code, ns)
+    assert ns['mul'](2, 3) == 6
+    assert cache.get(MUL, ('other', 'flags')) is None
+    # Entries written by another version of markingpy are not used.
+    with patch('markingpy.cache.__version__', 'other'):
+        assert cache.get(MUL) is None
+    # Unreadable entries are ignored.
+    path = cache.get_path(cache.make_key(MUL))
+    path.write_bytes(b'garbage')
+    assert cache.get(MUL) is None
+    cache.clear()
+    assert not path.exists()
+
+
+def test_submission_compile_uses_code_cache(tmp_path):
+    cache = CodeCache(tmp_path / 'code')
+    source = 'def add(a, b)\n    return a + b\n' + MUL
+    first = Submission('first', source)
+    first.compile(cache)
+    second = Submission('second', source)
+    second.compiler = MagicMock(
+        filename='<input>', mode='exec', side_effect=AssertionError
+    )
+    second.compile(cache)
+    assert second.source == first.source
+    assert second.feedback['compilation'] == first.feedback['compilation']
+    assert 'Removed:' in second.feedback['compilation']
+    ns = {}
+    exec(second.code, ns)
+    assert 'add' not in ns and ns['mul'](2, 3) == 6
+
+
+def test_run_stores_compiled_submissions(scheme, tmp_path):
+    scheme.cache = None
+    scheme.code_cache = tmp_path / 'code'
+    scheme.finder = NullFinder(*submissions())
+    scheme.run()
+    cache = scheme.get_code_cache()
+    for sub in submissions():
+        assert cache.get(sub.raw_source, ('<input>', 'exec')) is not None
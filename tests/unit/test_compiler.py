@@ -16,10 +16,12 @@
 #
 #
 # Tests for compilers
+import tokenize
 from unittest import TestCase
+from unittest.mock import patch
 from textwrap import dedent
 
-from markingpy.compiler import Compiler
+from markingpy.compiler import Compiler, Reason, RemovedChunk, split_blocks
 
 
 class TestCompiler(TestCase):
@@ -75,3 +77,195 @@ class TestCompiler(TestCase):
         exec (code, self.compiled_globals)
         self.assertIn("long_function", self.compiled_globals)
         self.assertEqual(self.compiled_globals["long_function"](1, 1), 2)
+
+    def test_compile_multiple_errors(self):
+        """Test only the blocks containing errors lose lines."""
+        source = dedent(
+            """\
+            def bad_one(a, b)
+                return a + b
+
+            def good_one(a, b):
+                return a + b
+
+            def bad_two(a, b):
+                return a +
+
+            def good_two(a, b):
+                return a - b
+            """
+        )
+        src, code = self.compiler(source)
+        exec (code, self.compiled_globals)
+        self.assertIn("good_one", self.compiled_globals)
+        self.assertIn("good_two", self.compiled_globals)
+        self.assertNotIn("bad_one", self.compiled_globals)
+        removed = sorted(
+            (c.line_start, c.line_end, c.content) for c in self.compiler.removed_chunks
+        )
+        self.assertEqual(
+            removed,
+            [
+                (0, 1, "def bad_one(a, b)\n    return a + b"),
+                (6, 7, "def bad_two(a, b):\n    return a +"),
+            ],
+        )
+        # Errors are reported at their line number in the whole source.
+        errors = [c.get_first_error().exc.lineno for c in self.compiler.removed_chunks]
+        self.assertEqual(errors, [1, 8])
+
+    def test_error_in_class_matches_baseline(self):
+        """Test an error in a method removes the rest of the class at once."""
+        source = dedent(
+            """\
+            class A:
+                def f(self)
+                    return 1
+
+                def g(self):
+                    return 2
+            x = 1
+            """
+        )
+        src, code = self.compiler(source)
+        # The original compiler removed the class as a single chunk and
+        # kept only the last statement.
+        self.assertEqual(src, "x = 1")
+        (chunk,) = self.compiler.removed_chunks
+        self.assertEqual(
+            tuple(chunk), (0, 5, "\n".join(source.splitlines()[:6]))
+        )
+        self.assertEqual(chunk.get_first_error().exc.lineno, 2)
+
+    def test_removed_chunks_separated_by_blank_lines(self):
+        """Test removed chunks separated only by blank lines are joined."""
+        source = dedent(
+            """\
+            def bad_one(a, b)
+                return a + b
+
+
+            def bad_two(a, b):
+                return a +
+            # Comment
+
+            def good(a, b):
+                return a - b
+            """
+        )
+        src, code = self.compiler(source)
+        exec (code, self.compiled_globals)
+        self.assertIn("good", self.compiled_globals)
+        self.assertEqual(
+            [(c.line_start, c.line_end) for c in self.compiler.removed_chunks],
+            [(0, 5)],
+        )
+        self.assertTrue(src.startswith("# Comment\n"))
+
+    def test_removed_chunks_are_joined(self):
+        """Test adjacent removed lines are joined into a single chunk."""
+        compiler = self.compiler
+        compiler.lines = lines = ["a", "b", "c", "d", "e"]
+        for index in (3, 0, 1, 4):
+            removed = RemovedChunk(lines, index, index)
+            removed.add_reason(Reason(index, SyntaxError()))
+            compiler.add_removed(removed)
+        self.assertEqual(
+            [tuple(c) for c in compiler.removed_chunks],
+            [(0, 1, "a\nb"), (3, 4, "d\ne")],
+        )
+        self.assertEqual(compiler.removed_starts, [0, 3])
+        removed = RemovedChunk(lines, 2, 2)
+        removed.add_reason(Reason(2, SyntaxError()))
+        compiler.add_removed(removed)
+        (chunk,) = compiler.removed_chunks
+        self.assertEqual(chunk.content, "a\nb\nc\nd\ne")
+        self.assertEqual(chunk.get_first_error().removed_at, 0)
+
+
+class TestSplitBlocks(TestCase):
+
+    def split(self, source):
+        lines = dedent(source).splitlines()
+        return [lines[start] for start, end in split_blocks(lines)]
+
+    def test_compound_statements(self):
+        """Test decorators and continuation clauses stay in their block."""
+        source = '''\
+                 import os
+
+                 @decorator
+                 def func():
+                     return """
+                 not_a_statement = 1
+                 """
+                 try:
+                     pass
+                 except ValueError:
+                     pass
+                 x = (1,
+                 2)
+                 '''
+        self.assertEqual(
+            self.split(source), ["import os", "@decorator", "try:", "x = (1,"]
+        )
+
+    def test_only_rejected_blocks_are_tokenized(self):
+        """Test blocks that compile are not tokenized."""
+        source = dedent(
+            '''\
+            x = """
+            not_a_statement = 1
+            """
+            y = 1
+            '''
+        )
+        lines = source.splitlines()
+        checked = []
+
+        def compiles(start, end):
+            checked.append(start)
+            try:
+                compile("\n".join(lines[start:end]), "<input>", "exec")
+            except SyntaxError:
+                return False
+
+            return True
+
+        self.assertEqual(split_blocks(lines, compiles), [(0, 3), (3, 4)])
+        self.assertEqual(checked, [0, 3])
+
+    def test_untokenizable_source(self):
+        """Test blocks are found by indentation after a tokenize error."""
+        source = """\
+                 a = 1
+                 b = (
+                 def func():
+                     pass
+                 else:
+                     pass
+                 c = 2
+                 """
+        self.assertEqual(self.split(source), ["a = 1", "b = (", "def func():", "c = 2"])
+
+    def test_unclosed_brackets_are_tokenized_once(self):
+        """Test the source is only read once past an unclosed bracket."""
+        lines = []
+        for i in range(50):
+            lines += ["def func{}(x):".format(i), "    y = (x +", "    return y"]
+        read = []
+        generate_tokens = tokenize.generate_tokens
+
+        def counting(readline):
+
+            def counted():
+                read.append(None)
+                return readline()
+
+            return generate_tokens(counted)
+
+        with patch("markingpy.compiler.tokenize.generate_tokens", counting):
+            blocks = split_blocks(lines, lambda start, end: False)
+
+        self.assertEqual([start for start, end in blocks], list(range(0, 150, 3)))
+        self.assertLessEqual(len(read), len(lines) + 1)
@@ -0,0 +1,182 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+import os
+import stat
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import pytest
+
+from markingpy import (
+    Coordinator,
+    MarkingScheme,
+    NullFinder,
+    SQLiteDB,
+    Submission,
+    Worker,
+    parse_address,
+    PoolGrader,
+)
+
+
+def submissions(n=4):
+    return [
+        Submission(f'sub{i}', f'def add(a, b):\n    return a + {i % 2} * b\n')
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def coordinator(tmp_path, make_scheme):
+    coord = Coordinator(
+        make_scheme(tmp_path / 'marks.db', submissions()), heartbeat_interval=0.1
+    )
+    thread = threading.Thread(target=coord.serve, daemon=True)
+    thread.start()
+    yield coord
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+@pytest.fixture
+def run_worker(tmp_path, make_scheme):
+
+    def run(coordinator, grader=None):
+        ms = make_scheme(tmp_path / 'worker.db', grader=grader)
+        Worker(ms, coordinator.address, coordinator.authkey).run()
+
+    return run
+
+
+def connect(coordinator):
+    conn = Client(coordinator.address, authkey=coordinator.authkey)
+    conn.send(('hello', 'test', coordinator.scheme_fingerprint))
+    assert conn.recv()[0] == 'welcome'
+    return conn
+
+
+def scores(coordinator):
+    return {row[0]: row[1] for row in coordinator.markscheme.db.get_all()}
+
+
+def test_parse_address():
+    assert parse_address('localhost:8765') == ('localhost', 8765)
+    assert parse_address(':8765') == ('localhost', 8765)
+    assert parse_address('/tmp/markingpy.sock') == '/tmp/markingpy.sock'
+
+
+def test_distributed_grading(coordinator, run_worker):
+    # Workers in the same process run submissions on a pool grader, as the
+    # exercises are shared between them.
+    workers = [
+        threading.Thread(
+            target=run_worker, args=(coordinator, PoolGrader(1))
+        )
+        for _ in range(2)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(10)
+    assert scores(coordinator) == {'sub0': 0, 'sub1': 100, 'sub2': 0, 'sub3': 100}
+    db = coordinator.markscheme.db
+    assert db.get_pass_rates() == {('add', 0, 'CallTest'): 0.5}
+
+
+def test_distributed_grading_unix_socket(tmp_path, make_scheme, run_worker):
+    path = str(tmp_path / 'coordinator.sock')
+    coord = Coordinator(make_scheme(tmp_path / 'marks.db', submissions()), path)
+    thread = threading.Thread(target=coord.serve, daemon=True)
+    thread.start()
+    # Only the owner can connect to the socket, so no key is needed.
+    assert coord.authkey is None
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    run_worker(coord)
+    thread.join(5)
+    assert len(scores(coord)) == 4
+
+
+def test_requeue_from_disconnected_worker(coordinator, run_worker):
+    conn = connect(coordinator)
+    conn.send(('request',))
+    kind, ref, _ = conn.recv()
+    assert kind == 'work'
+    conn.close()
+    run_worker(coordinator)
+    assert ref in scores(coordinator)
+    assert len(scores(coordinator)) == 4
+
+
+def test_requeue_from_unresponsive_worker(coordinator, run_worker):
+    conn = connect(coordinator)
+    conn.send(('request',))
+    _, ref, _ = conn.recv()
+    # The worker stays connected but stops sending heartbeats.
+    with coordinator.lock:
+        assert coordinator.lock.wait_for(lambda: ref not in coordinator.leases, 5)
+    run_worker(coordinator)
+    assert ref in scores(coordinator)
+    assert len(scores(coordinator)) == 4
+    conn.close()
+
+
+def test_failed_after_max_attempts(tmp_path, make_scheme):
+    coord = Coordinator(
+        make_scheme(tmp_path / 'marks.db', submissions(1)), max_attempts=2
+    )
+    thread = threading.Thread(target=coord.serve, daemon=True)
+    thread.start()
+    for _ in range(2):
+        conn = connect(coord)
+        conn.send(('request',))
+        assert conn.recv()[:2] == ('work', 'sub0')
+        conn.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    (record,) = coord.markscheme.db.get_all()
+    assert record[1] == 0
+    assert 'after 2 attempts' in record[2]
+
+
+def test_worker_rejected_for_different_scheme(coordinator, tmp_path, run_worker):
+    ms = MarkingScheme(finder=NullFinder(), marks_db=SQLiteDB(tmp_path / 'w.db'))
+    with pytest.raises(RuntimeError):
+        Worker(ms, coordinator.address, coordinator.authkey).run()
+    run_worker(coordinator)
+
+
+def test_authkey_generated_for_tcp(tmp_path, monkeypatch, make_scheme, run_worker):
+    monkeypatch.delenv('MARKINGPY_AUTHKEY', raising=False)
+    coord = Coordinator(
+        make_scheme(tmp_path / 'marks.db', submissions(1)), heartbeat_interval=0.1
+    )
+    assert coord.generated_authkey
+    assert len(coord.authkey) == 32
+    thread = threading.Thread(target=coord.serve, daemon=True)
+    thread.start()
+    with pytest.raises(AuthenticationError):
+        Client(coord.address, authkey=b'wrong')
+    run_worker(coord)
+    thread.join(5)
+    assert len(scores(coord)) == 1
+    monkeypatch.setenv('MARKINGPY_AUTHKEY', 'secret')
+    coord = Coordinator(make_scheme(tmp_path / 'marks.db'), 'localhost:0')
+    assert not coord.generated_authkey
+    assert coord.authkey == b'secret'
+    coord.listener.close()
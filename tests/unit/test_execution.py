@@ -0,0 +1,112 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+import time
+from textwrap import dedent
+
+import pytest
+
+from markingpy import FunctionExercise
+from markingpy import execution
+
+
+def first():
+    return 1
+
+
+def second():
+    return 1
+
+
+def slow():
+    return 1
+
+
+def make_exercises():
+    exercises = []
+    for func in (first, second, slow):
+        ex = FunctionExercise(func, name=func.__name__)
+        ex.add_test_call((), {}, marks=1)
+        ex.validate()
+        exercises.append(ex)
+    return exercises
+
+
+SOURCE = dedent(
+    """\
+    import os, time
+
+    state = []
+
+    def first():
+        state.append(1)
+        return len(state)
+
+    def second():
+        state.append(1)
+        return len(state)
+
+    def slow():
+        time.sleep(0.3)
+        return 1
+    """
+)
+
+
+def run(source, processes=None, indices=None):
+    task = execution.TestRun(make_exercises(), [], processes)
+    return list(task.iter_results(compile(source, 'submission', 'exec'), indices))
+
+
+def test_forked_call():
+    assert execution.ForkedCall(sum, (1, 2)).result() == 3
+    with pytest.raises(RuntimeError):
+        execution.ForkedCall(int, 'x').result()
+
+
+def test_sequential_exercises_share_state():
+    results = run(SOURCE)
+    assert [r.marks for _, r in results] == [1, 0, 1]
+
+
+def test_forked_exercises_are_isolated():
+    results = run(SOURCE, processes=2)
+    assert [i for i, _ in results] == [0, 1, 2]
+    assert [r.marks for _, r in results] == [1, 1, 1]
+
+
+def test_forked_exercises_run_concurrently():
+    source = SOURCE.replace('def first():\n', 'def first():\n    time.sleep(0.3)\n')
+    start = time.monotonic()
+    results = run(source, processes=3)
+    assert time.monotonic() - start < 0.55
+    assert [r.marks for _, r in results] == [1, 1, 1]
+
+
+def test_forked_exercise_crash():
+    source = SOURCE.replace('    state.append(1)\n', '    os._exit(1)\n', 1)
+    results = run(source, processes=2, indices=[0, 2])
+    assert [i for i, _ in results] == [0, 2]
+    (_, crashed), (_, ok) = results
+    assert crashed.marks == 0
+    assert 'exited unexpectedly' in crashed.feedback
+    assert ok.marks == 1
+
+
+def test_forked_exercise_processes_must_be_positive():
+    with pytest.raises(ValueError):
+        execution.TestRun(make_exercises(), [], 0)
@@ -0,0 +1,283 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+#
+import sqlite3
+import tarfile
+import time
+import types
+import zipfile
+
+import pytest
+
+from markingpy import (
+    DirectoryFinder,
+    IncrementalFinder,
+    NullFinder,
+    PrefetchingFinder,
+    ShardFinder,
+    SQLiteFinder,
+    Submission,
+    TarFinder,
+    ZipFinder,
+)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    files = {
+        'top.py': 'a = 1',
+        'notes.txt': 'not code',
+        'alice/main.py': 'b = 2',
+        'alice/util.py': 'c = 3',
+        'alice/__pycache__/main.py': 'stale',
+        'bob/main.py': 'd = 4',
+        'bob/tests/test_main.py': 'e = 5',
+        'carol/README': 'nothing',
+    }
+    for name, source in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+    return tmp_path
+
+
+def load(finder):
+    return [(s.reference, s.raw_source) for s in finder.get_submissions()]
+
+
+def test_directory_finder_top_level(tree):
+    assert load(DirectoryFinder(tree)) == [('top', 'a = 1')]
+
+
+def test_directory_finder_recursive(tree):
+    finder = DirectoryFinder(tree, exclude=['__pycache__'], recursive=True)
+    submissions = finder.get_submissions()
+    assert isinstance(submissions, types.GeneratorType)
+    assert [ref for ref, _ in load(finder)] == [
+        'top', 'alice/main', 'alice/util', 'bob/main', 'bob/tests/test_main'
+    ]
+    finder = DirectoryFinder(tree, exclude=['__pycache__', 'bob/tests'], recursive=True)
+    assert 'bob/tests/test_main' not in dict(load(finder))
+
+
+def test_directory_finder_include(tree):
+    finder = DirectoryFinder(tree, include=['*.txt', 'README'], recursive=True)
+    assert [ref for ref, _ in load(finder)] == ['notes', 'carol/README']
+
+
+def test_directory_finder_per_directory(tree):
+    finder = DirectoryFinder(
+        tree, exclude=['__pycache__'], recursive=True, per_directory=True
+    )
+    assert load(finder) == [('alice', 'b = 2\nc = 3'), ('bob', 'd = 4\ne = 5')]
+    finder = DirectoryFinder(tree, per_directory=True)
+    assert load(finder) == [('alice', 'b = 2\nc = 3'), ('bob', 'd = 4')]
+
+
+def test_directory_finder_missing(tmp_path):
+    finder = DirectoryFinder(tmp_path / 'missing')
+    with pytest.raises(RuntimeError):
+        list(finder.get_submissions())
+
+
+def test_prefetching_finder_loaders(tree):
+    finder = DirectoryFinder(tree, exclude=['__pycache__'], per_directory=True)
+    prefetching = PrefetchingFinder(finder, ahead=2, threads=2)
+    assert load(prefetching) == load(finder)
+
+
+def test_prefetching_finder_stream():
+    taken = []
+
+    class SlowFinder(NullFinder):
+
+        def get_submissions(self, **kwargs):
+            for sub in self.subs:
+                taken.append(sub.reference)
+                yield sub
+
+    subs = [Submission(f'sub{i}', 'x' * 100) for i in range(10)]
+    finder = PrefetchingFinder(SlowFinder(*subs), max_bytes=150)
+    submissions = finder.get_submissions()
+    assert next(submissions).reference == 'sub0'
+    time.sleep(0.2)
+    # The memory budget stops the background thread reading further ahead.
+    assert len(taken) < 5
+    assert [s.reference for s in submissions] == [f'sub{i}' for i in range(1, 10)]
+
+
+def test_prefetching_finder_error(tmp_path):
+    finder = PrefetchingFinder(DirectoryFinder(tmp_path / 'missing'))
+    with pytest.raises(RuntimeError):
+        list(finder.get_submissions())
+
+
+ARCHIVE = {
+    'export/alice/main.py': 'b = 2',
+    'export/alice/util.py': 'c = 3',
+    'export/bob/main.py': 'd = 4',
+    'export/bob/notes.txt': 'not code',
+    'export/top.py': 'a = 1',
+}
+
+
+def make_zip(path):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, source in ARCHIVE.items():
+            archive.writestr(name, source)
+    return path
+
+
+def make_tar(path):
+    with tarfile.open(path, 'w:gz') as archive:
+        for name, source in ARCHIVE.items():
+            file = path.parent / 'member'
+            file.write_text(source)
+            archive.add(str(file), arcname=name)
+    return path
+
+
+@pytest.mark.parametrize(
+    'finder_class, make', [(ZipFinder, make_zip), (TarFinder, make_tar)]
+)
+def test_archive_finders(tmp_path, finder_class, make):
+    path = make(tmp_path / 'export.archive')
+    finder = finder_class(path, strip=1)
+    assert load(finder) == [
+        ('alice/main', 'b = 2'), ('alice/util', 'c = 3'), ('bob/main', 'd = 4'),
+        ('top', 'a = 1'),
+    ]
+    finder = finder_class(path, exclude=['bob'], reference=lambda p: p.upper())
+    assert [ref for ref, _ in load(finder)] == [
+        'EXPORT/ALICE/MAIN.PY', 'EXPORT/ALICE/UTIL.PY', 'EXPORT/TOP.PY'
+    ]
+    finder = finder_class(path, strip=1, per_directory=True)
+    assert load(finder) == [('alice', 'b = 2\nc = 3'), ('bob', 'd = 4')]
+    assert not list(tmp_path.glob('export/*'))
+
+
+def test_sqlite_finder_changed_since(tmp_path):
+    path = tmp_path / 'subs.db'
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE subs (ref text, source text, updated int)")
+    conn.executemany(
+        "INSERT INTO subs VALUES (?, ?, ?)",
+        [(f'sub{i}', f'x = {i}', i) for i in range(5)],
+    )
+    conn.commit()
+
+    def make_finder():
+        return SQLiteFinder(
+            path,
+            'subs',
+            'ref',
+            'source',
+            changed_field='updated',
+            state_path=tmp_path / 'state.json',
+            batch_size=2,
+        )
+
+    finder = make_finder()
+    assert [ref for ref, _ in load(finder)] == [f'sub{i}' for i in range(5)]
+    # The watermark is only advanced once the run has finished.
+    assert len(load(finder)) == 5
+    assert not (tmp_path / 'state.json').exists()
+    finder.finish_run()
+    assert load(finder) == []
+    conn.execute("UPDATE subs SET source = 'x = 10', updated = 10 WHERE ref = 'sub2'")
+    conn.commit()
+    # The watermark is kept between runs in the state file.
+    finder = make_finder()
+    assert finder.since == 4
+    assert load(finder) == [('sub2', 'x = 10')]
+    finder.finish_run()
+    assert finder.since == 10
+    with pytest.raises(sqlite3.OperationalError):
+        finder.connect().execute("DELETE FROM subs")
+    finder.close()
+
+
+def run(finder, scheme='scheme', stored=None):
+    """
+    Load the submissions of a finder as a grading run would, storing the
+    submissions in *stored*, or all of them.
+    """
+    finder.start_run(scheme)
+    loaded = load(finder)
+    for ref, _ in loaded:
+        if stored is None or ref in stored:
+            finder.mark_stored(ref)
+    finder.finish_run()
+    return loaded
+
+
+def test_incremental_finder_directory(tree):
+    finder = IncrementalFinder(DirectoryFinder(tree), tree / 'state' / 'manifest.json')
+    (tree / 'other.py').write_text('f = 6')
+    assert [ref for ref, _ in run(finder)] == ['other', 'top']
+    assert run(finder) == []
+    # Touching a file without changing it does not reload it.
+    (tree / 'top.py').write_text('a = 1')
+    (tree / 'new.py').write_text('g = 7')
+    (tree / 'other.py').write_text('f = 8')
+    assert run(finder) == [('new', 'g = 7'), ('other', 'f = 8')]
+    assert run(finder) == []
+    # Every submission is loaded again when the marking scheme changes.
+    assert [ref for ref, _ in run(finder, 'changed')] == ['new', 'other', 'top']
+
+
+def test_incremental_finder_any_finder(tmp_path):
+    manifest = tmp_path / 'manifest.json'
+    subs = [Submission('a', 'x = 1'), Submission('b', 'x = 2')]
+    assert len(run(IncrementalFinder(NullFinder(*subs), manifest))) == 2
+    subs[1] = Submission('b', 'x = 3')
+    finder = IncrementalFinder(NullFinder(*subs), manifest)
+    assert run(finder) == [('b', 'x = 3')]
+
+
+def test_incremental_finder_records_stored_submissions(tree):
+    manifest = tree / 'manifest.json'
+    (tree / 'other.py').write_text('f = 6')
+    finder = IncrementalFinder(DirectoryFinder(tree), manifest)
+    # Submissions that were not stored are loaded again.
+    assert len(run(finder, stored={'top'})) == 2
+    assert run(finder) == [('other', 'f = 6')]
+    (tree / 'other.py').write_text('f = 7')
+    assert run(finder, stored=()) == [('other', 'f = 7')]
+    assert run(finder) == [('other', 'f = 7')]
+    # The manifest is only written once a run finishes.
+    (tree / 'top.py').write_text('a = 2')
+    finder.start_run('scheme')
+    assert load(finder) == [('top', 'a = 2')]
+    finder.mark_stored('top')
+    assert run(finder) == [('top', 'a = 2')]
+
+
+def test_shard_finder(tmp_path):
+    for i in range(20):
+        (tmp_path / f'sub{i}.py').write_text(f'x = {i}')
+    shards = [load(ShardFinder(DirectoryFinder(tmp_path), i, 3)) for i in range(3)]
+    refs = [ref for shard in shards for ref, _ in shard]
+    assert sorted(refs) == sorted(f'sub{i}' for i in range(20))
+    assert all(shards)
+    # Finders without loaders are filtered by reference too.
+    subs = [Submission(f'sub{i}', f'x = {i}') for i in range(20)]
+    assert sorted(load(ShardFinder(NullFinder(*subs), 1, 3))) == sorted(shards[1])
+    assert ShardFinder(DirectoryFinder(tmp_path), 0, 1).get_loaders() is not None
+    with pytest.raises(ValueError):
+        ShardFinder(NullFinder(), 3, 3)
@@ -15,3 +15,246 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 #
+import multiprocessing as mp
+import os
+import signal
+import time
+from collections import namedtuple
+
+import pytest
+
+from markingpy import (
+    ForkServerGrader, PoolGrader, ProcessGrader, SimpleGrader, Submission
+)
+from markingpy.grader import Record, _kill
+
+Result = namedtuple('Result', ('marks', 'total_marks', 'feedback'))
+
+
+class PidTask:
+    """
+    Task that reports the process it ran in. Submissions can set flags
+    to make the first exercise fail, loop forever or allocate memory.
+    """
+
+    def __init__(self, num_exercises=1):
+        self.exercises = list(range(num_exercises))
+        self.preloaded = False
+        self.calls = 0
+
+    def preload(self):
+        self.preloaded = True
+
+    def run_exercise(self, index, ns):
+        if index == 0:
+            if ns.get('fail'):
+                raise ValueError('bad submission')
+
+            while ns.get('loop'):
+                pass
+            if ns.get('allocate'):
+                ns['data'] = bytearray(ns['allocate'])
+        return Result(1, 1, f'{os.getpid()} {self.calls}')
+
+    def iter_results(self, code, indices=None):
+        self.preload()
+        self.calls += 1
+        ns = {}
+        exec(code, ns)
+        if indices is None:
+            indices = range(len(self.exercises))
+        for index in indices:
+            yield index, self.run_exercise(index, ns)
+
+    def __call__(self, code):
+        return [result for _, result in self.iter_results(code)]
+
+    def failed(self, msg, indices=None):
+        if indices is None:
+            indices = self.exercises
+        return [Result(0, 1, msg) for _ in indices]
+
+
+class ListDB:
+
+    def __init__(self):
+        self.records = []
+
+    def add_record(self, record):
+        self.records.append(record)
+
+
+def make_submissions(n, source='x = 1'):
+    return [Submission(f'sub{i}', source) for i in range(n)]
+
+
+@pytest.mark.parametrize(
+    'grader', (SimpleGrader(), PoolGrader(2), ProcessGrader(), ForkServerGrader(2))
+)
+def test_grade_all_submissions(grader):
+    db = ListDB()
+    grader.set_db(db)
+    subs = make_submissions(5)
+    graded = list(grader.grade(PidTask(), subs))
+    assert sorted(s.reference for s in graded) == sorted(s.reference for s in subs)
+    assert sorted(r.id for r in db.records) == sorted(s.reference for s in subs)
+    assert all(isinstance(r, Record) and r.score == 100 for r in db.records)
+
+
+@pytest.mark.parametrize('grader', (SimpleGrader(), PoolGrader(2)))
+def test_grade_only_pending_exercises(grader):
+    subs = make_submissions(3)
+    subs[0].exercise_results = {0: Result(1, 1, 'stored 0'), 1: Result(0, 1, 'x')}
+    subs[1].exercise_results = {1: Result(0, 1, 'stored 1')}
+    graded = {s.reference: s for s in grader.grade(PidTask(2), subs)}
+    assert graded['sub0'].feedback['tests'] == 'stored 0\nx'
+    assert graded['sub0'].score == 1
+    tests = graded['sub1'].feedback['tests'].splitlines()
+    assert tests[1] == 'stored 1'
+    assert tests[0] != 'stored 1'
+    assert graded['sub2'].score == 2
+    assert all(len(s.exercise_results) == 2 for s in graded.values())
+
+
+def test_pool_grader_reuses_workers():
+    grader = PoolGrader(1)
+    subs = list(grader.grade(PidTask(), make_submissions(3)))
+    pids = {sub.feedback['tests'].split()[0] for sub in subs}
+    assert len(pids) == 1
+    assert str(os.getpid()) not in pids
+
+
+def test_pool_grader_max_tasks_per_child():
+    grader = PoolGrader(1, max_tasks_per_child=1)
+    subs = list(grader.grade(PidTask(), make_submissions(3)))
+    pids = {sub.feedback['tests'].split()[0] for sub in subs}
+    assert len(pids) == 3
+
+
+def test_pool_grader_task_error():
+    grader = PoolGrader(2)
+    db = ListDB()
+    grader.set_db(db)
+    subs = make_submissions(2) + [Submission('bad', 'fail = True')]
+    graded = {sub.reference: sub for sub in grader.grade(PidTask(), subs)}
+    assert 'bad submission' in graded['bad'].feedback['tests']
+    assert {r.id: r.score for r in db.records}['bad'] == 0
+
+
+def test_fork_server_grader_isolates_submissions():
+    grader = ForkServerGrader(1)
+    subs = list(grader.grade(PidTask(), make_submissions(3)))
+    feedback = [sub.feedback['tests'].split() for sub in subs]
+    # Each submission runs in its own child, which never sees the state
+    # left behind by the previous submission.
+    assert len({pid for pid, _ in feedback}) == 3
+    assert all(calls == '1' for _, calls in feedback)
+
+
+@pytest.mark.parametrize('cls', (PoolGrader, ForkServerGrader))
+def test_submission_timeout(cls):
+    grader = cls(2, timeout=0.5)
+    subs = make_submissions(2) + [Submission('loop', 'loop = True')]
+    graded = {sub.reference: sub for sub in grader.grade(PidTask(2), subs)}
+    assert 'Time limit for submission' in graded['loop'].feedback['tests']
+    assert 'Time limit' not in graded['sub0'].feedback['tests']
+
+
+@pytest.mark.parametrize('cls', (PoolGrader, ForkServerGrader))
+def test_exercise_timeout_keeps_other_exercises(cls):
+    grader = cls(1, exercise_timeout=0.5)
+    db = ListDB()
+    grader.set_db(db)
+    sub, = grader.grade(PidTask(3), [Submission('loop', 'loop = True')])
+    feedback = sub.feedback['tests'].splitlines()
+    assert len(feedback) == 3
+    assert 'Time limit for exercise' in feedback[0]
+    assert db.records[0].score == pytest.approx(200 / 3)
+
+
+def loop_after_first_exercise(index, ns):
+    while index:
+        pass
+    return Result(1, 1, 'finished')
+
+
+def test_submission_timeout_partial_feedback():
+    grader = PoolGrader(1, timeout=0.5)
+    task = PidTask(2)
+    task.run_exercise = loop_after_first_exercise
+    sub, = grader.grade(task, [Submission('loop', 'x = 1')])
+    feedback = sub.feedback['tests'].splitlines()
+    assert feedback[0] == 'finished'
+    assert 'Time limit for submission' in feedback[1]
+
+
+@pytest.mark.parametrize('cls', (PoolGrader, ForkServerGrader))
+def test_cpu_limit(cls):
+    grader = cls(1, cpu_limit=1)
+    sub, = grader.grade(PidTask(), [Submission('loop', 'loop = True')])
+    assert sub.feedback['tests'] == 'CPU time limit exceeded.'
+
+
+@pytest.mark.parametrize('cls', (PoolGrader, ForkServerGrader))
+def test_memory_limit(cls):
+    grader = cls(1, memory_limit=2 ** 30)
+    source = f'allocate = {2 ** 31}'
+    sub, = grader.grade(PidTask(), [Submission('big', source)])
+    assert sub.feedback['tests'] == 'Grading failed: MemoryError: '
+
+
+def report_parent(index, ns):
+    return Result(1, 1, f'{os.getpid()} {os.getppid()}')
+
+
+@pytest.mark.parametrize(
+    'grader', (PoolGrader(1, max_tasks_per_child=1), ProcessGrader())
+)
+def test_workers_are_forked_from_template(grader):
+    task = PidTask()
+    task.run_exercise = report_parent
+    grader.start(task)
+    try:
+        template = grader.template.process.pid
+        subs = list(grader.grade(task, make_submissions(3)))
+    finally:
+        grader.stop()
+    feedback = [sub.feedback['tests'].split() for sub in subs]
+    assert len({pid for pid, _ in feedback}) == 3
+    assert {parent for _, parent in feedback} == {str(template)}
+    assert grader.template is None
+    # Without the task from start, the workers are forked from the grader.
+    sub, = grader.grade(task, make_submissions(1))
+    assert sub.feedback['tests'].split()[1] == str(os.getpid())
+
+
+@pytest.mark.parametrize('cls', (PoolGrader, ForkServerGrader))
+@pytest.mark.parametrize(
+    'limits, message',
+    (
+        ({'exercise_timeout': 0.5}, 'Time limit for exercise (0.5s) exceeded.'),
+        ({'cpu_limit': 1}, 'CPU time limit exceeded.'),
+    ),
+)
+def test_template_worker_limits(cls, limits, message):
+    grader = cls(1, **limits)
+    task = PidTask(2)
+    grader.start(task)
+    try:
+        subs = [Submission('loop', 'loop = True')] + make_submissions(2)
+        graded = {sub.reference: sub for sub in grader.grade(task, subs)}
+    finally:
+        grader.stop()
+    assert graded['loop'].feedback['tests'].splitlines()[0] == message
+    assert graded['sub1'].score == 2
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGKILL'), reason='requires SIGKILL')
+def test_kill_process():
+    process = mp.Process(target=time.sleep, args=(60,))
+    process.start()
+    _kill(process)
+    process.join(10)
+    assert process.exitcode == -signal.SIGKILL
+    # Killing a process that has exited does nothing.
+    _kill(process)
@@ -15,6 +15,12 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 #
+import gc
+import sqlite3
+import sys
+import threading
+import time
+import weakref
 from unittest import mock
 from textwrap import dedent
 
@@ -24,6 +30,7 @@ import pytest
 import markingpy
 from markingpy import markscheme
 from markingpy import finders
+from markingpy import storage
 
 
 @pytest.fixture
@@ -45,6 +52,19 @@ def ms():
     return ms
 
 
+def test_mark_scheme_expands_user(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    work = tmp_path / 'work'
+    work.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    monkeypatch.chdir(work)
+    monkeypatch.setattr(markingpy.users, '_MARKSCHEME', None)
+    ms = markingpy.users.mark_scheme(finder=finders.NullFinder())
+    ms.db.close()
+    assert (home / '.local' / 'markingpy' / 'marks.db').exists()
+    assert list(work.iterdir()) == []
+
+
 def test_markscheme_update_config(ms):
     conf = {
         'score_style': 'percentage', 'not_in': None
@@ -71,3 +91,345 @@ def test_markscheme_score_formatter(ms):
     # test with custom
     ms.score_style = '{score} - {total} ({percentage}%)'
     assert ms.format_return(score, total_score) == '1 - 2 (50%)'
+
+
+def test_markscheme_longest_first_schedule(tmp_path):
+    db = markingpy.SQLiteDB(tmp_path / 'marks.db')
+    db.add_runtime('slow', 2.0, 10)
+    db.add_runtime('fast', 0.1, 10)
+    subs = [
+        markingpy.Submission('fast', 'x = 1'),
+        markingpy.Submission('new_small', 'x' * 5),
+        markingpy.Submission('slow', 'x = 1'),
+        markingpy.Submission('new_large', 'x' * 100),
+    ]
+    ms = markscheme.MarkingScheme(
+        finder=finders.NullFinder(*subs), marks_db=db, schedule='longest-first'
+    )
+    # New submissions take 2.1s / 20 characters.
+    ordered = ms.order_submissions(ms.get_submissions())
+    assert [sub.reference for sub in ordered] == [
+        'new_large', 'slow', 'new_small', 'fast'
+    ]
+
+
+def test_markscheme_auto_schedule(ms):
+    subs = iter([])
+    assert ms.order_submissions(subs) is subs
+    assert isinstance(ms.order_submissions(subs, parallel=True), list)
+    ms.grader = markingpy.PoolGrader(2)
+    assert isinstance(ms.order_submissions(subs), list)
+
+
+def test_markscheme_records_runtimes(tmp_path):
+
+    def double(x):
+        return 2 * x
+
+    ex = markingpy.FunctionExercise(double, name='double')
+    ex.add_test_call((1,), {}, marks=1)
+    db = markingpy.SQLiteDB(tmp_path / 'marks.db')
+    source = 'def double(x):\n    return x + x\n'
+    ms = markscheme.MarkingScheme(
+        finder=finders.NullFinder(markingpy.Submission('sub', source)), marks_db=db
+    )
+    ms.add_exercise(ex)
+    ms.validate()
+    ms.run()
+    runtime, size = db.get_runtimes()['sub']
+    assert runtime >= 0
+    assert size == len(source)
+
+
+def make_resumable_scheme(path, grader):
+
+    def triple(x):
+        return 3 * x
+
+    ex = markingpy.FunctionExercise(triple, name='triple')
+    ex.add_test_call((1,), {}, marks=1)
+    subs = [
+        markingpy.Submission(f'sub{i}', 'def triple(x):\n    return x * 3\n')
+        for i in range(4)
+    ]
+    ms = markscheme.MarkingScheme(
+        finder=finders.NullFinder(*subs),
+        marks_db=markingpy.SQLiteDB(path),
+        grader=grader,
+        queue_size=1,
+    )
+    ms.add_exercise(ex)
+    ms.validate()
+    return ms
+
+
+def test_in_process_grading_runs_on_calling_thread(tmp_path, capsys):
+    ms = make_resumable_scheme(tmp_path / 'marks.db', None)
+    threads = set()
+    compile_submission = ms.compile_submission
+
+    def compile_on_thread(sub):
+        threads.add(threading.current_thread())
+        return compile_submission(sub)
+
+    ms.compile_submission = compile_on_thread
+    ms.grader.submit = mock.Mock(wraps=ms.grader.submit)
+    for sub in ms.run(generate=True):
+        # Output from the caller is not captured by the tests.
+        print(sub.reference)
+    assert threads == {threading.current_thread()}
+    assert capsys.readouterr().out.split() == [f'sub{i}' for i in range(4)]
+    assert ms.grader.submit.call_count == 4
+
+
+def test_markscheme_resume_needs_run_tracking(tmp_path):
+    ms = make_resumable_scheme(tmp_path / 'marks.db', None)
+    ms.db = storage.CSVStorageDB(tmp_path / 'marks.csv')
+    with pytest.raises(NotImplementedError, match='cannot be resumed'):
+        ms.run(resume=True)
+    assert not (tmp_path / 'marks.csv').exists()
+
+
+def test_markscheme_resume(tmp_path, counting_grader):
+    grader = counting_grader
+    ms = make_resumable_scheme(tmp_path / 'marks.db', grader)
+    graded = ms.run(generate=True)
+    next(graded)
+    # Interrupt the run after the first submission.
+    graded.close()
+    done = ms.db.get_completed(ms.fingerprint())
+    assert 'sub0' in done and len(done) < 4
+    grader.graded.clear()
+    ms.run(resume=True)
+    assert sorted(grader.graded + list(done)) == ['sub0', 'sub1', 'sub2', 'sub3']
+    assert ms.db.get_completed(ms.fingerprint()) == {'sub0', 'sub1', 'sub2', 'sub3'}
+    runs = ms.db.db.execute("SELECT finished FROM runs ORDER BY started").fetchall()
+    assert runs[0][0] is None and runs[1][0] is not None
+    # Records from a different marking scheme are not skipped.
+    ms.exercises[0].add_test_call((2,), {}, marks=1)
+    grader.graded.clear()
+    ms.run(resume=True)
+    assert len(grader.graded) == 4
+
+
+def test_sqlite_finder_watermark_advances_after_run(tmp_path, counting_grader):
+    path = tmp_path / 'subs.db'
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE subs (ref text, source text, updated int)")
+    conn.executemany(
+        "INSERT INTO subs VALUES (?, ?, ?)",
+        [(f'sub{i}', 'def triple(x):\n    return x * 3\n', i) for i in range(4)],
+    )
+    conn.commit()
+    conn.close()
+    grader = counting_grader
+    ms = make_resumable_scheme(tmp_path / 'marks.db', grader)
+    ms.finder = finders.ShardFinder(
+        finders.SQLiteFinder(path, 'subs', 'ref', 'source', changed_field='updated'),
+        0,
+        1,
+    )
+    graded = ms.run(generate=True)
+    next(graded)
+    graded.close()
+    # An interrupted run does not advance the watermark.
+    assert ms.finder.finder.since is None
+    ms.run()
+    assert ms.finder.finder.since == 3
+    grader.graded.clear()
+    ms.run()
+    assert grader.graded == []
+
+
+def test_incremental_finder_records_graded_submissions(tmp_path, counting_grader):
+    subs = tmp_path / 'subs'
+    subs.mkdir()
+    for i in range(4):
+        (subs / f'sub{i}.py').write_text('def triple(x):\n    return x * 3\n')
+    grader = counting_grader
+    ms = make_resumable_scheme(tmp_path / 'marks.db', grader)
+    ms.finder = finders.IncrementalFinder(
+        finders.DirectoryFinder(subs), tmp_path / 'manifest.json'
+    )
+    graded = ms.run(generate=True)
+    next(graded)
+    graded.close()
+    # Submissions found by the interrupted run are graded again.
+    grader.graded.clear()
+    ms.run()
+    assert sorted(grader.graded) == ['sub0', 'sub1', 'sub2', 'sub3']
+    grader.graded.clear()
+    ms.run()
+    assert grader.graded == []
+    # A changed marking scheme grades every submission again.
+    ms.exercises[0].add_test_call((2,), {}, marks=1)
+    ms.run()
+    assert len(grader.graded) == 4
+
+
+def test_sqlite_db_adds_missing_columns(tmp_path):
+    import sqlite3
+
+    conn = sqlite3.connect(str(tmp_path / 'old.db'))
+    conn.execute(
+        "CREATE TABLE submissions (submission_id text primary key,"
+        " percentage int, feedback text, markscheme_id text)"
+    )
+    conn.commit()
+    conn.close()
+    db = markingpy.SQLiteDB(tmp_path / 'old.db')
+    db.start_run('scheme')
+    db.add_record(markingpy.Record('sub', 100, ''))
+    assert db.get_completed('scheme') == {'sub'}
+
+
+def test_sqlite_db_batches_writes(tmp_path):
+    import sqlite3
+
+    path = tmp_path / 'marks.db'
+    db = markingpy.SQLiteDB(path, batch_size=3, flush_interval=60)
+    reader = sqlite3.connect(str(path))
+
+    def stored():
+        return reader.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+
+    assert reader.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+    db.start_run('scheme')
+    db.add_record(markingpy.Record('sub0', 100, ''))
+    db.add_runtime('sub0', 1.0, 10)
+    assert stored() == 0
+    db.add_record(markingpy.Record('sub1', 50, ''))
+    assert stored() == 2
+    db.add_record(markingpy.Record('sub2', 0, ''))
+    assert stored() == 2
+    # Reading through the store sees the buffered records.
+    assert db.get_completed('scheme') == {'sub0', 'sub1', 'sub2'}
+    assert stored() == 3
+    db.add_record(markingpy.Record('sub3', 0, ''))
+    db.close()
+    assert stored() == 4
+    db = markingpy.SQLiteDB(path, flush_interval=0.05)
+    db.add_record(markingpy.Record('sub4', 0, ''))
+    deadline = time.monotonic() + 5
+    while stored() < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stored() == 5
+    db.close()
+
+
+def test_sqlite_db_close(tmp_path):
+    db = markingpy.SQLiteDB(tmp_path / 'marks.db')
+    db.add_record(markingpy.Record('sub0', 100, ''))
+    db.close()
+    db.close()
+    for use in (
+        lambda: db.add_record(markingpy.Record('sub1', 0, '')),
+        lambda: db.get_completed('scheme'),
+        lambda: db.start_run('scheme'),
+    ):
+        with pytest.raises(RuntimeError, match='is closed'):
+            use()
+    db = markingpy.SQLiteDB(tmp_path / 'marks.db')
+    assert db.get_record('sub0') == ('sub0', 100, '')
+    # The exit hook does not keep a database that is no longer used alive.
+    ref = weakref.ref(db)
+    del db
+    gc.collect()
+    assert ref() is None
+
+
+def test_sqlite_db_stores_results(tmp_path):
+    ms = make_resumable_scheme(tmp_path / 'marks.db', None)
+    ms.exercises[0].add_test_call((2,), {}, marks=1)
+    ms.finder = finders.NullFinder(
+        markingpy.Submission('good', 'def triple(x):\n    return x * 3\n'),
+        markingpy.Submission('bad', 'def triple(x):\n    return x * (x + 2)\n'),
+        markingpy.Submission('missing', 'def double(x):\n    return x * 2\n'),
+    )
+    ms.run()
+    db = ms.db
+    rows = db.db.execute(
+        "SELECT submission_id, test_index, test, marks, passed, runtime"
+        " FROM test_results ORDER BY submission_id, test_index"
+    ).fetchall()
+    assert [row[:5] for row in rows] == [
+        ('bad', 0, 'CallTest', 1, 1),
+        ('bad', 1, 'CallTest', 0, 0),
+        ('good', 0, 'CallTest', 1, 1),
+        ('good', 1, 'CallTest', 1, 1),
+        ('missing', 0, 'CallTest', 0, 0),
+        ('missing', 1, 'CallTest', 0, 0),
+    ]
+    assert all(row[5] >= 0 for row in rows if row[0] != 'missing')
+    assert db.db.execute(
+        "SELECT submission_id, marks, total_marks FROM exercise_results"
+        " WHERE exercise = 'triple' ORDER BY submission_id"
+    ).fetchall() == [('bad', 1, 2), ('good', 2, 2), ('missing', 0, 2)]
+    assert db.get_pass_rates('triple') == {
+        ('triple', 0, 'CallTest'): 2 / 3,
+        ('triple', 1, 'CallTest'): 1 / 3,
+    }
+    plan = db.db.execute(
+        "EXPLAIN QUERY PLAN SELECT AVG(passed) FROM test_results"
+        " WHERE exercise = 'triple' AND test_index = 1"
+    ).fetchall()
+    assert 'test_results_by_test' in str(plan)
+    # Grading again replaces the results of the submission.
+    ms.exercises[0].tests.pop()
+    ms.finder = finders.NullFinder(
+        markingpy.Submission('bad', 'def triple(x):\n    return x * (x + 2)\n')
+    )
+    ms.run()
+    rows = db.db.execute(
+        "SELECT test_index, passed FROM test_results WHERE submission_id = 'bad'"
+    ).fetchall()
+    assert rows == [(0, 1)]
+
+
+def test_sqlite_db_merge(tmp_path):
+    shards = []
+    for i, records in enumerate([[('a', 100), ('b', 50)], [('c', 0), ('b', 60)]]):
+        db = markingpy.SQLiteDB(tmp_path / f'shard{i}.db')
+        db.start_run('scheme')
+        for ref, score in records:
+            db.add_results(ref, [('ex', score, 100, [('test', score, score > 0, 0.1)])])
+            db.add_record(markingpy.Record(ref, score, f'{ref} feedback'))
+        db.add_runtime('a', 1.0, 10)
+        db.close()
+        shards.append(db.path)
+    merged = markingpy.SQLiteDB(tmp_path / 'merged.db')
+    assert merged.merge(shards[0]) == []
+    assert merged.merge(shards[1]) == ['b']
+    scores = {ref: score for ref, score, _ in merged.get_all()}
+    assert scores == {'a': 100, 'b': 50, 'c': 0}
+    results = merged.db.execute("SELECT submission_id, marks FROM exercise_results")
+    assert sorted(results) == [('a', 100), ('b', 50), ('c', 0)]
+    assert merged.get_completed('scheme') == {'a', 'b', 'c'}
+    assert merged.merge(shards[1], overwrite=True) == ['b']
+    assert merged.get_record('b')[1] == 60
+    assert merged.get_pass_rates()[('ex', 0, 'test')] == 2 / 3
+    assert merged.get_runtimes() == {'a': (1.0, 10)}
+    assert len(merged.db.execute("SELECT * FROM runs").fetchall()) == 2
+    with pytest.raises(FileNotFoundError):
+        merged.merge(tmp_path / 'missing.db')
+
+
+def test_markscheme_compile_workers(tmp_path, counting_grader):
+    ms = make_resumable_scheme(tmp_path / 'marks.db', counting_grader)
+    broken = markingpy.Submission('broken', 'def triple(x)\n    return x * 3\n')
+    ms.finder = finders.NullFinder(broken, *ms.finder.get_submissions())
+    ms.compile_workers = 2
+    ms.metrics = tmp_path / 'metrics'
+    graded = {sub.reference: sub for sub in ms.run(generate=True)}
+    assert sorted(graded) == ['broken', 'sub0', 'sub1', 'sub2', 'sub3']
+    assert graded['sub0'].score == 1
+    assert graded['broken'].score == 0
+    assert 'Removed:' in graded['broken'].feedback['compilation']
+    report = (tmp_path / 'metrics.json').read_text()
+    assert '"broken"' in report
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='requires Python 3.7')
+def test_compile_workers_are_not_forked():
+    with markscheme._compile_pool(1) as pool:
+        assert pool._mp_context.get_start_method() in ('forkserver', 'spawn')
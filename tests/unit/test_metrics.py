@@ -0,0 +1,112 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+import json
+
+import pytest
+
+from markingpy import (
+    FunctionExercise,
+    MarkingScheme,
+    Metrics,
+    NullFinder,
+    PoolGrader,
+    SimpleGrader,
+    SQLiteDB,
+    Submission,
+    metrics,
+)
+from markingpy.metrics import Histogram, Sample
+
+
+def square(x):
+    return x * x
+
+
+def test_histogram():
+    hist = Histogram((0.1, 1.0, float('inf')))
+    for value in (0.05, 0.5, 0.7, 5.0):
+        hist.add(value)
+    assert hist.cumulative() == [1, 3, 4]
+    report = hist.as_dict()
+    assert report['count'] == 4
+    assert report['max'] == 5.0
+    assert report['buckets'] == {'0.1': 1, '1.0': 3, '+Inf': 4}
+
+
+def test_measure_inactive():
+    assert metrics.active() is None
+    with metrics.measure('compile'):
+        pass
+    assert metrics.drain() == []
+
+
+def test_measure_collecting():
+    collected = Metrics()
+    with metrics.collecting(collected):
+        with metrics.submission('sub'):
+            with metrics.measure('test', exercise='ex', test='t'):
+                pass
+        with metrics.measure('compile', 'other'):
+            pass
+    assert metrics.active() is None
+    first, second = collected.samples
+    assert first[:4] == ('test', 'sub', 'ex', 't')
+    assert second[:4] == ('compile', 'other', None, None)
+    assert first.wall >= 0 and first.cpu >= 0
+
+
+def test_prometheus_format():
+    collected = Metrics(buckets=(1.0, float('inf')))
+    collected.add(Sample('test', 's', 'ex "1"', 't', 0.5, 0.25, 1024))
+    text = collected.prometheus()
+    labels = 'stage="test",exercise="ex \\"1\\"",test="t"'
+    assert f'markingpy_wall_seconds_bucket{{{labels},le="1.0"}} 1' in text
+    assert f'markingpy_cpu_seconds_sum{{{labels}}} 0.25' in text
+    assert f'markingpy_peak_rss_bytes{{{labels}}} 1024' in text
+
+
+@pytest.mark.parametrize(
+    'grader, processes',
+    [(SimpleGrader(), None), (PoolGrader(1), None), (SimpleGrader(), 2)],
+)
+def test_run_writes_metrics(tmp_path, grader, processes):
+    ex = FunctionExercise(square, name='square')
+    ex.add_test_call((2,), {}, marks=1)
+    ex.add_test_call((3,), {}, marks=1)
+    subs = [
+        Submission(f'sub{i}', 'def square(x):\n    return x ** 2\n') for i in range(2)
+    ]
+    ms = MarkingScheme(
+        finder=NullFinder(*subs),
+        grader=grader,
+        marks_db=SQLiteDB(tmp_path / 'marks.db'),
+        exercise_processes=processes,
+        metrics=tmp_path / 'metrics',
+    )
+    ms.add_exercise(ex)
+    ms.validate()
+    ms.run()
+    report = json.loads((tmp_path / 'metrics.json').read_text())
+    assert report['stages']['compile']['wall']['count'] == 2
+    assert report['stages']['exec']['wall']['count'] == 2
+    assert report['stages']['test']['wall']['count'] == 4
+    assert {t['exercise'] for t in report['tests']} == {'square'}
+    assert set(report['submissions']) == {'sub0', 'sub1'}
+    assert set(report['submissions']['sub0']) == {'compile', 'exec', 'test'}
+    text = (tmp_path / 'metrics.prom').read_text()
+    assert 'markingpy_wall_seconds_count{stage="exec"} 2' in text
@@ -0,0 +1,131 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+import threading
+
+import pytest
+
+from markingpy.pipeline import Pipeline
+
+
+def test_pipeline_preserves_order_with_single_workers():
+    pipe = Pipeline(range(20), maxsize=2)
+    pipe.add_stage('double', lambda x: 2 * x)
+    pipe.add_stream_stage('increment', lambda items: (x + 1 for x in items))
+    assert list(pipe) == [2 * x + 1 for x in range(20)]
+
+
+def test_pipeline_stage_concurrency():
+    # Each call waits until four calls are running at once, which only
+    # happens if the stage runs its workers concurrently.
+    barrier = threading.Barrier(4, timeout=10)
+
+    def slow(x):
+        barrier.wait()
+        return x
+
+    pipe = Pipeline(range(8))
+    pipe.add_stage('slow', slow, workers=4)
+    assert sorted(pipe) == list(range(8))
+
+
+def test_pipeline_bypass():
+    calls = []
+
+    def record(x):
+        calls.append(x)
+        return x
+
+    pipe = Pipeline(range(6))
+    pipe.add_stage('record', record, bypass=lambda x: x % 2)
+    assert sorted(pipe) == list(range(6))
+    assert calls == [0, 2, 4]
+
+
+def test_pipeline_error_propagates():
+
+    def fail(x):
+        if x == 3:
+            raise ValueError('bad item')
+
+        return x
+
+    pipe = Pipeline(range(10))
+    pipe.add_stage('fail', fail)
+    with pytest.raises(ValueError):
+        list(pipe)
+
+
+def test_pipeline_stages_overlap():
+    second_started = threading.Event()
+
+    def first(x):
+        # The first stage only moves on to item 2 once the second stage is
+        # working on item 0, so this deadlocks unless the stages overlap.
+        if x == 2:
+            assert second_started.wait(10)
+        return x
+
+    def second(x):
+        second_started.set()
+        return x
+
+    pipe = Pipeline(range(3))
+    pipe.add_stage('first', first)
+    pipe.add_stage('second', second)
+    assert list(pipe) == [0, 1, 2]
+
+
+def test_pipeline_without_threads():
+    threads = []
+
+    def record(x):
+        threads.append(threading.current_thread())
+        return x
+
+    def increment(items):
+        for x in items:
+            threads.append(threading.current_thread())
+            yield x + 1
+
+    pipe = Pipeline(range(6), threaded=False)
+    pipe.add_stage('record', record, bypass=lambda x: x == 0)
+    pipe.add_stream_stage('increment', increment, bypass=lambda x: x % 2)
+    assert sorted(pipe) == [1, 1, 3, 3, 5, 5]
+    assert len(threads) == 8
+    assert set(threads) == {threading.current_thread()}
+
+
+def test_pipeline_close_joins_stages():
+    started = []
+    finished = []
+
+    def slow(x):
+        started.append(x)
+        threading.Event().wait(0.05)
+        finished.append(x)
+        return x
+
+    pipe = Pipeline(range(20), maxsize=1)
+    pipe.add_stage('slow', slow, workers=2)
+    items = iter(pipe)
+    next(items)
+    items.close()
+    # The items being processed when the pipeline was closed are finished,
+    # and the stage has stopped.
+    assert sorted(finished) == sorted(started)
+    assert not [t for t in threading.enumerate() if t.name.startswith('slow-')]
@@ -0,0 +1,159 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+import argparse
+import json
+from io import StringIO
+
+import pytest
+
+from markingpy import (
+    FunctionExercise,
+    JSONReporter,
+    DirectoryFinder,
+    MarkingScheme,
+    NullFinder,
+    PoolGrader,
+    Progress,
+    SimpleGrader,
+    SQLiteDB,
+    Submission,
+    TTYReporter,
+)
+from markingpy.cli import add_grader_arguments
+
+
+def cube(x):
+    return x ** 3
+
+
+def test_progress_status():
+    progress = Progress(total=4)
+    progress.start('w1', 'sub0')
+    progress.start('w2', 'sub1')
+    progress.finish('w1', 'sub0')
+    progress.complete('sub0')
+    status = progress.status()
+    assert status['completed'] == 1
+    assert status['rate'] > 0
+    assert status['eta'] == pytest.approx(3 / status['rate'])
+    assert status['average'] is not None
+    (worker,) = status['workers']
+    assert worker['worker'] == 'w2' and worker['submission'] == 'sub1'
+    # A worker that has moved on is not cleared by a late finish.
+    progress.start('w2', 'sub2')
+    progress.finish('w2', 'sub1')
+    assert progress.status()['workers'][0]['submission'] == 'sub2'
+
+
+def test_progress_unknown_total():
+    progress = Progress()
+    progress.complete('sub0')
+    assert progress.status()['eta'] is None
+
+
+def test_progress_rate_uses_recent_window(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr('markingpy.progress.time.monotonic', lambda: clock[0])
+    progress = Progress(total=10, window=2)
+    # Two slow submissions followed by two fast ones.
+    for now in (10.0, 20.0, 21.0, 22.0):
+        clock[0] = now
+        progress.complete('sub')
+    status = progress.status()
+    assert status['rate'] == pytest.approx(1.0)
+    assert status['eta'] == pytest.approx(6.0)
+
+
+def test_tty_reporter():
+    stream = StringIO()
+    progress = Progress(total=2, reporters=[TTYReporter(stream)])
+    progress.start('w1', 'slow_sub')
+    progress.report()
+    progress.complete('other')
+    progress.report(final=True)
+    first, second = stream.getvalue().split('\r')[1:]
+    assert first.startswith('Graded 0/2')
+    assert 'longest slow_sub' in first
+    assert second.startswith('Graded 1/2')
+    assert second.endswith('\n')
+
+
+def test_json_reporter(tmp_path):
+    path = tmp_path / 'status.json'
+    progress = Progress(reporters=[JSONReporter(path)])
+    progress.complete('sub0')
+    progress.report()
+    status = json.loads(path.read_text())
+    assert status['completed'] == 1
+    assert not status['finished']
+    assert list(tmp_path.iterdir()) == [path]
+
+
+@pytest.mark.parametrize('grader', [SimpleGrader(), PoolGrader(2)])
+def test_run_reports_progress(tmp_path, grader):
+    ex = FunctionExercise(cube, name='cube')
+    ex.add_test_call((2,), {}, marks=1)
+    subs = [
+        Submission(f'sub{i}', 'def cube(x):\n    return x * x * x\n') for i in range(3)
+    ]
+    ms = MarkingScheme(
+        finder=NullFinder(*subs),
+        grader=grader,
+        marks_db=SQLiteDB(tmp_path / 'marks.db'),
+        schedule='longest-first',
+        status_file=tmp_path / 'status.json',
+    )
+    ms.add_exercise(ex)
+    ms.validate()
+    ms.run()
+    status = json.loads((tmp_path / 'status.json').read_text())
+    assert status['finished']
+    assert status['completed'] == status['total'] == 3
+    assert status['workers'] == []
+    assert status['average'] is not None
+    assert grader.progress is None
+
+
+def test_streaming_run_reports_total(tmp_path):
+    ex = FunctionExercise(cube, name='cube')
+    ex.add_test_call((2,), {}, marks=1)
+    subs = tmp_path / 'subs'
+    subs.mkdir()
+    for i in range(3):
+        (subs / f'sub{i}.py').write_text('def cube(x):\n    return x * x * x\n')
+    ms = MarkingScheme(
+        finder=DirectoryFinder(subs),
+        marks_db=SQLiteDB(tmp_path / 'marks.db'),
+        status_file=tmp_path / 'status.json',
+    )
+    ms.add_exercise(ex)
+    ms.validate()
+    ms.run()
+    status = json.loads((tmp_path / 'status.json').read_text())
+    assert status['completed'] == status['total'] == 3
+
+
+def test_progress_option_keeps_scheme_setting():
+    parser = argparse.ArgumentParser()
+    add_grader_arguments(parser)
+    ms = MarkingScheme(finder=NullFinder(), progress=True)
+    ms.update_config(vars(parser.parse_args([])))
+    assert ms.progress
+    ms.progress = False
+    ms.update_config(vars(parser.parse_args(['--progress'])))
+    assert ms.progress
@@ -0,0 +1,87 @@
+#      Markingpy automatic grading tool for Python code.
+#      Copyright (C) 2019 University of East Anglia
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+import threading
+import time
+
+import pytest
+
+from markingpy import DirectoryFinder, InotifyMonitor, NullFinder, SubmissionWatcher
+
+
+def inotify_available(tmp_path):
+    try:
+        InotifyMonitor(DirectoryFinder(tmp_path)).close()
+    except (OSError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_get_loader(tmp_path, make_scheme):
+    (tmp_path / 'alice').mkdir()
+    (tmp_path / 'alice' / 'main.py').write_text('a = 1')
+    finder = DirectoryFinder(tmp_path, exclude=('skip_*',))
+    watcher = SubmissionWatcher(make_scheme(tmp_path / 'marks.db'), finder)
+    ref, load = watcher.get_loader(str(tmp_path / 'bob.py'))
+    assert ref == 'bob'
+    assert watcher.get_loader(str(tmp_path / 'notes.txt')) is None
+    assert watcher.get_loader(str(tmp_path / 'skip_me.py')) is None
+    assert watcher.get_loader(str(tmp_path / 'alice' / 'main.py')) is None
+    finder = DirectoryFinder(tmp_path, per_directory=True)
+    watcher = SubmissionWatcher(make_scheme(tmp_path / 'marks.db'), finder)
+    ref, load = watcher.get_loader(str(tmp_path / 'alice' / 'main.py'))
+    assert ref == 'alice'
+    assert 'a = 1' in load()
+
+
+@pytest.mark.parametrize('use_inotify', [False, True])
+def test_watcher_grades_changes(tmp_path, use_inotify, make_scheme):
+    if use_inotify and not inotify_available(tmp_path):
+        pytest.skip('inotify is not available')
+    subs = tmp_path / 'subs'
+    subs.mkdir()
+    (subs / 'old.py').write_text('def add(a, b):\n    return a + b\n')
+    ms = make_scheme(tmp_path / 'marks.db')
+    db = ms.db
+    finder = DirectoryFinder(subs)
+    watcher = SubmissionWatcher(
+        ms, finder, debounce=0.1, poll_interval=0.05, use_inotify=use_inotify
+    )
+    stop = threading.Event()
+    thread = threading.Thread(target=watcher.run, kwargs={'stop': stop})
+    thread.start()
+    try:
+        assert wait_for(lambda: db.get_record('old') is not None)
+        (subs / 'new.py').write_text('def add(a, b):\n    return a - b\n')
+        assert wait_for(lambda: db.get_record('new') is not None)
+        assert db.get_record('new')[1] == 0
+        (subs / 'new.py').write_text('def add(a, b):\n    return b + a\n')
+        assert wait_for(lambda: db.get_record('new')[1] == 100)
+    finally:
+        stop.set()
+        thread.join(5)
+    assert not thread.is_alive()
+    assert ms.finder is not finder and isinstance(ms.finder, NullFinder)